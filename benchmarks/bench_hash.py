@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+"""Compares time to checksum a synthetic file using the previous
+   4 KiB read md5 implementation and dbutil.hash_file() computing
+   md5 alone and md5 and sha256 in one pass serially and on a thread
+   pool. Threads split work across digests, one per thread, so the
+   threaded run only helps on machines with multiple cores.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from cildata_util import dbutil
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments
+    """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--sizemb', type=int, default=512,
+                        help='Size of synthetic file in megabytes '
+                             '(default 512)')
+    parser.add_argument('--threads', type=int, default=2,
+                        help='Number of threads used by threaded '
+                             'hash_file() run (default 2)')
+    parser.add_argument('--tmpdir', default=None,
+                        help='Directory under which synthetic file is '
+                             'created (default system temp directory)')
+    return parser.parse_args(args)
+
+
+def _write_file(fname, sizemb):
+    """Writes `sizemb` megabytes of random data to `fname`
+    """
+    block = os.urandom(1024 * 1024)
+    with open(fname, 'wb') as f:
+        for x in range(sizemb):
+            f.write(block)
+
+
+def _legacy_md5(fname):
+    """md5 as calculated by dbutil.md5() before hash_file() was added
+    """
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def _run_benchmark(name, func, sizemb):
+    """Runs `func` and outputs the time taken and throughput
+    """
+    start = time.time()
+    res = func()
+    duration = time.time() - start
+    sys.stdout.write(name + ': ' + '%.2f' % duration + 's ' +
+                     '%.1f' % (sizemb / max(duration, 1e-9)) + ' MB/s\n')
+    return duration, res
+
+
+def main(args):
+    """Runs benchmark
+    """
+    theargs = _parse_arguments(__doc__, args[1:])
+    temp_dir = tempfile.mkdtemp(dir=theargs.tmpdir)
+    try:
+        fname = os.path.join(temp_dir, 'data')
+        _write_file(fname, theargs.sizemb)
+        algos = (dbutil.MD5_ALGORITHM, dbutil.SHA256_ALGORITHM)
+        sys.stdout.write('Hashing ' + str(theargs.sizemb) + ' MB file\n')
+        legacy = _run_benchmark('legacy md5',
+                                lambda: _legacy_md5(fname),
+                                theargs.sizemb)
+        new = _run_benchmark('hash_file md5',
+                             lambda: dbutil.hash_file(fname,
+                                                      use_cache=False),
+                             theargs.sizemb)
+        serial = _run_benchmark('hash_file md5+sha256',
+                                lambda: dbutil.hash_file(fname,
+                                                         algorithms=algos,
+                                                         use_cache=False),
+                                theargs.sizemb)
+        threaded = _run_benchmark('hash_file md5+sha256 ' +
+                                  str(theargs.threads) + ' threads',
+                                  lambda: dbutil.hash_file(
+                                      fname, algorithms=algos,
+                                      threads=theargs.threads,
+                                      use_cache=False),
+                                  theargs.sizemb)
+        if not (legacy[1] == new[1][dbutil.MD5_ALGORITHM] ==
+                serial[1][dbutil.MD5_ALGORITHM] ==
+                threaded[1][dbutil.MD5_ALGORITHM]):
+            raise ValueError('md5 mismatch between implementations')
+        if serial[1] != threaded[1]:
+            raise ValueError('sha256 mismatch between implementations')
+        sys.stdout.write('Speedup vs legacy md5: md5 ' +
+                         '%.1f' % (legacy[0] / new[0]) + 'x md5+sha256 ' +
+                         '%.1f' % (legacy[0] / serial[0]) + 'x threaded ' +
+                         '%.1f' % (legacy[0] / threaded[0]) + 'x\n')
+    finally:
+        shutil.rmtree(temp_dir)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
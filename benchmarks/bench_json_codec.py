@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+
+"""Compares time to write and read a synthetic download tree of
+   per ID json files using CILDataFileJsonPickleWriter (legacy format)
+   and CILDataFileJsonWriter.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonPickleWriter
+from cildata_util.dbutil import CILDataFileJsonWriter
+from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments
+    """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--numfiles', type=int, default=100000,
+                        help='Number of per ID json files to '
+                             'generate (default 100000)')
+    parser.add_argument('--tmpdir', default=None,
+                        help='Directory under which synthetic tree is '
+                             'created (default system temp directory)')
+    return parser.parse_args(args)
+
+
+def _get_cildatafiles(cur_id):
+    """Generates CILDataFile objects like those written by
+       cildatadownloader.py for image `cur_id`
+    """
+    cdf_list = []
+    for suffix in [dbutil.TIF_SUFFIX, dbutil.JPG_SUFFIX, dbutil.RAW_SUFFIX]:
+        cdf = CILDataFile(str(cur_id))
+        cdf.set_is_video(False)
+        cdf.set_has_raw(True)
+        cdf.set_file_name(str(cur_id) + suffix)
+        cdf.set_localfile(cdf.get_file_name())
+        cdf.set_download_success(True)
+        cdf.set_mime_type('image/jpeg')
+        cdf.set_checksum('d41d8cd98f00b204e9800998ecf8427e')
+        cdf.set_file_size(123456)
+        cdf.set_headers({'Content-Type': 'image/jpeg',
+                         'Date': 'Tue, 23 Jan 2018 20:42:49 GMT',
+                         'Content-Length': '123456'})
+        cdf_list.append(cdf)
+    return cdf_list
+
+
+def _run_benchmark(name, writer, base_dir, numfiles):
+    """Writes and reads `numfiles` json files under `base_dir` using
+       `writer` and outputs the time taken
+    """
+    images_dir = os.path.join(base_dir, dbutil.IMAGES_DIR)
+    for cur_id in range(numfiles):
+        os.makedirs(os.path.join(images_dir, str(cur_id)))
+
+    start = time.time()
+    for cur_id in range(numfiles):
+        writer.writeCILDataFileListToFile(os.path.join(images_dir,
+                                                       str(cur_id),
+                                                       str(cur_id)),
+                                          _get_cildatafiles(cur_id))
+    write_duration = time.time() - start
+
+    start = time.time()
+    fac = CILDataFileFromJsonFilesFactory()
+    cdf_list = fac.get_cildatafiles(base_dir)
+    read_duration = time.time() - start
+    if len(cdf_list) != numfiles * 3:
+        raise ValueError('Expected ' + str(numfiles * 3) +
+                         ' entries, but got ' + str(len(cdf_list)))
+
+    sys.stdout.write(name + ': write ' + '%.2f' % write_duration +
+                     's read ' + '%.2f' % read_duration + 's\n')
+    return write_duration, read_duration
+
+
+def main(args):
+    """Runs benchmark
+    """
+    theargs = _parse_arguments(__doc__, args[1:])
+    temp_dir = tempfile.mkdtemp(dir=theargs.tmpdir)
+    try:
+        sys.stdout.write('Writing and reading ' + str(theargs.numfiles) +
+                         ' json files\n')
+        legacy = _run_benchmark('jsonpickle',
+                                CILDataFileJsonPickleWriter(),
+                                os.path.join(temp_dir, 'legacy'),
+                                theargs.numfiles)
+        new = _run_benchmark('json v' + str(dbutil.JSON_FORMAT_VERSION),
+                             CILDataFileJsonWriter(),
+                             os.path.join(temp_dir, 'new'),
+                             theargs.numfiles)
+        sys.stdout.write('Speedup: write ' + '%.1f' % (legacy[0] / new[0]) +
+                         'x read ' + '%.1f' % (legacy[1] / new[1]) + 'x\n')
+    finally:
+        shutil.rmtree(temp_dir)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -5,19 +5,35 @@ import argparse
 import sys
 import logging
 import os
+import collections
+import itertools
+import time
 import zipfile
+import multiprocessing
+from functools import partial
 
 import cildata_util
 from cildata_util import config
 from cildata_util import dbutil
-from cildata_util.dbutil import CILDataFileJsonPickleWriter
+from cildata_util.dbutil import CILDataFileJsonWriter
 from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
-from cildata_util.dbutil import CILDataFileListFromJsonPickleFactory
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
 from cildata_util.dbutil import CILDataFileConverter
+from cildata_util.dbutil import CILDataFileConvertState
 from cildata_util.dbutil import CILDataFileNoRawFilter
 
 logger = logging.getLogger('cildata_util.cildataconverter')
 
+SECONDS_PER_DAY = 86400
+
+# number of ids between progress log messages
+PROGRESS_INTERVAL = 1000
+
+# number of ids read on the main thread and handed to the process pool
+# at a time, the ids come from a generator that may use a scan cache
+# whose connection can only be used by the thread that opened it
+CONVERT_BATCH_SIZE = 256
+
 
 def _parse_arguments(desc, args):
     """Parses command line arguments
@@ -40,6 +56,59 @@ def _parse_arguments(desc, args):
                         help='If set skip any ids where no raw file is found'
                              'in directory.')
 
+    parser.add_argument('--ignorestate', action='store_true',
+                        help='If set, ignore <ID>' +
+                             dbutil.CONVERT_STATE_SUFFIX + ' files and '
+                             'convert ids already marked as converted. '
+                             'Steps of partially converted entries are '
+                             'still resumed')
+    parser.add_argument('--keepbackups', type=int,
+                        help='If set, only keep this many of the newest '
+                             'backups of each json file, older ones are '
+                             'removed each time a backup is made')
+    parser.add_argument('--keepbackupsdays', type=float,
+                        help='If set, keep backups of json files made '
+                             'within this many days. Combined with '
+                             '--keepbackups a backup is kept if either '
+                             'applies')
+    parser.add_argument('--compactbackups', action='store_true',
+                        help='If set, only remove backups of json files '
+                             'as specified by --keepbackups and '
+                             '--keepbackupsdays and exit without '
+                             'converting anything')
+    parser.add_argument('--compresslevel', type=int, choices=range(0, 10),
+                        default=dbutil.DEFAULT_COMPRESS_LEVEL,
+                        help='zlib compression level used for files put '
+                             'into <ID>.zip that are not already '
+                             'compressed, 0 stores all files (default ' +
+                             str(dbutil.DEFAULT_COMPRESS_LEVEL) + ')')
+    parser.add_argument('--deflatethreads', type=int, default=1,
+                        help='If greater then 1, files of at least ' +
+                             str(dbutil.PARALLEL_DEFLATE_MIN_SIZE) +
+                             ' bytes put into <ID>.zip are compressed '
+                             'using this many threads (default 1)')
+    parser.add_argument('--select', help=dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read json '
+                             'files in download directory and to convert '
+                             'ids, each id is converted by one process '
+                             '(default 1)')
+    parser.add_argument('--scancache',
+                        help='Path to scan cache file, created if needed, '
+                             'used to skip parsing json files that have not '
+                             'changed since the last run. For example ' +
+                             dbutil.SCAN_CACHE_FILE)
+    parser.add_argument('--checksumcache',
+                        help='Path to checksum cache file, created if '
+                             'needed, used to skip computing md5 of files '
+                             'that have not changed since their md5 was '
+                             'last computed. For example ' +
+                             dbutil.CHECKSUM_CACHE_FILE)
+    parser.add_argument('--checksumxattr', action='store_true',
+                        help='If set, also cache md5 of files in user '
+                             'extended attributes of the files')
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + cildata_util.__version__))
     return parser.parse_args(args)
@@ -69,6 +138,34 @@ def _check_zip_files(cdf, base_dir):
     zf.close()
 
 
+def _get_keep_since(theargs):
+    """Gets time in seconds since epoch from --keepbackupsdays
+    :returns: time or None if --keepbackupsdays was not set
+    """
+    if theargs.keepbackupsdays is None:
+        return None
+    return time.time() - theargs.keepbackupsdays * SECONDS_PER_DAY
+
+
+def _compact_backups(theargs):
+    """Removes backups of json files in download directory
+       as specified by --keepbackups and --keepbackupsdays
+    """
+    if theargs.keepbackups is None and theargs.keepbackupsdays is None:
+        logger.error('--compactbackups requires --keepbackups and/or '
+                     '--keepbackupsdays')
+        return 1
+    keep_since = _get_keep_since(theargs)
+    fac = CILDataFileFromJsonFilesFactory(id=theargs.id,
+                                          discovery_threads=theargs.workers)
+    num_removed = 0
+    for jsonfile in fac.get_json_files(os.path.abspath(theargs.downloaddir)):
+        num_removed += len(dbutil.compact_backups_of_json(
+            jsonfile, keep=theargs.keepbackups, keep_since=keep_since))
+    logger.info('Removed ' + str(num_removed) + ' backups')
+    return 0
+
+
 def _convert_data(theargs):
     """Examine all downloaded data and retry any
        failed entries
@@ -76,71 +173,201 @@ def _convert_data(theargs):
     abs_destdir = os.path.abspath(theargs.downloaddir)
     images_destdir = os.path.join(abs_destdir, dbutil.IMAGES_DIR)
     videos_destdir = os.path.join(abs_destdir, dbutil.VIDEOS_DIR)
-    fac = CILDataFileFromJsonFilesFactory()
-    all_cdf = fac.get_cildatafiles(abs_destdir)
-
-    logger.info('Total entries: ' + str(len(all_cdf)))
-
+    scan_cache = dbutil.get_scan_cache(theargs.scancache)
+    fac = CILDataFileFromJsonFilesFactory(id=theargs.id,
+                                          use_index=not theargs.noindex,
+                                          discovery_threads=theargs.workers,
+                                          workers=theargs.workers,
+                                          scan_cache=scan_cache,
+                                          predicate=dbutil.compile_select(
+                                              theargs.select))
     nofailedrawfilt = CILDataFileNoRawFilter()
-    filt_cdf = nofailedrawfilt.get_cildatafiles(all_cdf)
-
-    converter = CILDataFileConverter()
-    reader = CILDataFileListFromJsonPickleFactory()
-    writer = CILDataFileJsonPickleWriter()
+    filt_cdf = nofailedrawfilt.iter_cildatafiles(
+        fac.iter_cildatafiles(abs_destdir))
 
-    for cdf in filt_cdf:
+    index = dbutil.get_catalog_index(abs_destdir)
+    try:
+        return _convert_cildatafiles(theargs, filt_cdf, index,
+                                     images_destdir, videos_destdir)
+    finally:
+        if index is not None:
+            index.close()
+        if scan_cache is not None:
+            scan_cache.close()
+
+
+class _IndexUpdateRecorder(object):
+    """Used in place of CILDataFileCatalogIndex by processes converting
+       an id. Records json files written so the parent process, which
+       owns the index, can apply the updates
+    """
+    def __init__(self):
+        """Constructor
+        """
+        self._updates = []
+
+    def update_json_file(self, json_file, cdf_dict_list):
+        """Records update of `json_file`
+        """
+        self._updates.append((json_file, cdf_dict_list))
+
+    def get_updates(self):
+        """Gets recorded updates
+        :returns: list of tuples (json file, list of CILDataFile dicts)
+        """
+        return self._updates
+
+
+def _get_cildatafiles_by_id(theargs, filt_cdf):
+    """Generator that groups CILDataFile objects in `filt_cdf` by id
+       skipping ids that do not match --id
+    :returns: tuples (id, list of CILDataFile objects)
+    """
+    for cur_id, cdfs in dbutil.group_cildatafiles_by_id(filt_cdf):
         if theargs.id is not None:
-            if theargs.id != str(cdf.get_id()):
-                continue
-        logger.debug(cdf.get_file_name())
-        if cdf.get_is_video():
-            base_dir = os.path.join(videos_destdir, str(cdf.get_id()))
-        else:
-            base_dir = os.path.join(images_destdir, str(cdf.get_id()))
-            jsonfile = os.path.join(base_dir, str(cdf.get_id()) + dbutil.JSON_SUFFIX)
-            if not os.path.isfile(jsonfile):
-                logger.error(str(cdf.get_file_name()) + ' was guessed to be image, '
-                                                        'but this is wrong'
-                                                        'going with video')
-                base_dir = os.path.join(videos_destdir, str(cdf.get_id()))
-
-        if theargs.onlycheckzipfiles is True:
-            _check_zip_files(cdf, base_dir)
-            continue
-
-        if theargs.skipifrawmissing is True:
-            raw = os.path.join(base_dir, str(cdf.get_id() + dbutil.RAW_SUFFIX))
-            if not os.path.isfile(raw):
-                logger.debug('Skipping... ' + str(cdf.get_id()) + ' no raw file found')
+            if theargs.id != cur_id:
                 continue
+        yield cur_id, list(cdfs)
 
-        newcdfs = converter.convert(cdf, base_dir)
-
-        jsonfile = os.path.join(base_dir, str(cdf.get_id()) + dbutil.JSON_SUFFIX)
-        logger.debug('Making backup of ' + jsonfile)
-        dbutil.make_backup_of_json(jsonfile)
-
-        cdf_list = reader.get_cildatafiles(jsonfile)
 
-        newcdf_list = []
-        for entry in cdf_list:
-            logger.debug('Entry file name: ' + entry.get_file_name() +
-                         ' and cdf file name: ' + cdf.get_file_name())
+def _convert_cildatafiles_of_id(theargs, images_destdir, videos_destdir,
+                                id_and_cdfs):
+    """Converts CILDataFile objects of one id updating the json file
+       for that id once. Run in worker processes when --workers is
+       greater then 1 so no exceptions are raised.
+    :param id_and_cdfs: tuple (id, list of CILDataFile objects)
+    :returns: tuple (id, number of entries converted, list of updates
+              to apply to index, error message or None)
+    """
+    cur_id, cdfs = id_and_cdfs
+    recorder = _IndexUpdateRecorder()
+    num_converted = 0
+    try:
+        converter = CILDataFileConverter(
+            compresslevel=theargs.compresslevel,
+            deflate_threads=theargs.deflatethreads)
+        reader = CILDataFileListFromJsonFactory()
+        writer = CILDataFileJsonWriter(index=recorder)
+        updates_by_json = collections.OrderedDict()
+        states = {}
+        for cdf in cdfs:
+            logger.debug(cdf.get_file_name())
+            if cdf.get_is_video():
+                base_dir = os.path.join(videos_destdir, cur_id)
+            else:
+                base_dir = os.path.join(images_destdir, cur_id)
+                jsonfile = os.path.join(base_dir, cur_id + dbutil.JSON_SUFFIX)
+                if not os.path.isfile(jsonfile):
+                    logger.error(str(cdf.get_file_name()) +
+                                 ' was guessed to be image, '
+                                 'but this is wrong'
+                                 'going with video')
+                    base_dir = os.path.join(videos_destdir, cur_id)
+
+            if theargs.onlycheckzipfiles is True:
+                _check_zip_files(cdf, base_dir)
+                continue
 
-            if entry.get_file_name() == cdf.get_file_name():
-                logger.info('Updating ' + cdf.get_file_name())
-                if isinstance(newcdfs, list):
-                    logger.debug('Extending list')
-                    newcdf_list.extend(newcdfs)
-                else:
-                    logger.debug('Appending to list')
-                    newcdf_list.append(newcdfs)
+            jsonfile = os.path.join(base_dir, cur_id + dbutil.JSON_SUFFIX)
+            state = states.get(jsonfile)
+            if state is None:
+                state = CILDataFileConvertState(base_dir, cur_id)
+                states[jsonfile] = state
+            if theargs.ignorestate is False and state.is_done(jsonfile):
+                logger.debug('Skipping... ' + cur_id +
+                             ' already converted')
                 continue
-            newcdf_list.append(entry)
 
-        writer.writeCILDataFileListToFile(jsonfile, newcdf_list,
-                                          skipsuffixappend=True)
+            if theargs.skipifrawmissing is True:
+                raw = os.path.join(base_dir, cur_id + dbutil.RAW_SUFFIX)
+                step, step_cdfs = state.get_step(cdf.get_file_name())
+                if step is None and not os.path.isfile(raw):
+                    logger.debug('Skipping... ' + cur_id +
+                                 ' no raw file found')
+                    continue
+
+            if jsonfile not in updates_by_json:
+                updates_by_json[jsonfile] = {}
+            updates_by_json[jsonfile][cdf.get_file_name()] = \
+                converter.convert(cdf, base_dir, state=state)
+            num_converted += 1
+
+        for jsonfile, updates in updates_by_json.items():
+            dbutil.update_cildatafiles_in_json(
+                jsonfile, updates, reader, writer,
+                backup_keep=theargs.keepbackups,
+                backup_keep_since=_get_keep_since(theargs))
+            states[jsonfile].set_done(jsonfile)
+    except Exception as e:
+        logger.exception('Caught exception converting ' + cur_id)
+        return cur_id, num_converted, recorder.get_updates(), str(e)
+    return cur_id, num_converted, recorder.get_updates(), None
+
+
+def _get_convert_results(theargs, id_groups, images_destdir,
+                         videos_destdir):
+    """Generator that converts each id in `id_groups` using a process
+       pool if more then one worker was requested. `id_groups` is only
+       consumed on the calling thread, in batches of CONVERT_BATCH_SIZE
+    :returns: results of _convert_cildatafiles_of_id()
+    """
+    convert_func = partial(_convert_cildatafiles_of_id, theargs,
+                           images_destdir, videos_destdir)
+    if theargs.workers <= 1:
+        for id_and_cdfs in id_groups:
+            yield convert_func(id_and_cdfs)
+        return
 
+    id_groups = iter(id_groups)
+    pool = multiprocessing.Pool(theargs.workers)
+    try:
+        while True:
+            batch = list(itertools.islice(id_groups, CONVERT_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            for res in pool.imap_unordered(convert_func, batch):
+                yield res
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _convert_cildatafiles(theargs, filt_cdf, index,
+                          images_destdir, videos_destdir):
+    """Converts CILDataFile objects in `filt_cdf` grouped by id so
+       the json file for each id is updated once. Updates to
+       `index` are made in this process as ids finish converting
+    :returns: 0 if all ids were converted otherwise 1
+    """
+    num_ids = 0
+    num_converted = 0
+    failed_ids = []
+    start_time = time.time()
+    id_groups = _get_cildatafiles_by_id(theargs, filt_cdf)
+    for cur_id, num, index_updates, error in \
+            _get_convert_results(theargs, id_groups, images_destdir,
+                                 videos_destdir):
+        num_ids += 1
+        num_converted += num
+        if index is not None:
+            for jsonfile, cdf_dict_list in index_updates:
+                index.update_json_file(jsonfile, cdf_dict_list)
+        if error is not None:
+            logger.error('Unable to convert ' + cur_id + ' : ' + error)
+            failed_ids.append(cur_id)
+        if num_ids % PROGRESS_INTERVAL == 0:
+            logger.info('Processed ' + str(num_ids) + ' ids in ' +
+                        '{:.1f}'.format(time.time() - start_time) +
+                        ' seconds')
+
+    logger.info('Converted ' + str(num_converted) + ' entries in ' +
+                str(num_ids) + ' ids in ' +
+                '{:.1f}'.format(time.time() - start_time) + ' seconds. ' +
+                str(len(failed_ids)) + ' ids failed')
+    if len(failed_ids) > 0:
+        logger.error('Conversion failed for ids: ' +
+                     ', '.join(sorted(failed_ids)))
+        return 1
     return 0
 
 
@@ -203,10 +430,28 @@ def main(args):
               file sizes, and mime_types as determined by headers
               when downloading and/or by file extension.
 
+              RESUMING:
+
+              Progress converting each id is recorded in
+              <ID>{state_suffix} next to <ID>.json. If this script is
+              interrupted, running it again resumes each entry from the
+              last step finished. Ids whose <ID>.json has not changed
+              since they were converted are skipped unless --ignorestate
+              is set.
+
+              BACKUPS:
+
+              Before a json file is updated a backup named
+              <ID>.json.bk.<NUMBER> is made. Use --keepbackups and/or
+              --keepbackupsdays to limit the number of backups kept and
+              --compactbackups to apply those limits to existing backups
+              without converting anything.
+
               For more information visit:
 
               https://github.com/CRBS/cildata_util/wiki
-    """.format(version=cildata_util.__version__)
+    """.format(version=cildata_util.__version__,
+               state_suffix=dbutil.CONVERT_STATE_SUFFIX)
 
     theargs = _parse_arguments(desc, args[1:])
     theargs.program = args[0]
@@ -214,10 +459,16 @@ def main(args):
     config.setup_logging(logger, loglevel=theargs.loglevel)
 
     try:
+        if theargs.compactbackups is True:
+            return _compact_backups(theargs)
+        dbutil.set_checksum_cache(dbutil.open_checksum_cache(
+            theargs.checksumcache, use_xattr=theargs.checksumxattr))
         return _convert_data(theargs)
     except Exception:
         logger.exception('Caught fatal exception')
         return 1
+    finally:
+        dbutil.close_checksum_cache()
 
 
 if __name__ == '__main__':  # pragma: no cover
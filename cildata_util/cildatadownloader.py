@@ -5,21 +5,24 @@ import argparse
 import sys
 import logging
 import os
+import collections
 import cildata_util
 from cildata_util import config
 from cildata_util import dbutil
 from cildata_util.config import CILDatabaseConfig
 from cildata_util.dbutil import Database
 from cildata_util.dbutil import CILDataFileFromDatabaseFactory
-from cildata_util.dbutil import CILDataFileJsonPickleWriter
+from cildata_util.dbutil import CILDataFileJsonWriter
 from cildata_util.dbutil import CILDataFileFoundInFilesystemFilter
 from cildata_util.dbutil import CILDataFileNoRawFilter
 from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
 from cildata_util.dbutil import CILDataFileFailedDownloadFilter
-from cildata_util.dbutil import CILDataFileListFromJsonPickleFactory
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
 
 logger = logging.getLogger('cildata_util.cildatadownloader')
 
+ALL_HEADERS = 'all'
+
 
 def _parse_arguments(desc, args):
     """Parses command line arguments
@@ -39,6 +42,12 @@ def _parse_arguments(desc, args):
     parser.add_argument('--skipifexists', action='store_true',
                         help='Skip download if directory for id exists '
                              'on filesystem')
+    parser.add_argument('--expectedfiles',
+                        help='Comma delimited list of files that must exist '
+                             'in directory for id for --skipifexists to '
+                             'skip the download. {id} and {file_name} are '
+                             'replaced with the id and file name of each '
+                             'entry. ie {id}.json,{file_name}')
     parser.add_argument('--skipifprocessedtimeset', action='store_true',
                         help='Only download entries whose processed_time in '
                              'database is null')
@@ -54,12 +63,61 @@ def _parse_arguments(desc, args):
     parser.add_argument('--timeout', type=int, default=120,
                         help='Number of seconds to wait for response'
                              ' from http when downloading a file')
-
+    parser.add_argument('--headerwhitelist',
+                        default=','.join(dbutil.DEFAULT_HEADER_WHITELIST),
+                        help='Comma delimited list of http response headers'
+                             ' to store in json file. Set to ' +
+                             ALL_HEADERS + ' to store all headers. (default '
+                             + ','.join(dbutil.DEFAULT_HEADER_WHITELIST) +
+                             ')')
+
+    parser.add_argument('--select', help=dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read json '
+                             'files in download directory (default 1)')
+    parser.add_argument('--scancache',
+                        help='Path to scan cache file, created if needed, '
+                             'used to skip parsing json files that have not '
+                             'changed since the last run. For example ' +
+                             dbutil.SCAN_CACHE_FILE)
+    parser.add_argument('--checksumcache',
+                        help='Path to checksum cache file, created if '
+                             'needed, used to skip computing md5 of files '
+                             'that have not changed since their md5 was '
+                             'last computed. For example ' +
+                             dbutil.CHECKSUM_CACHE_FILE)
+    parser.add_argument('--checksumxattr', action='store_true',
+                        help='If set, also cache md5 of files in user '
+                             'extended attributes of the files')
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + cildata_util.__version__))
     return parser.parse_args(args)
 
 
+def _get_header_whitelist(theargs):
+    """Gets header whitelist from --headerwhitelist argument
+    :returns: list of header names or None if all headers should be kept
+    """
+    if theargs.headerwhitelist is None:
+        return dbutil.DEFAULT_HEADER_WHITELIST
+    if theargs.headerwhitelist.strip().lower() == ALL_HEADERS:
+        return None
+    return [h.strip() for h in theargs.headerwhitelist.split(',')
+            if h.strip() != '']
+
+
+def _get_expected_files(theargs):
+    """Gets expected files from --expectedfiles argument
+    :returns: list of file names or None if not set
+    """
+    if theargs.expectedfiles is None:
+        return None
+    return [f.strip() for f in theargs.expectedfiles.split(',')
+            if f.strip() != '']
+
+
 def _retry_download_of_failed(theargs):
     """Examine all downloaded data and retry any
        failed entries
@@ -67,59 +125,78 @@ def _retry_download_of_failed(theargs):
     abs_destdir = os.path.abspath(theargs.destdir)
     images_destdir = os.path.join(abs_destdir, dbutil.IMAGES_DIR)
     videos_destdir = os.path.join(abs_destdir, dbutil.VIDEOS_DIR)
-    fac = CILDataFileFromJsonFilesFactory()
-    all_cdf = fac.get_cildatafiles(abs_destdir)
+    scan_cache = dbutil.get_scan_cache(theargs.scancache)
+    fac = CILDataFileFromJsonFilesFactory(id=theargs.id,
+                                          use_index=not theargs.noindex,
+                                          discovery_threads=theargs.workers,
+                                          workers=theargs.workers,
+                                          scan_cache=scan_cache,
+                                          predicate=dbutil.compile_select(
+                                              theargs.select))
+    try:
+        all_cdf = fac.get_cildatafiles(abs_destdir)
+    finally:
+        if scan_cache is not None:
+            scan_cache.close()
 
     logger.info('Total entries: ' + str(len(all_cdf)))
 
-    filter = CILDataFileFailedDownloadFilter()
-    failfilt_cdf = filter.get_cildatafiles(all_cdf)
-    no_rawfilt = CILDataFileNoRawFilter()
-    filt_cdf = no_rawfilt.get_cildatafiles(failfilt_cdf)
+    cdf_filter = CILDataFileFailedDownloadFilter() & CILDataFileNoRawFilter()
+    filt_cdf = cdf_filter.get_cildatafiles(all_cdf)
     logger.info('Failed entries: ' + str(len(filt_cdf)))
 
-    reader = CILDataFileListFromJsonPickleFactory()
-    writer = CILDataFileJsonPickleWriter()
+    header_whitelist = _get_header_whitelist(theargs)
+    reader = CILDataFileListFromJsonFactory()
+    index = dbutil.get_catalog_index(abs_destdir)
+    writer = CILDataFileJsonWriter(header_whitelist=header_whitelist,
+                                   index=index)
+    try:
+        _retry_download_of_cildatafiles(theargs, filt_cdf, reader, writer,
+                                        images_destdir, videos_destdir,
+                                        header_whitelist)
+    finally:
+        if index is not None:
+            index.close()
+    return 0
+
 
-    for cdf in filt_cdf:
+def _retry_download_of_cildatafiles(theargs, filt_cdf, reader, writer,
+                                    images_destdir, videos_destdir,
+                                    header_whitelist):
+    """Retries download of CILDataFile objects in `filt_cdf` grouped
+       by id so the json file for each id is updated once
+    """
+    for cur_id, cdfs in dbutil.group_cildatafiles_by_id(filt_cdf):
         if theargs.id is not None:
-            if theargs.id != str(cdf.get_id()):
-                continue
-
-        if cdf.get_is_video():
-            base_dir = os.path.join(videos_destdir, str(cdf.get_id()))
-        else:
-            base_dir = os.path.join(images_destdir, str(cdf.get_id()))
-
-        destfile = os.path.join(base_dir, cdf.get_file_name())
-        if os.path.isfile(destfile):
-            logger.info(destfile + ' exists. Removing...')
-            os.remove(destfile)
-        newcdf = dbutil.download_cil_data_file(base_dir, cdf,
-                                               loadbaseurl=True,
-                                               download_direct_to_dest=True,
-                                               numretries=theargs.numretries,
-                                               retry_sleep=theargs.retrysleep,
-                                               timeout=theargs.timeout)
-        jsonfile = os.path.join(base_dir, str(cdf.get_id()) + dbutil.JSON_SUFFIX)
-
-        logger.debug('Making backup of ' + jsonfile)
-        dbutil.make_backup_of_json(jsonfile)
-
-        cdf_list = reader.get_cildatafiles(jsonfile)
-
-        newcdf_list = []
-        for entry in cdf_list:
-            if entry.get_file_name() == newcdf.get_file_name():
-                logger.info('Updating ' + newcdf.get_file_name())
-                newcdf_list.append(newcdf)
+            if theargs.id != cur_id:
                 continue
-            newcdf_list.append(entry)
 
-        writer.writeCILDataFileListToFile(jsonfile, newcdf_list,
-                                          skipsuffixappend=True)
-
-    return 0
+        updates_by_json = collections.OrderedDict()
+        for cdf in cdfs:
+            if cdf.get_is_video():
+                base_dir = os.path.join(videos_destdir, cur_id)
+            else:
+                base_dir = os.path.join(images_destdir, cur_id)
+
+            destfile = os.path.join(base_dir, cdf.get_file_name())
+            if os.path.isfile(destfile):
+                logger.info(destfile + ' exists. Removing...')
+                os.remove(destfile)
+            newcdf = dbutil.download_cil_data_file(
+                base_dir, cdf, loadbaseurl=True,
+                download_direct_to_dest=True,
+                numretries=theargs.numretries,
+                retry_sleep=theargs.retrysleep,
+                timeout=theargs.timeout,
+                header_whitelist=header_whitelist)
+            jsonfile = os.path.join(base_dir, cur_id + dbutil.JSON_SUFFIX)
+            if jsonfile not in updates_by_json:
+                updates_by_json[jsonfile] = {}
+            updates_by_json[jsonfile][newcdf.get_file_name()] = newcdf
+
+        for jsonfile, updates in updates_by_json.items():
+            dbutil.update_cildatafiles_in_json(jsonfile, updates,
+                                               reader, writer)
 
 
 def _download_cil_data_files(theargs):
@@ -135,7 +212,10 @@ def _download_cil_data_files(theargs):
     last_id = -1
     last_outdir = None
     same_id_cdf_list = []
-    writer = CILDataFileJsonPickleWriter()
+    header_whitelist = _get_header_whitelist(theargs)
+    index = dbutil.get_catalog_index(abs_destdir)
+    writer = CILDataFileJsonWriter(header_whitelist=header_whitelist,
+                                   index=index)
     try:
 
         conn = db.get_connection()
@@ -145,20 +225,19 @@ def _download_cil_data_files(theargs):
         cildatafiles = fac.get_cildatafiles()
         logger.info('Found ' + str(len(cildatafiles)) + ' entries')
 
-        noraw_filt = CILDataFileNoRawFilter()
-        cildatafiles = noraw_filt.get_cildatafiles(cildatafiles)
-        logger.info('Skipped raw without download count: ' +
-                    str(len(cildatafiles)))
-
+        cdf_filter = CILDataFileNoRawFilter()
+        select = dbutil.compile_select(theargs.select)
+        if select is not None:
+            cdf_filter = select & cdf_filter
         if theargs.skipifexists:
             logger.info("--skipifexists set to true. Skipping download if"
                         " id exists on filesystem")
-            fs_cdf_filter = CILDataFileFoundInFilesystemFilter(images_destdir,
-                                                               videos_destdir)
-            filt_list = fs_cdf_filter.get_cildatafiles(cildatafiles)
-            logger.info('After filtering found ' + str(len(filt_list)) +
-                        ' entries')
-            cildatafiles = filt_list
+            cdf_filter = cdf_filter & CILDataFileFoundInFilesystemFilter(
+                images_destdir, videos_destdir,
+                expected_files=_get_expected_files(theargs))
+        cildatafiles = cdf_filter.get_cildatafiles(cildatafiles)
+        logger.info('After filtering found ' + str(len(cildatafiles)) +
+                    ' entries')
 
         for entry in cildatafiles:
 
@@ -185,7 +264,9 @@ def _download_cil_data_files(theargs):
                                                 loadbaseurl=loadbaseurl,
                                                 numretries=theargs.numretries,
                                                 retry_sleep=theargs.retrysleep,
-                                                timeout=theargs.timeout)
+                                                timeout=theargs.timeout,
+                                                header_whitelist=
+                                                header_whitelist)
             same_id_cdf_list.append(cdf)
 
         if len(same_id_cdf_list) > 0:
@@ -196,6 +277,8 @@ def _download_cil_data_files(theargs):
     finally:
         if conn is not None:
             conn.close()
+        if index is not None:
+            index.close()
 
     return 0
 
@@ -278,6 +361,8 @@ def main(args):
     config.setup_logging(logger, loglevel=theargs.loglevel)
 
     try:
+        dbutil.set_checksum_cache(dbutil.open_checksum_cache(
+            theargs.checksumcache, use_xattr=theargs.checksumxattr))
         if theargs.retryfailed is True:
             return _retry_download_of_failed(theargs)
 
@@ -285,6 +370,8 @@ def main(args):
     except Exception:
         logger.exception('Caught fatal exception')
         return 1
+    finally:
+        dbutil.close_checksum_cache()
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+
+
+import argparse
+import sys
+import logging
+import os
+import time
+import multiprocessing
+from functools import partial
+
+import cildata_util
+from cildata_util import config
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
+
+logger = logging.getLogger('cildata_util.cildatamigrate')
+
+# number of json files between progress log messages
+PROGRESS_INTERVAL = 10000
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments
+    """
+    help_formatter = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_formatter)
+
+    parser.add_argument("downloaddir", help='Download directory')
+    parser.add_argument("--log", dest="loglevel", choices=['DEBUG',
+                        'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="Set the logging level (default WARNING)",
+                        default='WARNING')
+    parser.add_argument('--id', help='Only migrate json file of id '
+                                     'passed in.')
+    parser.add_argument('--keeplegacy', action='store_true',
+                        help='If set, leave legacy json files untouched '
+                             'by keeping them as <ID>.json' +
+                             dbutil.LEGACY_SUFFIX + ' for rollback')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to migrate json '
+                             'files (default 1)')
+    parser.add_argument('--chunksize', type=int, default=64,
+                        help='Number of json files sent to a worker '
+                             'process at a time (default 64)')
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' + cildata_util.__version__))
+    return parser.parse_args(args)
+
+
+def _get_migrate_results(theargs, json_files):
+    """Generator that migrates `json_files` using a process pool
+       if more then one worker was requested
+    :returns: results of dbutil.migrate_json_file()
+    """
+    migrate_func = partial(dbutil.migrate_json_file,
+                           keep_legacy=theargs.keeplegacy)
+    if theargs.workers <= 1:
+        for jsonfile in json_files:
+            yield migrate_func(jsonfile)
+        return
+
+    pool = multiprocessing.Pool(theargs.workers)
+    try:
+        for res in pool.imap_unordered(migrate_func, json_files,
+                                       chunksize=theargs.chunksize):
+            yield res
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _get_throughput(count, num_bytes, duration):
+    """Gets human readable throughput
+    """
+    if duration <= 0:
+        duration = 0.000001
+    return ('{:.1f} files/sec, {:.2f} MB/sec'.format(
+        count / duration, num_bytes / duration / 1048576.0))
+
+
+def _migrate_json_files(theargs):
+    """Migrates json files in download directory
+    """
+    fac = CILDataFileFromJsonFilesFactory(id=theargs.id,
+                                          discovery_threads=theargs.workers)
+    json_files = fac.get_json_files(os.path.abspath(theargs.downloaddir))
+
+    counts = {dbutil.MIGRATE_MIGRATED: 0,
+              dbutil.MIGRATE_SKIPPED: 0,
+              dbutil.MIGRATE_FAILED: 0}
+    num_bytes = 0
+    start_time = time.time()
+    for jsonfile, status, size, message in _get_migrate_results(theargs,
+                                                                json_files):
+        counts[status] += 1
+        num_bytes += size
+        if status == dbutil.MIGRATE_FAILED:
+            logger.error('Unable to migrate ' + jsonfile + ' : ' +
+                         str(message))
+        total = sum(counts.values())
+        if total % PROGRESS_INTERVAL == 0:
+            logger.info('Processed ' + str(total) + ' json files ' +
+                        _get_throughput(total, num_bytes,
+                                        time.time() - start_time))
+
+    duration = time.time() - start_time
+    total = sum(counts.values())
+    sys.stdout.write('Migrated: ' + str(counts[dbutil.MIGRATE_MIGRATED]) +
+                     '\n')
+    sys.stdout.write('Skipped (already migrated): ' +
+                     str(counts[dbutil.MIGRATE_SKIPPED]) + '\n')
+    sys.stdout.write('Failed: ' + str(counts[dbutil.MIGRATE_FAILED]) + '\n')
+    sys.stdout.write('Processed ' + str(total) + ' json files in ' +
+                     '{:.1f}'.format(duration) + ' seconds (' +
+                     _get_throughput(total, num_bytes, duration) + ')\n')
+    if counts[dbutil.MIGRATE_FAILED] > 0:
+        return 1
+    return 0
+
+
+def main(args):
+    """Main entry into cildatamigrate
+    :param args: should be set to sys.argv aka the list of arguments
+                 starting with script name as first argument
+    :returns: exit code of 0 upon success otherwise failure
+    """
+
+    desc = """
+              Version {version}
+
+              Given a directory of images and videos downloaded by
+              cildatadownloader.py, this script rewrites every legacy
+              <ID>.json file written with jsonpickle in the versioned
+              json format written by the current cildata tools.
+
+              Each json file is read back after conversion and every
+              field of every entry is compared with the legacy file
+              before the legacy file is atomically replaced. Json files
+              that fail the comparison are left untouched and reported.
+
+              Json files already in the new format are skipped so this
+              script can be rerun if interrupted.
+
+              If --keeplegacy is set the legacy json file is kept as
+              <ID>.json{legacy} for rollback.
+    """.format(version=cildata_util.__version__,
+               legacy=dbutil.LEGACY_SUFFIX)
+
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = cildata_util.__version__
+    config.setup_logging(logger, loglevel=theargs.loglevel)
+
+    try:
+        return _migrate_json_files(theargs)
+    except Exception:
+        logger.exception('Caught fatal exception')
+        return 1
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -5,10 +5,17 @@ import argparse
 import sys
 import logging
 import os
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
 import cildata_util
 from cildata_util import config
+from cildata_util import dbutil
 from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
 from cildata_util.dbutil import CILDataFileNoRawFilter
+from cildata_util.dbutil import CILDataFileTable
+from cildata_util.dbutil import CILDataFileCatalogIndex
+from cildata_util.dbutil import CILDataFileCatalog
 
 logger = logging.getLogger('cildata_util.cildatareport')
 
@@ -28,66 +35,203 @@ def _parse_arguments(desc, args):
     parser.add_argument("--printfailed", action='store_true',
                         help='If set output file names of files that'
                              'failed to download')
+    parser.add_argument('--rebuildindex', action='store_true',
+                        help='If set, (re)builds the catalog index file ' +
+                             dbutil.CATALOG_INDEX_FILE + ' in download '
+                             'directory from the json files before '
+                             'generating the report. Once built, the '
+                             'cildata tools read the index instead of '
+                             'the json files and keep it up to date.')
+    parser.add_argument('--catalog',
+                        help='If set, read entries from this binary catalog '
+                             'file written by --exportcatalog instead of '
+                             'the json files in download directory')
+    parser.add_argument('--exportcatalog',
+                        help='If set, write all entries to this binary '
+                             'catalog file which can be passed to '
+                             '--catalog on later runs')
+    parser.add_argument('--sniff', action='store_true',
+                        help='If set, read the first ' +
+                             str(dbutil.SNIFF_SIZE) + ' bytes of each '
+                             'downloaded file and report counts by type '
+                             'found along with entries whose contents do '
+                             'not match their suffix, such as HTML error '
+                             'pages. Use --printfailed to list them')
+    parser.add_argument('--select', help=dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read json '
+                             'files in download directory (default 1)')
+    parser.add_argument('--scancache',
+                        help='Path to scan cache file, created if needed, '
+                             'used to skip parsing json files that have not '
+                             'changed since the last run. For example ' +
+                             dbutil.SCAN_CACHE_FILE)
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + cildata_util.__version__))
     return parser.parse_args(args)
 
 
+def _rebuild_index(download_dir):
+    """Rebuilds catalog index in `download_dir`
+    """
+    index = CILDataFileCatalogIndex(os.path.join(download_dir,
+                                                 dbutil.CATALOG_INDEX_FILE))
+    try:
+        count = index.rebuild(download_dir)
+    finally:
+        index.close()
+    logger.info('Added ' + str(count) + ' entries to catalog index')
+
+
+def _get_table_from_json_files(theargs, download_dir):
+    """Gets CILDataFileTable of entries in json files
+       in `download_dir`
+    """
+    if theargs.rebuildindex is True:
+        _rebuild_index(download_dir)
+    scan_cache = dbutil.get_scan_cache(theargs.scancache)
+    factory = CILDataFileFromJsonFilesFactory(
+        use_index=not theargs.noindex,
+        discovery_threads=theargs.workers, workers=theargs.workers,
+        scan_cache=scan_cache,
+        predicate=dbutil.compile_select(theargs.select))
+    try:
+        return CILDataFileTable.from_cildatafiles(
+            factory.iter_cildatafiles(download_dir))
+    finally:
+        if scan_cache is not None:
+            scan_cache.close()
+
+
 def _generate_report(theargs):
     download_dir = os.path.abspath(theargs.downloaddir)
-    factory = CILDataFileFromJsonFilesFactory()
-    counter = 0
-    mimetypes = {}
-    failed_count = 0
-    failed_list = []
-    failed_id_hash = {}
-    unique_ids = {}
-    not_supposed_to_have_raw = 0
+    if theargs.catalog is not None:
+        catalog = CILDataFileCatalog(theargs.catalog)
+        try:
+            cdf_table = catalog.get_table()
+            select = dbutil.compile_select(theargs.select)
+            if select is not None:
+                cdf_table = cdf_table.filter(select.get_mask(cdf_table))
+            return _write_report(theargs, cdf_table)
+        finally:
+            catalog.close()
+
+    cdf_table = _get_table_from_json_files(theargs, download_dir)
+    if theargs.exportcatalog is not None:
+        count = CILDataFileCatalog.write(theargs.exportcatalog, cdf_table)
+        logger.info('Wrote ' + str(count) + ' entries to ' +
+                    theargs.exportcatalog)
+    return _write_report(theargs, cdf_table)
+
+
+def _get_data_file(download_dir, cur_id, file_name, is_video):
+    """Gets path to data file of entry
+    :returns: path under images or videos directory, falling back to
+              <ID> directory directly in `download_dir`
+    """
+    if is_video:
+        data_dir = dbutil.VIDEOS_DIR
+    else:
+        data_dir = dbutil.IMAGES_DIR
+    data_file = os.path.join(download_dir, data_dir, str(cur_id),
+                             str(file_name))
+    if os.path.isfile(data_file):
+        return data_file
+    return os.path.join(download_dir, str(cur_id), str(file_name))
+
+
+def _sniff_data_file(args):
+    """Sniffs file type of data file
+    :param args: tuple (data file, is video)
+    :returns: tuple (data file, file type or None, True if contents
+              match suffix otherwise False)
+    """
+    data_file, is_video = args
+    if not os.path.isfile(data_file):
+        return data_file, None, True
+    file_type = dbutil.sniff_file_type(data_file)
+    if file_type is None:
+        return data_file, None, True
+    if file_type == dbutil.FILE_TYPE_HTML:
+        return data_file, file_type, False
+    if data_file.endswith(dbutil.RAW_SUFFIX):
+        if is_video:
+            expected = file_type in dbutil.VIDEO_FILE_TYPES
+        else:
+            expected = file_type == dbutil.FILE_TYPE_ZIP
+        return data_file, file_type, expected
+    suffix_type = dbutil.get_file_type_from_suffix(data_file)
+    return data_file, file_type, suffix_type in (None, file_type)
+
+
+def _write_sniff_report(theargs, cdf_table, download_dir):
+    """Sniffs data file of each entry in `cdf_table` writing counts by
+       file type and entries whose contents do not match their suffix
+       to standard out
+    """
+    args = [(_get_data_file(download_dir, cur_id, file_name, is_video),
+             is_video) for cur_id, file_name, is_video in
+            zip(cdf_table.get_ids(), cdf_table.get_file_names(),
+                cdf_table.get_is_video_mask(True))]
+    type_counts = collections.Counter()
+    mismatched = []
+    pool = ThreadPool(max(1, theargs.workers))
+    try:
+        for data_file, file_type, matches in pool.imap(_sniff_data_file,
+                                                       args,
+                                                       chunksize=64):
+            if not os.path.isfile(data_file):
+                type_counts['missing'] += 1
+                continue
+            type_counts[str(file_type)] += 1
+            if matches is False:
+                mismatched.append((data_file, file_type))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    sys.stdout.write('-----------------\n')
+    sys.stdout.write('File types found by examining contents:\n')
+    for file_type in sorted(type_counts.keys()):
+        sys.stdout.write('\t' + file_type + ' ==> ' +
+                         str(type_counts[file_type]) + '\n')
+    sys.stdout.write('Number entries whose contents do not match suffix: ' +
+                     str(len(mismatched)) + '\n')
+    if theargs.printfailed is True:
+        for data_file, file_type in mismatched:
+            sys.stdout.write('\t' + data_file + ' ==> ' + file_type + '\n')
+
+
+def _write_report(theargs, cdf_table):
+    """Writes report for entries in `cdf_table` to standard out
+    """
     noraw_filt = CILDataFileNoRawFilter()
-    cdf_list = factory.get_cildatafiles(download_dir)
-    logger.info('Unfiltered list count: ' + str(len(cdf_list)))
+    logger.info('Unfiltered list count: ' + str(len(cdf_table)))
 
-    filt_cdf_list = noraw_filt.get_cildatafiles(cdf_list)
+    filt_cdf_table = noraw_filt.get_cildatafiles(cdf_table)
     logger.info('Skipped raw without download count: ' +
-                str(len(filt_cdf_list)))
-    not_supposed_to_have_raw = len(cdf_list) - len(filt_cdf_list)
+                str(len(filt_cdf_table)))
+    not_supposed_to_have_raw = len(cdf_table) - len(filt_cdf_table)
 
-    if theargs.printfailed is True:
-        sys.stdout.write('Failed\n')
-    for cdf in filt_cdf_list:
-        unique_ids[cdf.get_id()] = 1
-        counter += 1
-        if cdf.get_download_success() is False:
-            failed_id_hash[cdf.get_id()] = True
-            if theargs.printfailed is True:
-                sys.stdout.write(cdf.get_file_name() + '\n')
-            failed_count += 1
-            failed_list.append(cdf)
-        else:
-            if cdf.get_file_size() is 0:
-                failed_id_hash[cdf.get_id()] = True
-                if theargs.printfailed is True:
-                    sys.stdout.write(cdf.get_file_name() + '\n')
-                failed_count += 1
-                failed_list.append(cdf)
-            else:
-                if cdf.get_mime_type() is None:
-                    logger.debug(cdf.get_file_name() + 'mime type is None')
-                else:
-                    if cdf.get_mime_type().startswith('text'):
-                        logger.debug('Success, but type is text: ' +
-                                     cdf.get_file_name())
-
-        if cdf.get_mime_type() not in mimetypes:
-            mimetypes[cdf.get_mime_type()] = 1
-        else:
-            mimetypes[cdf.get_mime_type()] += 1
+    # a file failed if download was not successful or the file is empty
+    failed_mask = CILDataFileTable.mask_or(
+        filt_cdf_table.get_download_success_mask(False),
+        filt_cdf_table.get_file_size_mask(0))
+    failed_count = sum(failed_mask)
 
     if theargs.printfailed is True:
+        sys.stdout.write('Failed\n')
+        for file_name in itertools.compress(filt_cdf_table.get_file_names(),
+                                            failed_mask):
+            sys.stdout.write(str(file_name) + '\n')
         sys.stdout.write('-----------\n')
 
-    num_unique_ids = len(unique_ids.keys())
-    num_failed_ids = len(failed_id_hash.keys())
+    counter = len(filt_cdf_table)
+    num_unique_ids = len(filt_cdf_table.get_unique_ids())
+    num_failed_ids = len(filt_cdf_table.get_unique_ids(mask=failed_mask))
+    mimetypes = filt_cdf_table.count_by_mime_type()
     sys.stdout.write('\n')
     sys.stdout.write('Number entries: ' + str(counter) +
                      ' (failed: ' + str(failed_count) + ')\n')
@@ -101,6 +245,9 @@ def _generate_report(theargs):
     for entry in mimetypes.keys():
         sys.stdout.write('\t' + str(entry) + ' ==> ' +
                          str(mimetypes[entry]) + '\n')
+    if theargs.sniff is True:
+        _write_sniff_report(theargs, filt_cdf_table,
+                            os.path.abspath(theargs.downloaddir))
     return 0
 
 
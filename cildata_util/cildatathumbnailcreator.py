@@ -51,6 +51,12 @@ def _parse_arguments(desc, args):
     parser.add_argument('--overwrite', action='store_true',
                         help='NOT IMPLEMENTED. If set overwrites any existing thumbnails. '
                              'Otherwise existing thumbnails are skipped.')
+    parser.add_argument('--select',
+                        help='Only create thumbnails for ids with json '
+                             'entries matching this expression. ' +
+                             dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + cildata_util.__version__))
     return parser.parse_args(args)
@@ -153,7 +159,7 @@ def _create_thumbnail_images(image_file, size_list, abs_destdir):
                             thumbprefix + THUMBNAIL_LABEL + str(cursize) +
                             suffix)
         thumby_img = thumby_img.convert("RGB")
-	thumby_img.save(dest)
+        thumby_img.save(dest)
         thumby_img.close()
     im.close()
 
@@ -213,13 +219,17 @@ def _get_list_of_numeric_directories(dir_path):
 def _create_thumbnails_for_entries_in_subdirs(dir_entry,
                                               size_list,
                                               abs_destdir,
-                                              suffix):
+                                              suffix,
+                                              id_set=None):
     """Given a directory this function looks for
     all numeric subdirectories and then for images within
     that have same name as numeric subdirectory with
-    matching suffix. """
+    matching suffix. If `id_set` is set only subdirectories
+    in `id_set` are examined."""
     status = 0
     for entry in _get_list_of_numeric_directories(dir_entry):
+        if id_set is not None and entry not in id_set:
+            continue
         img_file = os.path.join(dir_entry, entry, entry + suffix)
         logger.debug('Looking for file: ' + img_file)
         if not os.path.isfile(img_file):
@@ -232,6 +242,24 @@ def _create_thumbnails_for_entries_in_subdirs(dir_entry,
     return status
 
 
+def _get_selected_ids(download_dir, select, use_index=True):
+    """Gets ids of entries in json files in `download_dir`
+       matching `select` expression
+    :param use_index: if False json files are read even if
+                      `download_dir` has a catalog index
+    :returns: set of ids as strings or None if `select` is None
+    """
+    predicate = dbutil.compile_select(select)
+    if predicate is None:
+        return None
+    fac = dbutil.CILDataFileFromJsonFilesFactory(use_index=use_index,
+                                                 predicate=predicate)
+    id_set = set(str(cdf.get_id()) for cdf in
+                 fac.iter_cildatafiles(download_dir))
+    logger.info('Found ' + str(len(id_set)) + ' ids matching ' + select)
+    return id_set
+
+
 def _create_thumbnails(theargs):
     """Examine all downloaded data and retry any
        failed entries
@@ -250,6 +278,8 @@ def _create_thumbnails(theargs):
         logger.error('Expected a directory, but didnt get one')
         return 1
 
+    id_set = _get_selected_ids(abs_input, theargs.select,
+                               use_index=not theargs.noindex)
     dir_list = [abs_input]
 
     images_dir = os.path.join(abs_input, dbutil.IMAGES_DIR)
@@ -265,7 +295,8 @@ def _create_thumbnails(theargs):
         res = _create_thumbnails_for_entries_in_subdirs(dir_entry,
                                                         size_list,
                                                         abs_destdir,
-                                                        theargs.suffix)
+                                                        theargs.suffix,
+                                                        id_set=id_set)
         if res != 0:
             status = 4
 
@@ -12,7 +12,7 @@ from cildata_util import dbutil
 from cildata_util.config import CILDatabaseConfig
 from cildata_util.dbutil import Database
 from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
-from cildata_util.dbutil import CILDataFileListFromJsonPickleFactory
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
 from cildata_util.dbutil import CILDataFileNoRawFilter
 from cildata_util.dbutil import CILDataFileDatabaseUpdater
 logger = logging.getLogger('cildata_util.cildataupdatedb')
@@ -33,6 +33,17 @@ def _parse_arguments(desc, args):
                         default='WARNING')
     parser.add_argument('--id', help='Only update database on '
                                      'data with id passed in.')
+    parser.add_argument('--select', help=dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read json '
+                             'files in download directory (default 1)')
+    parser.add_argument('--scancache',
+                        help='Path to scan cache file, created if needed, '
+                             'used to skip parsing json files that have not '
+                             'changed since the last run. For example ' +
+                             dbutil.SCAN_CACHE_FILE)
     parser.add_argument('--version', action='version',
                         version=('%(prog)s ' + cildata_util.__version__))
     return parser.parse_args(args)
@@ -45,13 +56,17 @@ def _update_database(theargs):
     abs_destdir = os.path.abspath(theargs.downloaddir)
     images_destdir = os.path.join(abs_destdir, dbutil.IMAGES_DIR)
     videos_destdir = os.path.join(abs_destdir, dbutil.VIDEOS_DIR)
-    fac = CILDataFileFromJsonFilesFactory()
-    all_cdf = fac.get_cildatafiles(abs_destdir)
-
-    logger.info('Total entries: ' + str(len(all_cdf)))
-
+    scan_cache = dbutil.get_scan_cache(theargs.scancache)
+    fac = CILDataFileFromJsonFilesFactory(id=theargs.id,
+                                          use_index=not theargs.noindex,
+                                          discovery_threads=theargs.workers,
+                                          workers=theargs.workers,
+                                          scan_cache=scan_cache,
+                                          predicate=dbutil.compile_select(
+                                              theargs.select))
     nofailedrawfilt = CILDataFileNoRawFilter()
-    filt_cdf = nofailedrawfilt.get_cildatafiles(all_cdf)
+    filt_cdf = nofailedrawfilt.iter_cildatafiles(
+        fac.iter_cildatafiles(abs_destdir))
 
     logger.debug('Reading database config')
     dbconf = CILDatabaseConfig(theargs.databaseconf)
@@ -60,7 +75,7 @@ def _update_database(theargs):
     updater = CILDataFileDatabaseUpdater(conn)
 
     try:
-        reader = CILDataFileListFromJsonPickleFactory()
+        reader = CILDataFileListFromJsonFactory()
 
         for cdf in filt_cdf:
             if theargs.id is not None:
@@ -84,6 +99,8 @@ def _update_database(theargs):
     finally:
         if conn is not None:
             conn.close()
+        if scan_cache is not None:
+            scan_cache.close()
     return 0
 
 
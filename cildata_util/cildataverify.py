@@ -0,0 +1,480 @@
+#! /usr/bin/env python
+
+
+import argparse
+import sys
+import logging
+import os
+import collections
+import random
+import sqlite3
+import time
+import zipfile
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+import cildata_util
+from cildata_util import config
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
+
+logger = logging.getLogger('cildata_util.cildataverify')
+
+# number of files between progress log messages and state commits
+PROGRESS_INTERVAL = 1000
+
+BYTES_PER_MB = 1024 * 1024
+
+VERIFY_OK = 'ok'
+VERIFY_MISSING = 'missing'
+VERIFY_SIZE_MISMATCH = 'size mismatch'
+VERIFY_CHECKSUM_MISMATCH = 'checksum mismatch'
+VERIFY_BAD_ZIP = 'bad zip'
+VERIFY_ERROR = 'error'
+VERIFY_EXTRA = 'extra'
+
+# throttle shared by threads of a worker, set by _init_worker()
+_throttle = None
+
+
+def _parse_arguments(desc, args):
+    """Parses command line arguments
+    """
+    help_formatter = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_formatter)
+    parser.add_argument("downloaddir",
+                        help='Directory where images and videos reside')
+    parser.add_argument("--log", dest="loglevel", choices=['DEBUG',
+                        'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="Set the logging level (default WARNING)",
+                        default='WARNING')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of threads, or processes if '
+                             '--useprocesses is set, used to verify '
+                             'files and read json files (default 1)')
+    parser.add_argument('--useprocesses', action='store_true',
+                        help='If set, verify files with a pool of '
+                             'processes instead of threads')
+    parser.add_argument('--maxmbpersec', type=float,
+                        help='If set, limit rate files are read at to '
+                             'this many megabytes per second across '
+                             'all workers')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--sample', type=float,
+                      help='If set, verify only this fraction, between '
+                           '0 and 1, of entries chosen at random. Extra '
+                           'files are not looked for')
+    mode.add_argument('--statefile',
+                      help='Path to state file, created if needed, '
+                           'recording files verified so far. If this '
+                           'script is interrupted, running it again '
+                           'with the same state file skips files '
+                           'already verified. Removed once all files '
+                           'have been verified')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for random number generator used by '
+                             '--sample')
+    parser.add_argument('--select', help=dbutil.SELECT_HELP)
+    parser.add_argument('--noindex', action='store_true',
+                        help=dbutil.NO_INDEX_HELP)
+    parser.add_argument('--scancache',
+                        help='Path to scan cache file, created if needed, '
+                             'used to skip parsing json files that have not '
+                             'changed since the last run. For example ' +
+                             dbutil.SCAN_CACHE_FILE)
+    parser.add_argument('--version', action='version',
+                        version=('%(prog)s ' + cildata_util.__version__))
+    return parser.parse_args(args)
+
+
+class _VerifyState(object):
+    """SQLite database that records result of verifying each file
+       so an interrupted run can be resumed
+    """
+    def __init__(self, state_file):
+        """Constructor
+        :param state_file: path to sqlite database, created if needed
+        """
+        self._state_file = state_file
+        self._conn = None
+
+    def _get_connection(self):
+        """Gets connection to database creating tables if needed
+        """
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self._state_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS verified '
+                           '(data_file TEXT PRIMARY KEY, '
+                           'status TEXT NOT NULL, '
+                           'detail TEXT)')
+        self._conn.commit()
+        return self._conn
+
+    def get_results(self):
+        """Gets results recorded so far
+        :returns: dict of data file => tuple (status, detail)
+        """
+        res = {}
+        for data_file, status, detail in self._get_connection().execute(
+                'SELECT data_file, status, detail FROM verified'):
+            res[data_file] = (status, detail)
+        return res
+
+    def add_result(self, data_file, status, detail):
+        """Records result for `data_file`, caller must call commit()
+        """
+        self._get_connection().execute(
+            'INSERT OR REPLACE INTO verified (data_file, status, detail) '
+            'VALUES (?, ?, ?)', (data_file, status, detail))
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def remove(self):
+        """Closes and deletes state file
+        """
+        self.close()
+        if os.path.isfile(self._state_file):
+            os.remove(self._state_file)
+
+
+def _init_worker(bytes_per_sec):
+    """Creates throttle shared by threads of this process
+    :param bytes_per_sec: rate limit for this process or None
+    """
+    global _throttle
+    if bytes_per_sec is None:
+        _throttle = None
+    else:
+        _throttle = dbutil.IOThrottle(bytes_per_sec)
+
+
+def _get_data_file(download_dir, cdf):
+    """Gets path to data file of `cdf`
+    :returns: path under images or videos directory, falling back to
+              <ID> directory directly in `download_dir`
+    """
+    file_name = cdf.get_localfile()
+    if file_name is None:
+        file_name = cdf.get_file_name()
+    if cdf.get_is_video():
+        data_dirs = [dbutil.VIDEOS_DIR, dbutil.IMAGES_DIR]
+    else:
+        data_dirs = [dbutil.IMAGES_DIR, dbutil.VIDEOS_DIR]
+    for data_dir in data_dirs:
+        data_file = os.path.join(download_dir, data_dir, str(cdf.get_id()),
+                                 str(file_name))
+        if os.path.isfile(data_file):
+            return data_file
+    fallback = os.path.join(download_dir, str(cdf.get_id()), str(file_name))
+    if os.path.isfile(fallback):
+        return fallback
+    return os.path.join(download_dir, data_dirs[0], str(cdf.get_id()),
+                        str(file_name))
+
+
+def _is_zip_file(data_file, is_video):
+    """Zip files are <ID>.zip files and downloaded image <ID>.raw files
+    """
+    if data_file.endswith(dbutil.ZIP_SUFFIX):
+        return True
+    return data_file.endswith(dbutil.RAW_SUFFIX) and not is_video
+
+
+def _test_zip(data_file):
+    """Like zipfile.ZipFile.testzip() reads every member of `data_file`
+       so its CRC is checked, but honors throttle
+    :returns: None if zip file is valid otherwise error message
+    """
+    try:
+        with zipfile.ZipFile(data_file) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                try:
+                    with zf.open(info) as member:
+                        while member.read(dbutil.STREAM_BLOCK_SIZE):
+                            pass
+                except (zipfile.BadZipfile, zlib.error, EOFError,
+                        NotImplementedError) as e:
+                    return info.filename + ' : ' + str(e)
+                if _throttle is not None:
+                    _throttle.consume(info.compress_size)
+    except zipfile.BadZipfile as e:
+        return str(e)
+    return None
+
+
+def _verify_file(args):
+    """Verifies size, checksum and, for zip files, CRC of each member
+       of data file. Run in worker threads or processes so no
+       exceptions are raised.
+    :param args: tuple (data file, expected size or None, expected md5
+                 or None, True if data file is a zip file)
+    :returns: tuple (data file, one of VERIFY_* status, detail or None)
+    """
+    data_file, size, checksum, is_zip = args
+    try:
+        try:
+            st = os.stat(data_file)
+        except OSError:
+            return data_file, VERIFY_MISSING, None
+        if size is not None and st.st_size != size:
+            return (data_file, VERIFY_SIZE_MISMATCH,
+                    'expected ' + str(size) + ' found ' + str(st.st_size))
+        if checksum is not None:
+            found = dbutil.hash_file(data_file, use_cache=False,
+                                     throttle=_throttle)
+            if found[dbutil.MD5_ALGORITHM] != checksum:
+                return (data_file, VERIFY_CHECKSUM_MISMATCH,
+                        'expected ' + checksum + ' found ' +
+                        found[dbutil.MD5_ALGORITHM])
+        if is_zip:
+            error = _test_zip(data_file)
+            if error is not None:
+                return data_file, VERIFY_BAD_ZIP, error
+    except Exception as e:
+        logger.exception('Caught exception verifying ' + data_file)
+        return data_file, VERIFY_ERROR, str(e)
+    return data_file, VERIFY_OK, None
+
+
+def _get_verify_args(theargs, download_dir):
+    """Gets arguments for _verify_file() for each entry whose download
+       succeeded
+    :returns: OrderedDict of data file => arguments
+    """
+    scan_cache = dbutil.get_scan_cache(theargs.scancache)
+    factory = CILDataFileFromJsonFilesFactory(
+        use_index=not theargs.noindex,
+        discovery_threads=theargs.workers, workers=theargs.workers,
+        scan_cache=scan_cache,
+        predicate=dbutil.compile_select(theargs.select))
+    rng = random.Random(theargs.seed)
+    verify_args = collections.OrderedDict()
+    try:
+        for cdf in factory.iter_cildatafiles(download_dir):
+            if cdf.get_download_success() is not True:
+                continue
+            if theargs.sample is not None and\
+                    rng.random() >= theargs.sample:
+                continue
+            data_file = _get_data_file(download_dir, cdf)
+            verify_args[data_file] = (data_file, cdf.get_file_size(),
+                                      cdf.get_checksum(),
+                                      _is_zip_file(data_file,
+                                                   cdf.get_is_video()))
+    finally:
+        if scan_cache is not None:
+            scan_cache.close()
+    return verify_args
+
+
+def _is_bookkeeping_file(file_name, cur_id):
+    """Json files, their backups and convert state files are
+       not data files
+    """
+    if file_name.startswith(cur_id + dbutil.JSON_SUFFIX):
+        return True
+    return file_name == cur_id + dbutil.CONVERT_STATE_SUFFIX
+
+
+def _get_extra_files(download_dir, data_files):
+    """Gets files in <ID> directories under `download_dir` that are
+       not in `data_files`, skipping json and state files
+    :returns: sorted list of paths
+    """
+    extra = []
+    for sub_dir in [download_dir,
+                    os.path.join(download_dir, dbutil.IMAGES_DIR),
+                    os.path.join(download_dir, dbutil.VIDEOS_DIR)]:
+        try:
+            id_dirs = [e for e in scandir(sub_dir)
+                       if e.is_dir() and e.name.isdigit()]
+        except OSError:
+            continue
+        for id_dir in id_dirs:
+            for entry in scandir(id_dir.path):
+                if not entry.is_file():
+                    continue
+                if _is_bookkeeping_file(entry.name, id_dir.name):
+                    continue
+                if entry.path not in data_files:
+                    extra.append(entry.path)
+    extra.sort()
+    return extra
+
+
+def _get_verify_results(theargs, verify_args):
+    """Generator that verifies each file using a pool of threads
+       or processes
+    :returns: results of _verify_file()
+    """
+    bytes_per_sec = None
+    if theargs.maxmbpersec is not None:
+        bytes_per_sec = theargs.maxmbpersec * BYTES_PER_MB
+    workers = max(1, theargs.workers)
+    if theargs.useprocesses is True and workers > 1:
+        if bytes_per_sec is not None:
+            bytes_per_sec /= workers
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(bytes_per_sec,))
+    else:
+        _init_worker(bytes_per_sec)
+        pool = ThreadPool(workers)
+    try:
+        for res in pool.imap_unordered(_verify_file, verify_args):
+            yield res
+    finally:
+        pool.terminate()
+        pool.join()
+        _init_worker(None)
+
+
+def _verify_data(theargs):
+    """Verifies data files of entries in json files in download
+       directory writing a report to standard out
+    :returns: 0 if no problems were found otherwise 1
+    """
+    download_dir = os.path.abspath(theargs.downloaddir)
+    if theargs.sample is not None and not 0 < theargs.sample <= 1:
+        logger.error('--sample must be greater then 0 and at most 1')
+        return 1
+
+    verify_args = _get_verify_args(theargs, download_dir)
+    logger.info('Found ' + str(len(verify_args)) + ' files to verify')
+
+    state = None
+    results = {}
+    if theargs.statefile is not None:
+        state = _VerifyState(theargs.statefile)
+        results = dict((k, v) for k, v in state.get_results().items()
+                       if k in verify_args)
+        logger.info('Skipping ' + str(len(results)) +
+                    ' files verified on a previous run')
+
+    num_checked = 0
+    start_time = time.time()
+    try:
+        for data_file, status, detail in _get_verify_results(
+                theargs, [a for k, a in verify_args.items()
+                          if k not in results]):
+            results[data_file] = (status, detail)
+            if state is not None:
+                state.add_result(data_file, status, detail)
+            num_checked += 1
+            if num_checked % PROGRESS_INTERVAL == 0:
+                if state is not None:
+                    state.commit()
+                logger.info('Verified ' + str(num_checked) +
+                            ' files in ' +
+                            '{:.1f}'.format(time.time() - start_time) +
+                            ' seconds')
+    finally:
+        if state is not None:
+            state.close()
+
+    if theargs.sample is None and theargs.select is None:
+        for data_file in _get_extra_files(download_dir, verify_args):
+            results[data_file] = (VERIFY_EXTRA, None)
+
+    if state is not None:
+        state.remove()
+    return _write_report(verify_args, results)
+
+
+def _write_report(verify_args, results):
+    """Writes counts by status and each file with a problem
+       to standard out
+    :returns: 0 if no problems were found otherwise 1
+    """
+    status_counts = collections.Counter(status for status, detail
+                                        in results.values())
+    sys.stdout.write('Number files verified: ' + str(len(verify_args)) +
+                     '\n')
+    sys.stdout.write('-----------------\n')
+    for status in sorted(status_counts.keys()):
+        sys.stdout.write('\t' + status + ' ==> ' +
+                         str(status_counts[status]) + '\n')
+
+    problems = sorted((data_file, status, detail) for data_file,
+                      (status, detail) in results.items()
+                      if status != VERIFY_OK)
+    if len(problems) == 0:
+        return 0
+    sys.stdout.write('-----------------\n')
+    for data_file, status, detail in problems:
+        line = status + ' ==> ' + data_file
+        if detail is not None:
+            line += ' (' + detail + ')'
+        sys.stdout.write(line + '\n')
+    return 1
+
+
+def main(args):
+    """Main entry into cildataverify
+    :param args: should be set to sys.argv aka the list of arguments
+                 starting with script name as first argument
+    :returns: exit code of 0 upon success otherwise failure
+    """
+
+    desc = """
+              Version {version}
+
+              Given a directory of images and videos downloaded by
+              cildatadownloader.py, this script verifies the data files
+              still match the sizes and md5 checksums recorded in the
+              json files, or catalog index if present, and that every
+              member of zip files can be read with a valid CRC.
+
+              Files are re-read even if a checksum cache is used
+              by other tools. Use --workers to verify files in parallel
+              and --maxmbpersec to limit the load put on storage.
+
+              A report is written to standard out listing counts by
+              status followed by each file that is missing, whose
+              size or checksum does not match, that is a bad zip file
+              or that is in an <ID> directory, but not referenced by
+              any json file (extra). Extra files are not looked for when
+              --sample or --select is set.
+
+              For periodic audits use --sample to check a random subset
+              of files or --statefile to check all files across
+              interrupted runs.
+
+              Exit code is 0 if no problems were found otherwise 1.
+
+              For more information visit:
+
+              https://github.com/CRBS/cildata_util/wiki
+    """.format(version=cildata_util.__version__)
+
+    theargs = _parse_arguments(desc, args[1:])
+    theargs.program = args[0]
+    theargs.version = cildata_util.__version__
+    config.setup_logging(logger, loglevel=theargs.loglevel)
+
+    try:
+        return _verify_data(theargs)
+    except Exception:
+        logger.exception('Caught fatal exception')
+        return 1
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
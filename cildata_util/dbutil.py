@@ -1,23 +1,82 @@
 import re
+import io
 import os
 import logging
+import sys
+import itertools
+import operator
+import bisect
+import mmap
+import struct
+import collections
+import multiprocessing
+from array import array
 import pg8000
 import jsonpickle
 import json
+import sqlite3
 import hashlib
 import shutil
+import tempfile
 import requests
 import time
+import threading
 import mimetypes
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 from dateutil import parser
 
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+try:
+    from itertools import imap
+except ImportError:
+    imap = map
+
+# Python 2 ints lack from_bytes() used to combine masks in bulk
+_HAS_INT_FROM_BYTES = hasattr(int, 'from_bytes')
+
+
+def _get_array_typecode(candidates, itemsize):
+    """Gets first array typecode in `candidates` whose items are
+       `itemsize` bytes. Python 2 lacks the 'q' and 'Q' typecodes
+       but its 'l' and 'L' are 8 bytes on 64 bit unix
+    :returns: typecode or last of `candidates` if none match
+    """
+    for typecode in candidates:
+        try:
+            if array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            pass
+    return candidates[-1]
+
+
+# array typecodes for signed and unsigned 64 bit ints
+_INT64_TYPECODE = _get_array_typecode(('q', 'l'), 8)
+_UINT64_TYPECODE = _get_array_typecode(('Q', 'L'), 8)
+
+# zipfile can only write to files that cannot seek from Python 3.5 on
+_ZIPFILE_WRITES_UNSEEKABLE = sys.version_info >= (3, 5)
+
+# compresslevel argument of zipfile.ZipFile.write() was added in 3.7
+_ZIPFILE_HAS_COMPRESSLEVEL = sys.version_info >= (3, 7)
+
+# zlib.compressobj() takes a zdict to prime the compressor from 3.3 on
+_ZLIB_HAS_ZDICT = sys.version_info >= (3, 3)
+
 logger = logging.getLogger(__name__)
 
 IMAGES_DIR = 'images'
 VIDEOS_DIR = 'videos'
 JSON_SUFFIX = '.json'
 BK_TXT = '.bk.'
+BK_INDEX_TXT = 'index'
+TMP_SUFFIX = '.tmp'
 RAW_SUFFIX = '.raw'
 JPG_SUFFIX = '.jpg'
 TIF_SUFFIX = '.tif'
@@ -28,20 +87,413 @@ ZIP_MIMETYPE = 'application/zip'
 ORIG_IDENTIFIER = '_orig'
 CONTENT_DISPOSITION = 'Content-disposition'
 
+# files with these suffixes are already compressed and are stored
+# in zip files without compression by CILDataFileConverter
+STORED_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.jp2', '.flv',
+                   '.mp4', '.m4v', '.mov', '.avi', '.mpg', '.mpeg', '.wmv',
+                   '.webm', '.zip', '.gz', '.bz2', '.xz')
+TIFF_SUFFIXES = ('.tif', '.tiff')
+
+# value of TIFF compression tag (259) for uncompressed images
+TIFF_COMPRESSION_TAG = 259
+TIFF_COMPRESSION_NONE = 1
+
+# zlib level used to deflate files in zip files, 0 stores all files
+DEFAULT_COMPRESS_LEVEL = 6
+
+# files at least this big are deflated by ParallelDeflateCompressor
+# when CILDataFileConverter is given more then one deflate thread
+PARALLEL_DEFLATE_MIN_SIZE = 8 * 1024 * 1024
+
+# uncompressed bytes in each block deflated by ParallelDeflateCompressor
+PARALLEL_DEFLATE_BLOCK_SIZE = 1024 * 1024
+
+# deflate window, each block is primed with this much of previous block
+DEFLATE_WINDOW_SIZE = 32768
+
+# result of _can_replace_zip_compressor(), None until checked
+_zip_compressor_replaceable = None
+
+# file types identified by sniff_file_type()
+FILE_TYPE_ZIP = 'zip'
+FILE_TYPE_TIFF = 'tiff'
+FILE_TYPE_FLV = 'flv'
+FILE_TYPE_MP4 = 'mp4'
+FILE_TYPE_MOV = 'mov'
+FILE_TYPE_AVI = 'avi'
+FILE_TYPE_MPEG = 'mpeg'
+FILE_TYPE_JPEG = 'jpeg'
+FILE_TYPE_PNG = 'png'
+FILE_TYPE_GIF = 'gif'
+FILE_TYPE_HTML = 'html'
+
+VIDEO_FILE_TYPES = (FILE_TYPE_FLV, FILE_TYPE_MP4, FILE_TYPE_MOV,
+                    FILE_TYPE_AVI, FILE_TYPE_MPEG)
+
+# suffix given to files of each type
+FILE_TYPE_SUFFIXES = {FILE_TYPE_ZIP: ZIP_SUFFIX,
+                      FILE_TYPE_TIFF: TIF_SUFFIX,
+                      FILE_TYPE_FLV: FLV_SUFFIX,
+                      FILE_TYPE_MP4: '.mp4',
+                      FILE_TYPE_MOV: '.mov',
+                      FILE_TYPE_AVI: '.avi',
+                      FILE_TYPE_MPEG: '.mpg',
+                      FILE_TYPE_JPEG: JPG_SUFFIX,
+                      FILE_TYPE_PNG: '.png',
+                      FILE_TYPE_GIF: '.gif',
+                      FILE_TYPE_HTML: '.html'}
+
+# file type expected for each suffix
+SUFFIX_FILE_TYPES = dict((suffix, file_type) for file_type, suffix in
+                         FILE_TYPE_SUFFIXES.items())
+SUFFIX_FILE_TYPES.update({'.tiff': FILE_TYPE_TIFF, '.m4v': FILE_TYPE_MP4,
+                          '.qt': FILE_TYPE_MOV, '.mpeg': FILE_TYPE_MPEG,
+                          '.jpeg': FILE_TYPE_JPEG, '.htm': FILE_TYPE_HTML})
+
+# bytes read from start of file by sniff_file_type()
+SNIFF_SIZE = 4096
+
+# suffix and version of files written by CILDataFileConvertState
+CONVERT_STATE_SUFFIX = '.convertstate'
+CONVERT_STATE_VERSION = 1
+
+# steps of CILDataFileConverter recorded by CILDataFileConvertState
+CONVERT_STEP_RENAMED = 'renamed'
+CONVERT_STEP_EXTRACTED = 'extracted'
+CONVERT_STEP_ZIPPED = 'zipped'
+
+# permissions set on new files written by replace_file_atomically()
+DEFAULT_FILE_MODE = 0o644
+
+# headers kept by default when storing download response headers
+# in CILDataFile objects, matching is case insensitive
+DEFAULT_HEADER_WHITELIST = ['Content-Type', 'Content-Disposition', 'ETag',
+                            'Last-Modified', 'Content-Length', 'Date']
+
+# maximum number of distinct header keys and values to intern
+MAX_INTERNED_HEADER_VALUES = 100000
+
+# headers whose values repeat across downloads and are interned by
+# convert_response_headers_to_dict(), matching is case insensitive.
+# Values of other headers ie Date, ETag, Last-Modified, Content-Length
+# and Content-Disposition are usually unique per file so are not
+INTERNED_HEADER_VALUE_NAMES = ['Content-Type', 'Content-Encoding',
+                               'Content-Language', 'Server',
+                               'Accept-Ranges', 'Connection', 'Vary',
+                               'Cache-Control', 'Transfer-Encoding',
+                               'Via', 'X-Powered-By']
+
+_interned_header_value_names = set(h.lower() for h in
+                                   INTERNED_HEADER_VALUE_NAMES)
+
+_interned_header_values = {}
+
+# values written to json files by CILDataFileJsonWriter to identify
+# the format and version of the file
+JSON_FORMAT_KEY = 'format'
+JSON_FORMAT_NAME = 'cildatafile'
+JSON_VERSION_KEY = 'version'
+JSON_FORMAT_VERSION = 1
+JSON_CILDATAFILES_KEY = 'cildatafiles'
+
+# name of catalog index file written to top of download directory
+CATALOG_INDEX_FILE = 'cildata_index.sqlite'
+
+# default name of scan cache file used by cildata tools
+SCAN_CACHE_FILE = 'cildata_scancache.sqlite'
+
+# default name of checksum cache file used by cildata tools
+CHECKSUM_CACHE_FILE = 'cildata_checksumcache.sqlite'
+
+# prefix of user extended attributes storing checksums of a file
+CHECKSUM_XATTR_PREFIX = 'user.cildata.'
+
+MD5_ALGORITHM = 'md5'
+SHA256_ALGORITHM = 'sha256'
+
+# size of buffer files are read into by hash_file()
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# files at least this big are hashed by hash_file() on a thread pool,
+# one thread per algorithm, when more then one thread and more then
+# one algorithm are requested
+PARALLEL_HASH_MIN_SIZE = 64 * 1024 * 1024
+
+# CILDataFileChecksumCache consulted by md5(), see set_checksum_cache()
+_checksum_cache = None
+
+# suffix appended to legacy json files kept by migrate_json_file()
+LEGACY_SUFFIX = '.legacy'
+
+# status values returned by migrate_json_file()
+MIGRATE_MIGRATED = 'migrated'
+MIGRATE_SKIPPED = 'skipped'
+MIGRATE_FAILED = 'failed'
+
+# help for --select flag of the cildata tools, see compile_select()
+SELECT_HELP = ('Only operate on entries matching this expression ie '
+               '"suffix=raw and success=false and size>1G and id in '
+               '1000..2000". Fields are id, suffix, name, mime, size, '
+               'success, video and hasraw. Operators are =, !=, <, <=, >, '
+               '>=, in low..high and in (a, b). Combine with and, or, not '
+               'and parenthesis. none matches fields that are not set')
+
+# help for --noindex flag of the cildata tools that read the catalog index
+NO_INDEX_HELP = ('If set, ignore catalog index ' + CATALOG_INDEX_FILE +
+                 ' in download directory and read the json files '
+                 'instead. Use if json files were changed by anything '
+                 'other than the cildata tools, then rebuild the index '
+                 'with cildatareport.py --rebuildindex')
+
+# values returned by link_or_copy_file() denoting how file was copied
+LINK_METHOD = 'link'
+COPY_FILE_RANGE_METHOD = 'copy_file_range'
+COPY_METHOD = 'copy'
+
+# maximum bytes requested per os.copy_file_range() call
+COPY_FILE_RANGE_CHUNK = 1024 * 1024 * 1024
+
+# bytes read at a time when streaming data between files
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+# identifies binary catalog files written by CILDataFileCatalog
+CATALOG_MAGIC = b'CILDCAT\x00'
+CATALOG_VERSION = 1
+
+
+def replace_file_atomically(path, write_func, mode='w'):
+    """Writes file at `path` by passing an open temporary file in the
+       same directory to `write_func` and renaming the temporary file
+       to `path` once written and synced to disk. A crash while
+       writing leaves `path` untouched.
+    :param path: path to file to write
+    :param write_func: function that takes an open file and writes to it
+    :param mode: mode to open temporary file with
+    """
+    dir_name, file_name = os.path.split(os.path.abspath(path))
+    tmp_fd, tmpfile = tempfile.mkstemp(prefix='.' + file_name + '.',
+                                       suffix=TMP_SUFFIX, dir=dir_name)
+    try:
+        with os.fdopen(tmp_fd, mode) as tmp_file:
+            write_func(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if os.path.isfile(path):
+            shutil.copymode(path, tmpfile)
+        else:
+            os.chmod(tmpfile, DEFAULT_FILE_MODE)
+        os.rename(tmpfile, path)
+    except Exception:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def _copy_file_range(src, dest):
+    """Copies `src` to `dest` with os.copy_file_range() so data is
+       copied by the kernel, which shares blocks instead of copying
+       them on filesystems that support reflinks
+    """
+    with open(src, 'rb') as in_file:
+        with open(dest, 'wb') as out_file:
+            remaining = os.fstat(in_file.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(in_file.fileno(),
+                                            out_file.fileno(),
+                                            min(remaining,
+                                                COPY_FILE_RANGE_CHUNK))
+                if copied == 0:
+                    break
+                remaining -= copied
+    shutil.copymode(src, dest)
+
+
+def link_or_copy_file(src, dest):
+    """Makes `dest` have the same contents as `src` without copying
+       data if possible. A hardlink is tried first, then
+       os.copy_file_range() and finally a regular copy. Any existing
+       `dest` is replaced. Since a hardlink shares data with `src`,
+       callers must replace `dest` rather then write to it.
+    :param src: path to source file
+    :param dest: path to destination file
+    :returns: LINK_METHOD, COPY_FILE_RANGE_METHOD or COPY_METHOD
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return LINK_METHOD
+    except OSError as e:
+        logger.debug('Unable to hardlink ' + src + ' to ' + dest +
+                     ' : ' + str(e))
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            _copy_file_range(src, dest)
+            return COPY_FILE_RANGE_METHOD
+        except OSError as e:
+            logger.debug('Unable to copy_file_range ' + src + ' to ' +
+                         dest + ' : ' + str(e))
+
+    shutil.copy(src, dest)
+    return COPY_METHOD
+
+
+def _get_backup_index_file(jsonfile):
+    """Gets path to file that stores next backup number for `jsonfile`
+    """
+    return jsonfile + BK_TXT + BK_INDEX_TXT
+
+
+def get_backups_of_json(jsonfile):
+    """Gets backups of `jsonfile` made by make_backup_of_json()
+    :param jsonfile: path to json file
+    :returns: list of tuples (backup number, path to backup) sorted by
+              backup number, oldest first
+    """
+    dir_name, file_name = os.path.split(jsonfile)
+    prefix = file_name + BK_TXT
+    backups = []
+    try:
+        entries = list(scandir(dir_name or os.curdir))
+    except OSError:
+        return backups
+    for entry in entries:
+        if not entry.name.startswith(prefix):
+            continue
+        num = entry.name[len(prefix):]
+        if num.isdigit():
+            backups.append((int(num), os.path.join(dir_name, entry.name)))
+    backups.sort()
+    return backups
+
+
+def _get_next_backup_number(jsonfile):
+    """Gets next free backup number for `jsonfile` from the backup
+       index file. If the index file is missing or invalid the
+       backups are listed once to find the highest number in use.
+    """
+    try:
+        with open(_get_backup_index_file(jsonfile), 'r') as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        pass
+    backups = get_backups_of_json(jsonfile)
+    if len(backups) == 0:
+        return 0
+    return backups[-1][0] + 1
+
+
+def compact_backups_of_json(jsonfile, keep=None, keep_since=None):
+    """Removes backups of `jsonfile` made by make_backup_of_json().
+       A backup is kept if it is one of the `keep` newest backups
+       or if it was modified at or after `keep_since`. If both
+       `keep` and `keep_since` are None nothing is removed.
+       Backup numbers are not reused after compaction.
+    :param jsonfile: path to json file
+    :param keep: number of newest backups to keep
+    :param keep_since: keep backups modified at or after this time
+                       in seconds since epoch
+    :returns: list of paths to backups that were removed
+    """
+    if keep is None and keep_since is None:
+        return []
+    backups = get_backups_of_json(jsonfile)
+    if keep is not None:
+        if keep > 0:
+            backups = backups[:-keep]
+    removed = []
+    for num, backupfile in backups:
+        if keep_since is not None:
+            try:
+                if os.path.getmtime(backupfile) >= keep_since:
+                    continue
+            except OSError:
+                continue
+        logger.debug('Removing backup ' + backupfile)
+        os.remove(backupfile)
+        removed.append(backupfile)
+    return removed
+
 
-def make_backup_of_json(jsonfile):
+def make_backup_of_json(jsonfile, keep=None, keep_since=None):
     """Makes copy of file by appending .bk.# where
        # is one whole number higher then the highest
-       number found in directory.
+       backup made so far. The next number is tracked in
+       a .bk.index file next to `jsonfile` so finding it
+       does not require looking at existing backups.
+       :param keep: If set, only keep this many newest backups
+                    see compact_backups_of_json()
+       :param keep_since: If set, keep backups modified at or after
+                          this time see compact_backups_of_json()
        :raises IOError: If `jsonfile` does not exist
        :raises OSError: Can also be raised if there is a copy problem
+       :returns: path to backup file
     """
-    cntr = 0
+    cntr = _get_next_backup_number(jsonfile)
     backupfile = jsonfile + BK_TXT + str(cntr)
-    while os.path.isfile(backupfile):
-        backupfile = jsonfile + BK_TXT + str(cntr)
-        cntr += 1
-    shutil.copy(jsonfile, backupfile)
+
+    def copy_json(out_file):
+        with open(jsonfile, 'rb') as in_file:
+            shutil.copyfileobj(in_file, out_file)
+
+    replace_file_atomically(backupfile, copy_json, mode='wb')
+    replace_file_atomically(_get_backup_index_file(jsonfile),
+                            lambda f: f.write(str(cntr + 1) + '\n'))
+    compact_backups_of_json(jsonfile, keep=keep, keep_since=keep_since)
+    return backupfile
+
+
+def group_cildatafiles_by_id(cildatafiles):
+    """Generator that groups consecutive CILDataFile objects with
+       the same id. The json file factories return all CILDataFile
+       objects from a json file together so each id forms one group.
+    :param cildatafiles: iterable of CILDataFile objects
+    :returns: tuples (id as str, list of CILDataFile objects)
+    """
+    for cur_id, cdfs in itertools.groupby(cildatafiles,
+                                          key=lambda c: str(c.get_id())):
+        yield cur_id, list(cdfs)
+
+
+def update_cildatafiles_in_json(jsonfile, updates, reader, writer,
+                                backup_keep=None, backup_keep_since=None):
+    """Replaces entries in `jsonfile` whose file name is a key in
+       `updates` with the value in `updates`. The json file is backed
+       up, read and written once no matter how many entries are updated.
+    :param jsonfile: path to json file
+    :param updates: dict of file name => CILDataFile or list of
+                    CILDataFile objects to replace entry with
+    :param reader: used to read `jsonfile` ie
+                   CILDataFileListFromJsonFactory
+    :param writer: used to write `jsonfile` ie CILDataFileJsonWriter
+    :param backup_keep: passed as `keep` to make_backup_of_json()
+    :param backup_keep_since: passed as `keep_since` to
+                              make_backup_of_json()
+    :returns: number of entries updated
+    """
+    logger.debug('Making backup of ' + jsonfile)
+    make_backup_of_json(jsonfile, keep=backup_keep,
+                        keep_since=backup_keep_since)
+
+    cdf_list = reader.get_cildatafiles(jsonfile)
+    newcdf_list = []
+    num_updated = 0
+    for entry in cdf_list:
+        newcdfs = updates.get(entry.get_file_name())
+        if newcdfs is None:
+            newcdf_list.append(entry)
+            continue
+        logger.info('Updating ' + entry.get_file_name())
+        num_updated += 1
+        if isinstance(newcdfs, list):
+            newcdf_list.extend(newcdfs)
+        else:
+            newcdf_list.append(newcdfs)
+
+    writer.writeCILDataFileListToFile(jsonfile, newcdf_list,
+                                      skipsuffixappend=True)
+    return num_updated
 
 
 def download_file(url, dest_dir, numretries=2,
@@ -127,8 +579,495 @@ def get_download_url(base_url, omero_url, cdf):
     return None
 
 
+def copy_stream_with_md5(in_file, out_file, block_size=STREAM_BLOCK_SIZE):
+    """Copies `in_file` to `out_file` computing md5 and size of the
+       data as it is written so the copy does not need to be read again
+    :param in_file: file like object to read from
+    :param out_file: file like object to write to
+    :param block_size: bytes to read at a time
+    :returns: tuple (md5 hexdigest(), number of bytes copied)
+    """
+    hash_md5 = hashlib.md5()
+    size = 0
+    for chunk in iter(lambda: in_file.read(block_size), b''):
+        hash_md5.update(chunk)
+        out_file.write(chunk)
+        size += len(chunk)
+    return hash_md5.hexdigest(), size
+
+
+class HashingFileWriter(object):
+    """Wraps a file opened for writing computing md5 and size of
+       data as it is written. Seeking is not supported which makes
+       zipfile.ZipFile write archives sequentially, using data
+       descriptors instead of going back to update headers, so the
+       md5 matches the file on disk. zipfile only does this on
+       Python 3.5 and later, see _ZIPFILE_WRITES_UNSEEKABLE
+    """
+    def __init__(self, out_file):
+        """Constructor
+        :param out_file: file like object to write to
+        """
+        self._out_file = out_file
+        self._md5 = hashlib.md5()
+        self._size = 0
+
+    def write(self, data):
+        """Writes `data` updating md5 and size
+        """
+        self._md5.update(data)
+        self._size += len(data)
+        return self._out_file.write(data)
+
+    def flush(self):
+        """Flushes wrapped file
+        """
+        self._out_file.flush()
+
+    def get_md5(self):
+        """Gets md5 hexdigest() of data written so far
+        """
+        return self._md5.hexdigest()
+
+    def get_size(self):
+        """Gets number of bytes written so far
+        """
+        return self._size
+
+
+def _deflate_block(block, level, zdict, flush_mode):
+    """Compresses `block` into raw deflate data primed with `zdict`
+       and ending with `flush_mode` flush. Without zdict support the
+       block is compressed on its own which is still valid, just a
+       little bigger
+    """
+    if zdict and _ZLIB_HAS_ZDICT:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(flush_mode)
+
+
+class ParallelDeflateCompressor(object):
+    """Compresses data into a single raw deflate stream using a pool
+       of threads, similar to pigz. Has the compress() and flush()
+       methods of objects returned by zlib.compressobj() so it can be
+       used in their place.
+
+       Data is split into blocks that are compressed independently.
+       Each block is primed with the last 32K of the previous block so
+       little compression is lost, and every block but the last ends
+       with a sync flush so the compressed blocks can be concatenated.
+       zlib releases the GIL while compressing so blocks are compressed
+       in parallel.
+    """
+    def __init__(self, threads, level=DEFAULT_COMPRESS_LEVEL,
+                 block_size=PARALLEL_DEFLATE_BLOCK_SIZE):
+        """Constructor
+        :param threads: number of threads used to compress blocks
+        :param level: zlib compression level
+        :param block_size: uncompressed bytes per block
+        """
+        self._pool = ThreadPool(threads)
+        self._level = level
+        self._block_size = block_size
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+        self._buf = bytearray()
+        self._zdict = None
+
+    def _submit(self, block, flush_mode):
+        """Queues `block` to be compressed
+        """
+        zdict = self._zdict
+        self._zdict = block[-DEFLATE_WINDOW_SIZE:]
+        self._pending.append(self._pool.apply_async(
+            _deflate_block, (block, self._level, zdict, flush_mode)))
+
+    def compress(self, data):
+        """Adds `data` to be compressed
+        :returns: compressed data of blocks finished so far, in order
+        """
+        self._buf.extend(data)
+        while len(self._buf) >= self._block_size:
+            block = bytes(self._buf[:self._block_size])
+            del self._buf[:self._block_size]
+            self._submit(block, zlib.Z_SYNC_FLUSH)
+
+        out = []
+        while self._pending and (self._pending[0].ready() or
+                                 len(self._pending) > self._max_pending):
+            out.append(self._pending.popleft().get())
+        return b''.join(out)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        """Compresses remaining data and ends deflate stream. The
+           thread pool is shut down so no more data can be compressed.
+        :returns: remaining compressed data
+        """
+        self._submit(bytes(self._buf), zlib.Z_FINISH)
+        self._buf = bytearray()
+        try:
+            return b''.join([res.get() for res in self._pending])
+        finally:
+            self._pending.clear()
+            self.close()
+
+    def close(self):
+        """Shuts down thread pool
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _can_replace_zip_compressor():
+    """Checks if objects returned by zipfile.ZipFile.open() in write
+       mode hold their compressor in a _compressor attribute that
+       ParallelDeflateCompressor can replace. That attribute is not
+       part of the zipfile API so this is checked once on a throw away
+       in memory zip file in case a Python version does it differently
+    :returns: True if compressor can be replaced otherwise False
+    """
+    global _zip_compressor_replaceable
+    if _zip_compressor_replaceable is not None:
+        return _zip_compressor_replaceable
+    replaceable = False
+    try:
+        with zipfile.ZipFile(io.BytesIO(), mode='w') as zf:
+            zinfo = zipfile.ZipInfo('probe')
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(zinfo, mode='w') as dest:
+                compressor = getattr(dest, '_compressor', None)
+                replaceable = (hasattr(compressor, 'compress') and
+                               hasattr(compressor, 'flush'))
+    except Exception as e:
+        logger.debug('Unable to check zipfile compressor: ' + str(e))
+    if replaceable is False:
+        logger.info('zipfile compressor cannot be replaced, '
+                    'deflating files with one thread')
+    _zip_compressor_replaceable = replaceable
+    return replaceable
+
+
+def sniff_file_type_from_bytes(head):
+    """Identifies type of file from the first bytes in the file
+    :param head: bytes from start of file, at least SNIFF_SIZE bytes
+                 unless the file is smaller
+    :returns: file type ie FILE_TYPE_ZIP or None if not known
+    """
+    if head[:4] in (b'PK\x03\x04', b'PK\x05\x06', b'PK\x07\x08'):
+        return FILE_TYPE_ZIP
+    if head[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        return FILE_TYPE_TIFF
+    if head[:3] == b'\xff\xd8\xff':
+        return FILE_TYPE_JPEG
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return FILE_TYPE_PNG
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return FILE_TYPE_GIF
+    if head[:3] == b'FLV':
+        return FILE_TYPE_FLV
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return FILE_TYPE_AVI
+    if head[4:8] == b'ftyp':
+        if head[8:12] == b'qt  ':
+            return FILE_TYPE_MOV
+        return FILE_TYPE_MP4
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        return FILE_TYPE_MOV
+    if head[:4] in (b'\x00\x00\x01\xba', b'\x00\x00\x01\xb3'):
+        return FILE_TYPE_MPEG
+
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if text.startswith((b'<!doctype html', b'<html', b'<head', b'<body',
+                        b'<title')):
+        return FILE_TYPE_HTML
+    if text.startswith(b'<') and b'<html' in text:
+        return FILE_TYPE_HTML
+    return None
+
+
+def sniff_file_type(fname, size=SNIFF_SIZE):
+    """Identifies type of file by reading the first `size` bytes
+       instead of trusting its suffix or http headers
+    :param fname: path to file
+    :param size: number of bytes to read
+    :returns: file type ie FILE_TYPE_ZIP or None if not known or
+              file cannot be read
+    """
+    try:
+        with open(fname, 'rb') as f:
+            head = f.read(size)
+    except (IOError, OSError) as e:
+        logger.debug('Unable to sniff ' + fname + ' : ' + str(e))
+        return None
+    return sniff_file_type_from_bytes(head)
+
+
+def get_file_type_from_suffix(fname):
+    """Gets file type expected for suffix of `fname`
+    :returns: file type ie FILE_TYPE_ZIP or None if suffix is not known
+    """
+    return SUFFIX_FILE_TYPES.get(os.path.splitext(fname)[1].lower())
+
+
+def get_tiff_compression(fname):
+    """Gets value of compression tag in first image of TIFF file.
+       Both classic and BigTIFF files are supported.
+    :param fname: path to TIFF file
+    :returns: compression tag value ie TIFF_COMPRESSION_NONE or None
+              if file is not a TIFF file or tag is not found
+    """
+    try:
+        with open(fname, 'rb') as f:
+            header = f.read(16)
+            if header[:2] == b'II':
+                endian = '<'
+            elif header[:2] == b'MM':
+                endian = '>'
+            else:
+                return None
+            version = struct.unpack(endian + 'H', header[2:4])[0]
+            if version == 42:
+                offset = struct.unpack(endian + 'I', header[4:8])[0]
+                count_fmt, entry_fmt = 'H', 'HHI4s'
+            elif version == 43:
+                offset = struct.unpack(endian + 'Q', header[8:16])[0]
+                count_fmt, entry_fmt = 'Q', 'HHQ8s'
+            else:
+                return None
+            count_size = struct.calcsize(endian + count_fmt)
+            entry_size = struct.calcsize(endian + entry_fmt)
+            f.seek(offset)
+            num_entries = struct.unpack(endian + count_fmt,
+                                        f.read(count_size))[0]
+            entries = f.read(num_entries * entry_size)
+    except (IOError, OSError, struct.error):
+        return None
+
+    for i in range(len(entries) // entry_size):
+        tag, type_id, count, value = struct.unpack_from(
+            endian + entry_fmt, entries, i * entry_size)
+        if tag != TIFF_COMPRESSION_TAG:
+            continue
+        # value is a SHORT (3) or LONG (4) stored inline
+        if type_id == 4:
+            return struct.unpack_from(endian + 'I', value)[0]
+        return struct.unpack_from(endian + 'H', value)[0]
+    return None
+
+
+def get_zip_compress_type(fname):
+    """Gets compression to use when adding `fname` to a zip file.
+       Already compressed formats listed in STORED_SUFFIXES and
+       compressed TIFF files are stored, everything else is deflated.
+    :param fname: path to file
+    :returns: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    """
+    suffix = os.path.splitext(fname)[1].lower()
+    if suffix in STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    if suffix in TIFF_SUFFIXES:
+        compression = get_tiff_compression(fname)
+        if compression is not None and \
+                compression != TIFF_COMPRESSION_NONE:
+            return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def set_checksum_cache(cache):
+    """Sets CILDataFileChecksumCache consulted by md5() and updated
+       with checksums computed while writing files
+    :param cache: CILDataFileChecksumCache or None to disable caching
+    :returns: previously set cache
+    """
+    global _checksum_cache
+    prev_cache = _checksum_cache
+    _checksum_cache = cache
+    return prev_cache
+
+
+def get_checksum_cache():
+    """Gets CILDataFileChecksumCache set by set_checksum_cache()
+    :returns: CILDataFileChecksumCache or None
+    """
+    return _checksum_cache
+
+
+def close_checksum_cache():
+    """Closes and unsets CILDataFileChecksumCache set by
+       set_checksum_cache()
+    """
+    cache = set_checksum_cache(None)
+    if cache is not None:
+        cache.close()
+
+
+def remember_checksum(fname, checksum, algorithm=MD5_ALGORITHM):
+    """Stores `checksum` of `fname` computed while it was written in
+       CILDataFileChecksumCache set by set_checksum_cache() if any
+    """
+    if _checksum_cache is not None:
+        _checksum_cache.set_checksum(fname, checksum, algorithm=algorithm)
+
+
+def _advise_sequential(fd):
+    """Tells kernel file descriptor `fd` will be read sequentially
+       so it reads ahead more aggressively, if supported
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError as e:
+        logger.debug('posix_fadvise failed: ' + str(e))
+
+
+class IOThrottle(object):
+    """Limits rate data is read at across all threads that share
+       an instance by sleeping in consume() whenever more bytes were
+       consumed then `bytes_per_sec` allows since construction
+    """
+    def __init__(self, bytes_per_sec):
+        """Constructor
+        :param bytes_per_sec: maximum bytes per second, must be
+                              greater then 0
+        :raises ValueError: if `bytes_per_sec` is not greater then 0
+        """
+        if bytes_per_sec <= 0:
+            raise ValueError('bytes_per_sec must be greater then 0')
+        self._bytes_per_sec = float(bytes_per_sec)
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._total = 0
+
+    def get_bytes_per_sec(self):
+        return self._bytes_per_sec
+
+    def consume(self, num_bytes):
+        """Records `num_bytes` were read sleeping as needed to
+           stay under the rate limit
+        """
+        with self._lock:
+            self._total += num_bytes
+            delay = (self._total / self._bytes_per_sec -
+                     (time.time() - self._start))
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _update_hashers(in_file, hashers, buffer_size, throttle=None):
+    """Reads `in_file` into a reused buffer updating each hash object
+       in `hashers` with every block
+    """
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        num_read = in_file.readinto(buf)
+        if not num_read:
+            break
+        if throttle is not None:
+            throttle.consume(num_read)
+        block = view[:num_read]
+        for hasher in hashers:
+            hasher.update(block)
+
+
+def _update_hashers_in_parallel(in_file, hashers, buffer_size, threads,
+                                throttle=None):
+    """Like _update_hashers() but each hash object is updated on a
+       thread pool, hashlib releases the GIL, while the next block is
+       read into a second buffer. A single hash object cannot be split
+       across threads so no more then len(`hashers`) threads are used
+    """
+    bufs = [bytearray(buffer_size), bytearray(buffer_size)]
+    pool = ThreadPool(min(threads, len(hashers)))
+    try:
+        pending = []
+        cur = 0
+        while True:
+            # buffer `cur` is free since updates submitted for it two
+            # blocks ago were waited on below before the last submit
+            num_read = in_file.readinto(bufs[cur])
+            for res in pending:
+                res.get()
+            if not num_read:
+                break
+            if throttle is not None:
+                throttle.consume(num_read)
+            block = memoryview(bufs[cur])[:num_read]
+            pending = [pool.apply_async(hasher.update, (block,))
+                       for hasher in hashers]
+            cur = 1 - cur
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def hash_file(fname, algorithms=(MD5_ALGORITHM,),
+              buffer_size=HASH_BUFFER_SIZE, threads=1, use_cache=True,
+              throttle=None):
+    """Computes checksums of `fname` for each of `algorithms` in a
+       single pass over the file. The file is read into a reused buffer
+       after advising the kernel it will be read sequentially.
+
+       Threads only split work across algorithms, each digest is
+       computed by one thread, so `threads` only helps when several
+       `algorithms` are requested for files of at least
+       PARALLEL_HASH_MIN_SIZE bytes. A single digest, as computed by
+       md5(), is always calculated serially.
+
+       If a CILDataFileChecksumCache was set via set_checksum_cache()
+       it is consulted first and updated with the result.
+    :param fname: path to file
+    :param algorithms: names of hashlib algorithms ie MD5_ALGORITHM
+    :param buffer_size: bytes read at a time
+    :param threads: maximum number of threads used to hash large files
+                    when more then one algorithm is requested
+    :param use_cache: if False checksum cache is ignored
+    :param throttle: IOThrottle to limit read rate or None
+    :raises IOError: if file cannot be read
+    :returns: dict of algorithm => hexdigest()
+    """
+    cache = _checksum_cache if use_cache is True else None
+    with open(fname, 'rb', buffering=0) as in_file:
+        st = os.fstat(in_file.fileno())
+        if cache is not None:
+            checksums = dict((algorithm,
+                              cache.get_checksum(fname, st=st,
+                                                 algorithm=algorithm))
+                             for algorithm in algorithms)
+            if None not in checksums.values():
+                logger.debug('Using cached checksums of file: ' + fname)
+                return checksums
+
+        logger.debug('Calculating ' + ','.join(algorithms) +
+                     ' of file: ' + fname)
+        _advise_sequential(in_file.fileno())
+        hashers = [hashlib.new(algorithm) for algorithm in algorithms]
+        if threads > 1 and len(hashers) > 1 and \
+                st.st_size >= PARALLEL_HASH_MIN_SIZE:
+            _update_hashers_in_parallel(in_file, hashers, buffer_size,
+                                        threads, throttle=throttle)
+        else:
+            _update_hashers(in_file, hashers, buffer_size,
+                            throttle=throttle)
+
+    checksums = {}
+    for algorithm, hasher in zip(algorithms, hashers):
+        checksums[algorithm] = hasher.hexdigest()
+        if cache is not None:
+            cache.set_checksum(fname, checksums[algorithm], st=st,
+                               algorithm=algorithm)
+    return checksums
+
+
 def md5(fname):
-    """Calculates md5 hash on file passed in
+    """Calculates md5 hash on file passed in using hash_file(). If a
+       CILDataFileChecksumCache was set via set_checksum_cache()
+       it is consulted first and updated with the result.
     :param fname: file to examine
     :returns: None if no file is passed in or if file does
               not exist otherwise md5hash hexdigest()
@@ -140,32 +1079,67 @@ def md5(fname):
         logger.error(fname + ' is not a file')
         return None
 
-    hash_md5 = hashlib.md5()
-    logger.debug('Calculating md5 of file: ' + fname)
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_file(fname)[MD5_ALGORITHM]
+
+
+def intern_header_value(val):
+    """Returns a shared copy of header key or value `val` so
+       repeated values ie 'Content-Type' or 'image/jpeg'
+       are only stored once in memory across CILDataFile objects.
+       Once MAX_INTERNED_HEADER_VALUES distinct values have been seen
+       new values are returned as is and the pool is never freed, so
+       only pass keys and values that repeat, see
+       INTERNED_HEADER_VALUE_NAMES.
+    :param val: header key or value
+    :returns: interned version of `val`
+    """
+    try:
+        shared_val = _interned_header_values.get(val)
+    except TypeError:
+        # unhashable values are not interned
+        return val
+
+    if shared_val is not None:
+        return shared_val
+
+    if len(_interned_header_values) < MAX_INTERNED_HEADER_VALUES:
+        _interned_header_values[val] = val
+    return val
 
 
-def convert_response_headers_to_dict(headers):
+def convert_response_headers_to_dict(headers, whitelist=None):
     """Converts Requests.Response headers to
-       dictionary
+       dictionary interning the keys and the values of headers in
+       INTERNED_HEADER_VALUE_NAMES via intern_header_value()
+    :param headers: Requests.Response headers or dict
+    :param whitelist: list of header names to keep, matching is case
+                      insensitive. If None all headers are kept
+    :returns: dict of headers or None if `headers` is None
     """
     if headers is None:
         logger.error('Headers is None')
         return None
 
+    allowed = None
+    if whitelist is not None:
+        allowed = set([h.lower() for h in whitelist])
+
     header_dict = {}
 
     for k in headers.keys():
-        header_dict[k] = headers[k]
+        if allowed is not None and k.lower() not in allowed:
+            continue
+        val = headers[k]
+        if k.lower() in _interned_header_value_names:
+            val = intern_header_value(val)
+        header_dict[intern_header_value(k)] = val
     return header_dict
 
 
 def download_cil_data_file(destination_dir, cdf, loadbaseurl=False,
                            download_direct_to_dest=False,
-                           numretries=2,retry_sleep=30, timeout=120):
+                           numretries=2,retry_sleep=30, timeout=120,
+                           header_whitelist=DEFAULT_HEADER_WHITELIST):
 
     base_url = 'http://www.cellimagelibrary.org/'
     omero_url = 'http://grackle.crbs.ucsd.edu:8080/OmeroWebService/images/'
@@ -208,12 +1182,17 @@ def download_cil_data_file(destination_dir, cdf, loadbaseurl=False,
         logger.debug('content type: ' + headers['Content-Type'])
         cdf.set_mime_type(headers['Content-Type'])
         cdf.set_localfile(local_file)
-        cdf.set_headers(convert_response_headers_to_dict(headers))
+        cdf.set_headers(convert_response_headers_to_dict(
+            headers, whitelist=header_whitelist))
     if status is 200:
         cdf.set_download_success(True)
         local_file_fp = os.path.join(out_dir, cdf.get_localfile())
         cdf.set_checksum(md5(local_file_fp))
         cdf.set_file_size(os.path.getsize(local_file_fp))
+        if sniff_file_type(local_file_fp) == FILE_TYPE_HTML:
+            logger.warning('Downloaded ' + cdf.get_file_name() +
+                           ' is an HTML page, marking download failed')
+            cdf.set_download_success(False)
     else:
         logger.warning('Error downloading ' + cdf.get_file_name() +
                        ' code: ' + str(status))
@@ -487,203 +1466,1824 @@ class CILDataFile(object):
     def get_localfile(self):
         return self._localfile
 
-
-class CILDataFileFoundInFilesystemFilter(object):
-    """Filter that removes any CILDataFile objects
-       that already exist in the file system
-    """
-    def __init__(self, images_dir, videos_dir):
+    def to_dict(self):
+        """Gets values of this object as a dict suitable for
+           serializing to json
+        :returns: dict
         """
-        COnstructor
-        :param images_dir: Directory where images are stored
-        :param videos_dir: Directory where videos are stored
-        :raises ValueError: If either images_dir or videos_dir is None
+        return {'id': self._id,
+                'is_video': self._is_video,
+                'mime_type': self._mimetype,
+                'file_name': self._file_name,
+                'download_success': self._download_success,
+                'download_time': self._download_time,
+                'checksum': self._checksum,
+                'localfile': self._localfile,
+                'headers': self._headers,
+                'file_size': self._file_size,
+                'has_raw': self._has_raw}
+
+    @staticmethod
+    def from_dict(cdf_dict):
+        """Creates CILDataFile from dict generated by to_dict()
+           any missing values are left as None
+        :param cdf_dict: dict
+        :raises KeyError: if id is not in `cdf_dict`
+        :returns: CILDataFile
         """
-        self._images_dir = images_dir
-        self._videos_dir = videos_dir
-        if self._images_dir is None:
-            raise ValueError('images_dir cannot be None')
-        if self._videos_dir is None:
-            raise ValueError('videos_dir cannot be None')
+        cdf = CILDataFile(cdf_dict['id'])
+        cdf._is_video = cdf_dict.get('is_video')
+        cdf._mimetype = cdf_dict.get('mime_type')
+        cdf._file_name = cdf_dict.get('file_name')
+        cdf._download_success = cdf_dict.get('download_success')
+        cdf._download_time = cdf_dict.get('download_time')
+        cdf._checksum = cdf_dict.get('checksum')
+        cdf._localfile = cdf_dict.get('localfile')
+        headers = cdf_dict.get('headers')
+        if isinstance(headers, dict):
+            headers = convert_response_headers_to_dict(headers)
+        cdf._headers = headers
+        cdf._file_size = cdf_dict.get('file_size')
+        cdf._has_raw = cdf_dict.get('has_raw')
+        return cdf
 
-    def get_cildatafiles(self, cildatafile_list):
-        """Filters out any CILDataFile objects
-           that have a presence on filesystem
-           where presence means a directory
-           exists
-        :returns: list of CILDataFile objects that passed filter or
-                  None if None was passed in. An empty list will return
-                  an empty list.
-        """
 
-        if cildatafile_list is None:
-            logger.debug('Received None so returning None')
-            return None
+class CILDataFileTable(object):
+    """Column oriented in memory table of CILDataFile objects.
 
-        filtered_cdf_list = []
-        for cdf in cildatafile_list:
-            if cdf.get_is_video():
-                base_dir = self._videos_dir
-            else:
-                base_dir = self._images_dir
+       Instead of a list of objects the id, file name, suffix,
+       download success, file size, mime type, is video and
+       has raw values are stored in separate columns. The id and
+       file size columns are `array` objects, the suffix and mime type
+       columns hold codes into interned string pools and the boolean
+       columns are `bytearray` objects storing one of
+       TRISTATE_NONE, TRISTATE_FALSE, or TRISTATE_TRUE.
 
-            cdf_dir = os.path.join(base_dir, str(cdf.get_id()))
-            if os.path.isdir(cdf_dir):
-                continue
+       Filters are expressed as masks which are `bytearray` objects
+       the same length as the table with 1 for rows that match and
+       0 for rows that do not. Masks can be combined with
+       mask_and(), mask_or() and mask_not() and applied with filter().
+    """
+    TRISTATE_NONE = 0
+    TRISTATE_FALSE = 1
+    TRISTATE_TRUE = 2
 
-            filtered_cdf_list.append(cdf)
-        return filtered_cdf_list
+    NULL_FILE_SIZE = -1
 
+    _NOT_TABLE = bytes(bytearray([1, 0]) + bytearray(254))
 
-class CILDataFileNoRawFilter(object):
-    """Filter that removes any CILDataFile image objects
-       that end with .raw and whose get_has_raw() is
-       set to False
-    """
     def __init__(self):
+        """Constructor
         """
-        COnstructor
+        self._ids = array(_INT64_TYPECODE)
+        self._file_names = []
+        self._suffix_codes = bytearray()
+        self._success = bytearray()
+        self._file_sizes = array(_INT64_TYPECODE)
+        self._mime_codes = array('l')
+        self._is_video = bytearray()
+        self._has_raw = bytearray()
+        self._cdfs = []
+        self._suffix_pool = [None]
+        self._suffix_lookup = {None: 0}
+        self._mime_pool = [None]
+        self._mime_lookup = {None: 0}
+
+    @staticmethod
+    def from_cildatafiles(cildatafiles):
+        """Creates a CILDataFileTable from an iterable of
+           CILDataFile objects. Objects whose id is not numeric
+           are logged and skipped
+        :param cildatafiles: iterable of CILDataFile objects
+        :returns: CILDataFileTable
         """
-
-    def get_cildatafiles(self, cildatafile_list):
-        """Filters out any CILDataFile objects as described
-           in constructor.
-        :raises AttributeError: if CILDataFile does not have values for
-                                get_file_name()
-        :returns: filtered list of CILDataFile objects
+        table = CILDataFileTable()
+        if cildatafiles is None:
+            return table
+        for cdf in cildatafiles:
+            if not CILDataFileTable.is_numeric_id(cdf.get_id()):
+                logger.warning('Skipping ' + str(cdf.get_file_name()) +
+                               ' with non numeric id: ' +
+                               str(cdf.get_id()))
+                continue
+            table.append(cdf)
+        return table
+
+    @staticmethod
+    def is_numeric_id(id):
+        """Checks if `id` can be stored in id column
+        :returns: True if `id` is an int or string of an int
+                  otherwise False
         """
-        if cildatafile_list is None:
-            logger.debug('Received None so returning None')
+        try:
+            int(id)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    @staticmethod
+    def _to_tristate(val):
+        """Converts None, False, True to corresponding
+           TRISTATE_* value
+        """
+        if val is None:
+            return CILDataFileTable.TRISTATE_NONE
+        if val is True:
+            return CILDataFileTable.TRISTATE_TRUE
+        return CILDataFileTable.TRISTATE_FALSE
+
+    @staticmethod
+    def _get_code(val, pool, lookup):
+        """Gets code for `val` in `pool` adding `val`
+           to `pool` if not already there
+        """
+        code = lookup.get(val)
+        if code is None:
+            code = len(pool)
+            pool.append(val)
+            lookup[val] = code
+        return code
+
+    @staticmethod
+    def get_suffix(file_name):
+        """Gets suffix of `file_name` ie 123_orig.tif returns .tif
+        :returns: lower case suffix or None if `file_name` is None
+                  or has no suffix
+        """
+        if file_name is None:
+            return None
+        suffix = os.path.splitext(file_name)[1]
+        if suffix == '':
             return None
+        return suffix.lower()
 
-        filtered_cdf_list = []
-        for cdf in cildatafile_list:
-            if cdf.get_is_video() is not True:
-                if cdf.get_file_name().endswith(RAW_SUFFIX):
-                    if cdf.get_has_raw() is False:
-                        logger.debug('Skipping entry: ' + cdf.get_file_name())
-                        continue
-            filtered_cdf_list.append(cdf)
-        return filtered_cdf_list
+    def append(self, cdf):
+        """Adds CILDataFile `cdf` to end of table
+        :raises ValueError: if id of `cdf` is not numeric or if more
+                            then 255 unique suffixes are added, in
+                            which case the table is left unchanged
+        """
+        cur_id = int(cdf.get_id())
+        file_name = cdf.get_file_name()
+        suffix_code = CILDataFileTable._get_code(
+            CILDataFileTable.get_suffix(file_name),
+            self._suffix_pool, self._suffix_lookup)
+        if suffix_code > 255:
+            raise ValueError('Too many unique suffixes in table')
+        if not isinstance(self._cdfs, list):
+            self._file_names = list(self._file_names)
+            self._cdfs = list(self._cdfs)
+        self._ids.append(cur_id)
+        self._file_names.append(file_name)
+        self._suffix_codes.append(suffix_code)
+        self._success.append(
+            CILDataFileTable._to_tristate(cdf.get_download_success()))
+        if cdf.get_file_size() is None:
+            self._file_sizes.append(CILDataFileTable.NULL_FILE_SIZE)
+        else:
+            self._file_sizes.append(cdf.get_file_size())
+        self._mime_codes.append(
+            CILDataFileTable._get_code(cdf.get_mime_type(),
+                                       self._mime_pool, self._mime_lookup))
+        self._is_video.append(
+            CILDataFileTable._to_tristate(cdf.get_is_video()))
+        self._has_raw.append(
+            CILDataFileTable._to_tristate(cdf.get_has_raw()))
+        self._cdfs.append(cdf)
+
+    def __len__(self):
+        return len(self._ids)
 
+    def get_cildatafiles(self):
+        """Gets CILDataFile objects in table
+        :returns: list of CILDataFile objects
+        """
+        return list(self._cdfs)
 
-class CILDataFileFailedDownloadFilter(object):
-    """Filter that retreives CILDataFile objects that
-       failed to download, excluding .raw image
-       entries that failed to download with get_has_raw()
-       set to False
-    """
-    def __init__(self):
-        """Constructor"""
+    def get_ids(self):
+        """Gets id column
+        :returns: array of ids as ints
+        """
+        return self._ids
 
-    def get_cildatafiles(self, cildatafile_list):
-        """Removes CILDataFile objects that
-        had a successful download or if they were
-        .raw image entries that failed to download
-         with get_has_raw() set to False
+    def get_file_names(self):
+        """Gets file name column
+        :returns: list of file names
         """
-        if cildatafile_list is None:
-            logger.error('Received None so returning None')
-            return None
-        filtered_cdf_list = []
-        for cdf in cildatafile_list:
-            if cdf.get_download_success() is True:
-                continue
-            filtered_cdf_list.append(cdf)
-        return filtered_cdf_list
+        return self._file_names
 
+    def get_file_sizes(self):
+        """Gets file size column where NULL_FILE_SIZE denotes
+           file size was not set
+        :returns: array of file sizes
+        """
+        return self._file_sizes
 
-class CILDataFileFromJsonFilesFactory(object):
-    """Generates CILDataFile objects by parsing
-       json files found in directory passed in.
-    """
-    def __init__(self):
-        """Constructor
+    def get_unique_ids(self, mask=None):
+        """Gets set of unique ids in table
+        :param mask: if set only include ids of rows in mask
+        :returns: set of ids as ints
+        """
+        if mask is None:
+            return set(self._ids)
+        return set(itertools.compress(self._ids, mask))
+
+    def count_by_suffix(self):
+        """Counts rows by suffix
+        :returns: dict of suffix => count, None is used for
+                  rows without a suffix
+        """
+        res = {}
+        for code in range(len(self._suffix_pool)):
+            # Python 2 bytearray.count() only takes a byte sequence
+            count = self._suffix_codes.count(bytearray((code,)))
+            if count > 0:
+                res[self._suffix_pool[code]] = count
+        return res
+
+    def count_by_mime_type(self):
+        """Counts rows by mime type
+        :returns: dict of mime type => count, None is used for
+                  rows without a mime type
+        """
+        counts = collections.Counter(self._mime_codes)
+        res = {}
+        for code in range(len(self._mime_pool)):
+            if code in counts:
+                res[self._mime_pool[code]] = counts[code]
+        return res
+
+    @staticmethod
+    def _get_code_mask(column, codes):
+        """Gets mask for `column` of byte codes set to 1 where
+           value is in `codes`
         """
+        table = bytearray(256)
+        for code in codes:
+            table[code] = 1
+        return column.translate(bytes(table))
+
+    def get_suffix_mask(self, suffix):
+        """Gets mask of rows whose suffix, as returned by get_suffix(),
+           is `suffix`. Suffixes are compared ignoring case since
+           get_suffix() lower cases them
+        :param suffix: suffix with leading period ie .raw
+        """
+        if suffix is not None:
+            suffix = suffix.lower()
+        code = self._suffix_lookup.get(suffix)
+        if code is None:
+            return bytearray(len(self))
+        return CILDataFileTable._get_code_mask(self._suffix_codes, [code])
+
+    def get_download_success_mask(self, val):
+        """Gets mask of rows whose download success is `val`
+        :param val: True, False, or None
+        """
+        return CILDataFileTable._get_code_mask(
+            self._success, [CILDataFileTable._to_tristate(val)])
 
-    def _get_all_json_files(self, path):
-        """Generator
+    def get_is_video_mask(self, val):
+        """Gets mask of rows whose is video is `val`
+        :param val: True, False, or None
         """
-        # logger.debug('Examining ' + path)
-        if os.path.isfile(path) and path.endswith(JSON_SUFFIX):
-            # logger.debug('Yielding ' + path)
-            yield path
-        if os.path.isdir(path):
-            for entry in os.listdir(path):
-                fp = os.path.join(path, entry)
-                for subentry in self._get_all_json_files(fp):
-                    yield subentry
+        return CILDataFileTable._get_code_mask(
+            self._is_video, [CILDataFileTable._to_tristate(val)])
 
-    def get_cildatafiles(self, dir_path):
+    def get_has_raw_mask(self, val):
+        """Gets mask of rows whose has raw is `val`
+        :param val: True, False, or None
+        """
+        return CILDataFileTable._get_code_mask(
+            self._has_raw, [CILDataFileTable._to_tristate(val)])
 
-        if dir_path is None:
-            logger.error('None passed in')
-            return None
+    def get_mime_type_mask(self, mimetype):
+        """Gets mask of rows whose mime type is `mimetype`. Unlike
+           masks of the byte columns, which use bytes.translate(),
+           this compares each row in a Python loop
+        """
+        code = self._mime_lookup.get(mimetype)
+        if code is None:
+            return bytearray(len(self))
+        return bytearray(x == code for x in self._mime_codes)
+
+    def get_file_size_mask(self, size):
+        """Gets mask of rows whose file size is `size` pass
+           None to get rows with no file size set. Like
+           get_mime_type_mask() this compares each row in a Python loop
+        """
+        if size is None:
+            size = CILDataFileTable.NULL_FILE_SIZE
+        return bytearray(x == size for x in self._file_sizes)
+
+    @staticmethod
+    def mask_and(mask_a, mask_b):
+        """Logical and of two masks, done on big integers where
+           int.from_bytes() is available (Python 3)
+        """
+        if _HAS_INT_FROM_BYTES:
+            val = (int.from_bytes(bytes(mask_a), 'little') &
+                   int.from_bytes(bytes(mask_b), 'little'))
+            return bytearray(val.to_bytes(len(mask_a), 'little'))
+        return bytearray(imap(operator.and_, mask_a, mask_b))
+
+    @staticmethod
+    def mask_or(mask_a, mask_b):
+        """Logical or of two masks, see mask_and()
+        """
+        if _HAS_INT_FROM_BYTES:
+            val = (int.from_bytes(bytes(mask_a), 'little') |
+                   int.from_bytes(bytes(mask_b), 'little'))
+            return bytearray(val.to_bytes(len(mask_a), 'little'))
+        return bytearray(imap(operator.or_, mask_a, mask_b))
+
+    @staticmethod
+    def mask_not(mask):
+        """Logical not of mask
+        """
+        return bytearray(mask).translate(CILDataFileTable._NOT_TABLE)
 
-        reader = CILDataFileListFromJsonPickleFactory()
-        full_list = []
-        for jsonfile in self._get_all_json_files(dir_path):
-            for entry in reader.get_cildatafiles(jsonfile):
-                full_list.append(entry)
-        return full_list
+    @staticmethod
+    def _compress_column(column, mask):
+        """Gets rows of `column` set in `mask`, lazy columns
+           loaded from a CILDataFileCatalog stay lazy
+        """
+        if isinstance(column, _CatalogHeapColumn):
+            return column.compress(mask)
+        return list(itertools.compress(column, mask))
+
+    def filter(self, mask):
+        """Creates new table containing only rows set in `mask`
+        :param mask: bytearray the same length as this table
+        :raises ValueError: if mask is not the same length as table
+        :returns: CILDataFileTable
+        """
+        if len(mask) != len(self):
+            raise ValueError('Mask length ' + str(len(mask)) +
+                             ' does not match table length ' +
+                             str(len(self)))
+        table = CILDataFileTable()
+        table._ids = array(_INT64_TYPECODE,
+                           itertools.compress(self._ids, mask))
+        table._file_names = CILDataFileTable._compress_column(
+            self._file_names, mask)
+        table._suffix_codes = bytearray(itertools.compress(self._suffix_codes,
+                                                           mask))
+        table._success = bytearray(itertools.compress(self._success, mask))
+        table._file_sizes = array(_INT64_TYPECODE,
+                                  itertools.compress(self._file_sizes, mask))
+        table._mime_codes = array('l', itertools.compress(self._mime_codes,
+                                                          mask))
+        table._is_video = bytearray(itertools.compress(self._is_video, mask))
+        table._has_raw = bytearray(itertools.compress(self._has_raw, mask))
+        table._cdfs = CILDataFileTable._compress_column(self._cdfs, mask)
+        table._suffix_pool = self._suffix_pool
+        table._suffix_lookup = self._suffix_lookup
+        table._mime_pool = self._mime_pool
+        table._mime_lookup = self._mime_lookup
+        return table
+
+
+def _array_to_le_bytes(arr):
+    """Gets contents of array `arr` as little endian bytes
+    """
+    if sys.byteorder != 'little':  # pragma: no cover
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    if hasattr(arr, 'tobytes'):
+        return arr.tobytes()
+    return arr.tostring()
 
 
-class CILDataFileFromDatabaseFactory(object):
-    """Obtains CILDataFile objects from database
+def _array_from_le_bytes(typecode, buf):
+    """Creates array of `typecode` from little endian bytes in `buf`
     """
-    IMG_SUFFIX_LIST = [TIF_SUFFIX, JPG_SUFFIX, RAW_SUFFIX]
-    VID_SUFFIX_LIST = [FLV_SUFFIX, RAW_SUFFIX, JPG_SUFFIX]
+    arr = array(typecode)
+    # Python 2 arrays only have fromstring()
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(buf)
+    else:
+        arr.fromstring(bytes(buf))
+    if sys.byteorder != 'little':  # pragma: no cover
+        arr.byteswap()
+    return arr
 
-    def __init__(self, conn, id=None, skipifrawfalse=False,
-                 skipifprocessedtimeset=False):
+
+class _CatalogHeapColumn(object):
+    """Read only sequence of values stored in the heap of a
+       CILDataFileCatalog. Values are decoded from the memory
+       mapped file only when accessed.
+    """
+    def __init__(self, buf, base, offsets, decode_func, rows=None):
         """Constructor
-        :param conn: database connection already connected
-        :param id: only return CILDataFile objects with matching id.
-        :param skipifrawfalse: Omit the .raw image if has_raw is False
+        :param buf: memory mapped catalog
+        :param base: offset of heap in `buf`
+        :param offsets: array of n + 1 offsets into heap where
+                        value i is stored between offsets i and i + 1
+        :param decode_func: function that converts bytes to value
+        :param rows: array of rows in this column or None for all rows
         """
-        self._conn = conn
-        self._id = id
-        self._skipifrawfalse = skipifrawfalse
-        self._skipifprocessedtimeset = skipifprocessedtimeset
+        self._buf = buf
+        self._base = base
+        self._offsets = offsets
+        self._decode_func = decode_func
+        self._rows = rows
+
+    def __len__(self):
+        if self._rows is None:
+            return len(self._offsets) - 1
+        return len(self._rows)
+
+    def _get_row(self, row):
+        return self._decode_func(
+            self._buf[self._base + self._offsets[row]:
+                      self._base + self._offsets[row + 1]])
+
+    def __getitem__(self, index):
+        if self._rows is None:
+            if index < 0:
+                index += len(self)
+            if index < 0 or index >= len(self):
+                raise IndexError('index out of range')
+            return self._get_row(index)
+        return self._get_row(self._rows[index])
+
+    def __iter__(self):
+        if self._rows is None:
+            rows = range(len(self))
+        else:
+            rows = self._rows
+        for row in rows:
+            yield self._get_row(row)
 
-    def get_cildatafiles(self):
-        """Queries database to get CILDataFile objects
-           creating a duplicate entry for each image
-           type (tif, raw, jpg)
-           method also updates status information from status table
+    def compress(self, mask):
+        """Gets new column with only rows set in `mask`
+        """
+        if self._rows is None:
+            rows = range(len(self))
+        else:
+            rows = self._rows
+        rows = array(_INT64_TYPECODE, itertools.compress(rows, mask))
+        return _CatalogHeapColumn(self._buf, self._base, self._offsets,
+                                  self._decode_func, rows=rows)
+
+
+class CILDataFileCatalog(object):
+    """Packed binary export of CILDataFile objects that is loaded
+       via mmap without parsing json.
+
+       The file starts with a header containing CATALOG_MAGIC, the
+       version, the number of sections and number of rows followed by
+       the (offset, length) of each section. Rows are sorted by id.
+       The fixed width sections hold the CILDataFileTable columns as
+       little endian arrays. File names and CILDataFile objects (as
+       compact json of CILDataFile.to_dict()) are stored in heaps
+       indexed by offset sections with n + 1 entries.
+
+       Since rows are sorted by id the id section doubles as the
+       offset table for lookups by id.
+    """
+    HEADER_FORMAT = '<8sIIQ'
+    SECTION_FORMAT = '<QQ'
+
+    # sections in order they appear in file, with array typecode
+    # or None for raw bytes
+    SECTIONS = [('ids', _INT64_TYPECODE), ('file_sizes', _INT64_TYPECODE),
+                ('mime_codes', 'I'), ('suffix_codes', None),
+                ('success', None), ('is_video', None), ('has_raw', None),
+                ('file_name_null', None),
+                ('file_name_offsets', _UINT64_TYPECODE),
+                ('data_offsets', _UINT64_TYPECODE), ('pools', None),
+                ('file_name_heap', None), ('data_heap', None)]
+
+    def __init__(self, catalog_file):
+        """Constructor, memory maps `catalog_file`
+        :param catalog_file: path to catalog written by write()
+        :raises ValueError: if `catalog_file` is not a catalog or has
+                            an unsupported version
+        """
+        self._catalog_file = catalog_file
+        self._file = open(catalog_file, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            self._sections = self._read_header()
+        except Exception:
+            self.close()
+            raise
+        self._ids = self._get_array('ids')
+
+    def _read_header(self):
+        """Reads header of catalog
+        :returns: dict of section name => (offset, length)
+        """
+        header_size = struct.calcsize(CILDataFileCatalog.HEADER_FORMAT)
+        if len(self._mm) < header_size:
+            raise ValueError(self._catalog_file + ' is not a catalog')
+        (magic, version,
+         num_sections, self._num_rows) = struct.unpack_from(
+            CILDataFileCatalog.HEADER_FORMAT, self._mm, 0)
+        if magic != CATALOG_MAGIC:
+            raise ValueError(self._catalog_file + ' is not a catalog')
+        if version != CATALOG_VERSION:
+            raise ValueError('Unsupported catalog version: ' + str(version))
+        sections = {}
+        offset = header_size
+        section_size = struct.calcsize(CILDataFileCatalog.SECTION_FORMAT)
+        for name, typecode in CILDataFileCatalog.SECTIONS[:num_sections]:
+            sections[name] = struct.unpack_from(
+                CILDataFileCatalog.SECTION_FORMAT, self._mm, offset)
+            offset += section_size
+        return sections
+
+    def _get_bytes(self, name):
+        """Gets contents of section `name` as bytes
         """
-        origcdflist = self._get_cildatafiles_from_data_type_table()
-        return self._generate_cildatafiles_from_database(origcdflist)
+        offset, length = self._sections[name]
+        return self._mm[offset:offset + length]
 
-    def _generate_cildatafiles_from_database(self, cdflist):
-        """Given a list of CILDataFile objects from the database,
-        which is one CILDataFile per id, generates all the CILDataFile
-        objects which should include multiple CILDataFile objects
-        per id.
-        :param cdflist:
-        :return:
+    def _get_array(self, name):
+        """Gets contents of section `name` as array
         """
-        newcdflist = []
-        for cdf in cdflist:
-            if cdf.get_is_video():
-                counter = 0
-                cur_id = cdf.get_id()
-                for suffix in CILDataFileFromDatabaseFactory.VID_SUFFIX_LIST:
-                    if counter is 0:
-                        newcdf = cdf
-                        counter = 1
-                    else:
-                        newcdf = CILDataFile(cur_id)
-                        newcdf.copy(cdf)
-                        newcdf.set_is_video(True)
+        typecode = dict(CILDataFileCatalog.SECTIONS)[name]
+        return _array_from_le_bytes(typecode, self._get_bytes(name))
 
-                    newcdf.set_file_name(str(cur_id) + suffix)
-                    newcdflist.append(newcdf)
-            else:
-                counter = 0
-                cur_id = cdf.get_id()
-                for suffix in CILDataFileFromDatabaseFactory.IMG_SUFFIX_LIST:
-                    if self._skipifrawfalse is True and suffix == RAW_SUFFIX:
+    def _get_heap_column(self, heap_name, offsets_name, decode_func):
+        """Gets lazy column of values in heap `heap_name`
+        """
+        return _CatalogHeapColumn(self._mm, self._sections[heap_name][0],
+                                  self._get_array(offsets_name),
+                                  decode_func)
+
+    @staticmethod
+    def _decode_file_name(data):
+        return data.decode('utf-8')
+
+    @staticmethod
+    def _decode_cildatafile(data):
+        return CILDataFile.from_dict(json.loads(data.decode('utf-8')))
+
+    def __len__(self):
+        return self._num_rows
+
+    def get_table(self):
+        """Gets CILDataFileTable of all rows in catalog. Columns are
+           copied out of the memory mapped file, file names and
+           CILDataFile objects are decoded lazily when accessed
+        :returns: CILDataFileTable
+        """
+        table = CILDataFileTable()
+        table._ids = array(_INT64_TYPECODE, self._ids)
+        table._file_sizes = self._get_array('file_sizes')
+        table._mime_codes = array('l', self._get_array('mime_codes'))
+        table._suffix_codes = bytearray(self._get_bytes('suffix_codes'))
+        table._success = bytearray(self._get_bytes('success'))
+        table._is_video = bytearray(self._get_bytes('is_video'))
+        table._has_raw = bytearray(self._get_bytes('has_raw'))
+
+        file_names = self._get_heap_column(
+            'file_name_heap', 'file_name_offsets',
+            CILDataFileCatalog._decode_file_name)
+        null_rows = bytearray(self._get_bytes('file_name_null'))
+        if any(null_rows):
+            file_names = [None if null_rows[i] == 1 else name
+                          for i, name in enumerate(file_names)]
+        table._file_names = file_names
+        table._cdfs = self._get_heap_column(
+            'data_heap', 'data_offsets',
+            CILDataFileCatalog._decode_cildatafile)
+
+        pools = json.loads(self._get_bytes('pools').decode('utf-8'))
+        table._suffix_pool = pools['suffix']
+        table._suffix_lookup = dict((v, i) for i, v in
+                                    enumerate(table._suffix_pool))
+        table._mime_pool = pools['mime']
+        table._mime_lookup = dict((v, i) for i, v in
+                                  enumerate(table._mime_pool))
+        return table
+
+    def get_row_range(self, id):
+        """Gets rows with id `id` using binary search of the
+           sorted id section
+        :returns: tuple (first row, last row + 1)
+        """
+        id = int(id)
+        return (bisect.bisect_left(self._ids, id),
+                bisect.bisect_right(self._ids, id))
+
+    def get_cildatafiles(self, id=None):
+        """Gets CILDataFile objects in catalog
+        :param id: only return CILDataFile objects with this id
+        :returns: list of CILDataFile objects sorted by id
+        """
+        return list(self.iter_cildatafiles(id=id))
+
+    def iter_cildatafiles(self, id=None):
+        """Generator version of get_cildatafiles()
+        :param id: only return CILDataFile objects with this id
+        """
+        cdfs = self._get_heap_column('data_heap', 'data_offsets',
+                                     CILDataFileCatalog._decode_cildatafile)
+        if id is None:
+            rows = range(len(self))
+        else:
+            rows = range(*self.get_row_range(id))
+        for row in rows:
+            yield cdfs[row]
+
+    def close(self):
+        """Unmaps and closes catalog file
+        """
+        if getattr(self, '_mm', None) is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _get_offsets_and_heap(values):
+        """Packs `values` which are bytes into a heap
+        :returns: tuple (array of n + 1 offsets, heap bytes)
+        """
+        offsets = array(_UINT64_TYPECODE, [0])
+        heap = bytearray()
+        for val in values:
+            heap.extend(val)
+            offsets.append(len(heap))
+        return offsets, bytes(heap)
+
+    @staticmethod
+    def write(catalog_file, cildatafiles):
+        """Writes catalog of `cildatafiles` to `catalog_file` atomically
+        :param catalog_file: path to catalog file
+        :param cildatafiles: CILDataFileTable or iterable of
+                             CILDataFile objects
+        :returns: number of rows written
+        """
+        if isinstance(cildatafiles, CILDataFileTable):
+            table = cildatafiles
+        else:
+            table = CILDataFileTable.from_cildatafiles(cildatafiles)
+        order = sorted(range(len(table)), key=table._ids.__getitem__)
+
+        def take(column):
+            return [column[i] for i in order]
+
+        file_names = take(table._file_names)
+        cdfs = table.get_cildatafiles()
+        name_offsets, name_heap = CILDataFileCatalog._get_offsets_and_heap(
+            (b'' if f is None else f.encode('utf-8')) for f in file_names)
+        data_offsets, data_heap = CILDataFileCatalog._get_offsets_and_heap(
+            json.dumps(cdfs[i].to_dict(),
+                       separators=(',', ':')).encode('utf-8')
+            for i in order)
+        pools = json.dumps({'suffix': table._suffix_pool,
+                            'mime': table._mime_pool},
+                           separators=(',', ':')).encode('utf-8')
+        contents = {
+            'ids': _array_to_le_bytes(array(_INT64_TYPECODE,
+                                            take(table._ids))),
+            'file_sizes': _array_to_le_bytes(array(_INT64_TYPECODE,
+                                                   take(table._file_sizes))),
+            'mime_codes': _array_to_le_bytes(array('I',
+                                                   take(table._mime_codes))),
+            'suffix_codes': bytes(bytearray(take(table._suffix_codes))),
+            'success': bytes(bytearray(take(table._success))),
+            'is_video': bytes(bytearray(take(table._is_video))),
+            'has_raw': bytes(bytearray(take(table._has_raw))),
+            'file_name_null': bytes(bytearray(f is None
+                                              for f in file_names)),
+            'file_name_offsets': _array_to_le_bytes(name_offsets),
+            'data_offsets': _array_to_le_bytes(data_offsets),
+            'pools': pools,
+            'file_name_heap': name_heap,
+            'data_heap': data_heap}
+
+        sections = CILDataFileCatalog.SECTIONS
+        offset = (struct.calcsize(CILDataFileCatalog.HEADER_FORMAT) +
+                  len(sections) *
+                  struct.calcsize(CILDataFileCatalog.SECTION_FORMAT))
+        header = [struct.pack(CILDataFileCatalog.HEADER_FORMAT,
+                              CATALOG_MAGIC, CATALOG_VERSION,
+                              len(sections), len(order))]
+        body = []
+        for name, typecode in sections:
+            # keep sections 8 byte aligned
+            padding = (8 - offset % 8) % 8
+            body.append(b'\x00' * padding)
+            offset += padding
+            header.append(struct.pack(CILDataFileCatalog.SECTION_FORMAT,
+                                      offset, len(contents[name])))
+            body.append(contents[name])
+            offset += len(contents[name])
+
+        def write_catalog(out_file):
+            for chunk in header + body:
+                out_file.write(chunk)
+
+        replace_file_atomically(catalog_file, write_catalog, mode='wb')
+        return len(order)
+
+
+class CILDataFilePredicate(object):
+    """Base class for filters that decide if a single CILDataFile
+       object passes via matches(). Predicates are combined with
+       & (and), | (or) and ~ (not) into a single predicate so a
+       chain of filters is applied in one pass over the CILDataFile
+       objects. When combined, predicates are evaluated in order of
+       increasing COST so cheap in memory checks run before checks
+       that hit the filesystem.
+    """
+    # relative cost of calling matches(), predicates that only look
+    # at CILDataFile values should use CHEAP_COST
+    CHEAP_COST = 1
+    FILESYSTEM_COST = 100
+    COST = CHEAP_COST
+
+    def matches(self, cdf):
+        """Checks if `cdf` passes this predicate
+        :param cdf: CILDataFile object
+        :returns: True if `cdf` passes otherwise False
+        """
+        raise NotImplementedError('subclasses must implement matches()')
+
+    def get_cost(self):
+        """Gets relative cost of calling matches()
+        """
+        return self.COST
+
+    def refresh(self):
+        """Clears any state cached by matches(), called at the start
+           of iter_cildatafiles(), get_cildatafiles() and get_mask()
+        """
+        pass
+
+    def get_cildatafiles(self, cildatafile_list):
+        """Gets CILDataFile objects that pass this predicate
+        :param cildatafile_list: list of CILDataFile objects or
+                                 CILDataFileTable
+        :returns: filtered list of CILDataFile objects or CILDataFileTable
+                  if CILDataFileTable was passed in or None if None was
+                  passed in. An empty list will return an empty list.
+        """
+        if cildatafile_list is None:
+            logger.debug('Received None so returning None')
+            return None
+
+        if isinstance(cildatafile_list, CILDataFileTable):
+            return cildatafile_list.filter(self.get_mask(cildatafile_list))
+
+        return list(self.iter_cildatafiles(cildatafile_list))
+
+    def iter_cildatafiles(self, cildatafiles):
+        """Generator version of get_cildatafiles()
+        :param cildatafiles: iterable of CILDataFile objects
+        """
+        self.refresh()
+        matches = self.matches
+        for cdf in cildatafiles:
+            if matches(cdf):
+                yield cdf
+
+    def get_mask(self, table):
+        """Gets mask of rows in CILDataFileTable `table` that
+           pass this predicate. Subclasses should override this
+           with a column based version where possible
+        """
+        self.refresh()
+        matches = self.matches
+        return bytearray(matches(cdf) for cdf in table.get_cildatafiles())
+
+    def __and__(self, other):
+        return CILDataFileAndPredicate(self, other)
+
+    def __or__(self, other):
+        return CILDataFileOrPredicate(self, other)
+
+    def __invert__(self):
+        return CILDataFileNotPredicate(self)
+
+
+class _CILDataFileCompoundPredicate(CILDataFilePredicate):
+    """Base class for CILDataFileAndPredicate and CILDataFileOrPredicate
+    """
+    def __init__(self, *predicates):
+        """Constructor
+        :param predicates: CILDataFilePredicate objects, nested
+                           predicates of the same type are flattened
+        :raises ValueError: if no predicates are passed in
+        """
+        if len(predicates) == 0:
+            raise ValueError('At least one predicate is required')
+        flat = []
+        for pred in predicates:
+            if type(pred) is type(self):
+                flat.extend(pred.get_predicates())
+            else:
+                flat.append(pred)
+        # sort is stable so equal cost predicates keep their order
+        self._predicates = sorted(flat, key=lambda p: p.get_cost())
+
+    def get_predicates(self):
+        """Gets predicates in order they are evaluated
+        """
+        return list(self._predicates)
+
+    def get_cost(self):
+        return sum(p.get_cost() for p in self._predicates)
+
+    def refresh(self):
+        for pred in self._predicates:
+            pred.refresh()
+
+
+class CILDataFileAndPredicate(_CILDataFileCompoundPredicate):
+    """Predicate that passes CILDataFile objects that pass
+       all of the predicates passed to constructor
+    """
+    def matches(self, cdf):
+        for pred in self._predicates:
+            if not pred.matches(cdf):
+                return False
+        return True
+
+    def get_mask(self, table):
+        mask = self._predicates[0].get_mask(table)
+        for pred in self._predicates[1:]:
+            mask = CILDataFileTable.mask_and(mask, pred.get_mask(table))
+        return mask
+
+
+class CILDataFileOrPredicate(_CILDataFileCompoundPredicate):
+    """Predicate that passes CILDataFile objects that pass
+       any of the predicates passed to constructor
+    """
+    def matches(self, cdf):
+        for pred in self._predicates:
+            if pred.matches(cdf):
+                return True
+        return False
+
+    def get_mask(self, table):
+        mask = self._predicates[0].get_mask(table)
+        for pred in self._predicates[1:]:
+            mask = CILDataFileTable.mask_or(mask, pred.get_mask(table))
+        return mask
+
+
+class CILDataFileNotPredicate(CILDataFilePredicate):
+    """Predicate that passes CILDataFile objects that do not
+       pass the predicate passed to constructor
+    """
+    def __init__(self, predicate):
+        """Constructor
+        :param predicate: CILDataFilePredicate to negate
+        """
+        self._predicate = predicate
+
+    def get_cost(self):
+        return self._predicate.get_cost()
+
+    def refresh(self):
+        self._predicate.refresh()
+
+    def matches(self, cdf):
+        return not self._predicate.matches(cdf)
+
+    def get_mask(self, table):
+        return CILDataFileTable.mask_not(self._predicate.get_mask(table))
+
+
+class CILDataFileFoundInFilesystemFilter(CILDataFilePredicate):
+    """Filter that removes any CILDataFile objects
+       that already exist in the file system.
+
+       The images and videos directories are each listed once and
+       the numeric <ID> directory names kept in memory so no per
+       entry stat calls are needed.
+    """
+    COST = CILDataFilePredicate.FILESYSTEM_COST
+
+    def __init__(self, images_dir, videos_dir, expected_files=None):
+        """
+        COnstructor
+        :param images_dir: Directory where images are stored
+        :param videos_dir: Directory where videos are stored
+        :param expected_files: If set, list of file names that must all
+                               exist within <ID> directory for a
+                               CILDataFile to be considered present.
+                               {id} and {file_name} are replaced with
+                               the id and file name of the CILDataFile
+                               ie ['{id}.json', '{file_name}']
+        :raises ValueError: If either images_dir or videos_dir is None
+        """
+        self._images_dir = images_dir
+        self._videos_dir = videos_dir
+        if self._images_dir is None:
+            raise ValueError('images_dir cannot be None')
+        if self._videos_dir is None:
+            raise ValueError('videos_dir cannot be None')
+        self._expected_files = expected_files
+        self._ids_by_dir = {}
+        self._last_id_dir = None
+        self._last_id_dir_files = None
+
+    def refresh(self):
+        """Clears directory listings so changes to the filesystem
+           made after the first call to matches() are seen
+        """
+        self._ids_by_dir = {}
+        self._last_id_dir = None
+        self._last_id_dir_files = None
+
+    def _get_ids_in_dir(self, base_dir):
+        """Gets set of numeric directory names in `base_dir`
+           listing `base_dir` on first call
+        """
+        ids = self._ids_by_dir.get(base_dir)
+        if ids is not None:
+            return ids
+        ids = set()
+        try:
+            for entry in scandir(base_dir):
+                if entry.name.isdigit() and entry.is_dir():
+                    ids.add(entry.name)
+        except OSError:
+            logger.debug('Unable to list ' + base_dir)
+        logger.debug('Found ' + str(len(ids)) + ' id directories in ' +
+                     base_dir)
+        self._ids_by_dir[base_dir] = ids
+        return ids
+
+    def _get_files_in_id_dir(self, id_dir):
+        """Gets set of names in `id_dir`, the listing of the most
+           recent <ID> directory is kept since CILDataFile objects
+           of an id are usually together
+        """
+        if id_dir != self._last_id_dir:
+            try:
+                self._last_id_dir_files = set(e.name for e in
+                                              scandir(id_dir))
+            except OSError:
+                self._last_id_dir_files = set()
+            self._last_id_dir = id_dir
+        return self._last_id_dir_files
+
+    def _is_id_dir_present(self, base_dir, cdf_id):
+        """Checks if <ID> directory exists in `base_dir`
+        """
+        if cdf_id.isdigit():
+            return cdf_id in self._get_ids_in_dir(base_dir)
+        return os.path.isdir(os.path.join(base_dir, cdf_id))
+
+    def matches(self, cdf):
+        """Checks if `cdf` does NOT have a presence on filesystem
+           where presence means a directory exists and if set in
+           constructor the expected files exist within it
+        """
+        if cdf.get_is_video():
+            base_dir = self._videos_dir
+        else:
+            base_dir = self._images_dir
+
+        cdf_id = str(cdf.get_id())
+        if not self._is_id_dir_present(base_dir, cdf_id):
+            return True
+        if self._expected_files is None:
+            return False
+
+        files = self._get_files_in_id_dir(os.path.join(base_dir, cdf_id))
+        for expected in self._expected_files:
+            if expected.format(id=cdf_id,
+                               file_name=cdf.get_file_name()) not in files:
+                return True
+        return False
+
+
+class CILDataFileNoRawFilter(CILDataFilePredicate):
+    """Filter that removes any CILDataFile image objects
+       that end with .raw, ignoring case, and whose get_has_raw() is
+       set to False
+    """
+    def __init__(self):
+        """
+        COnstructor
+        """
+
+    def matches(self, cdf):
+        """Checks if `cdf` is NOT a .raw image entry with
+           get_has_raw() set to False. The suffix is found with
+           CILDataFileTable.get_suffix() so this agrees with get_mask()
+        """
+        if cdf.get_is_video() is not True:
+            suffix = CILDataFileTable.get_suffix(cdf.get_file_name())
+            if suffix == RAW_SUFFIX:
+                if cdf.get_has_raw() is False:
+                    logger.debug('Skipping entry: ' + cdf.get_file_name())
+                    return False
+        return True
+
+    def get_mask(self, table):
+        """Gets mask of rows in CILDataFileTable `table` that
+           pass this filter
+        """
+        skip_mask = CILDataFileTable.mask_and(
+            table.get_suffix_mask(RAW_SUFFIX),
+            table.get_has_raw_mask(False))
+        not_video_mask = CILDataFileTable.mask_not(
+            table.get_is_video_mask(True))
+        return CILDataFileTable.mask_not(
+            CILDataFileTable.mask_and(skip_mask, not_video_mask))
+
+
+class CILDataFileFailedDownloadFilter(CILDataFilePredicate):
+    """Filter that retreives CILDataFile objects that
+       failed to download. Combine with CILDataFileNoRawFilter to
+       exclude .raw image entries that failed to download with
+       get_has_raw() set to False
+    """
+    def __init__(self):
+        """Constructor"""
+
+    def matches(self, cdf):
+        """Checks if `cdf` did not download successfully
+        """
+        return cdf.get_download_success() is not True
+
+    def get_mask(self, table):
+        """Gets mask of rows in CILDataFileTable `table` that
+           pass this filter
+        """
+        return CILDataFileTable.mask_not(
+            table.get_download_success_mask(True))
+
+
+class CILDataFileSelectPredicate(CILDataFilePredicate):
+    """Predicate that compares a single field of CILDataFile objects
+       to a value. These are created by compile_select() from
+       expressions such as suffix=raw and size>1G.
+
+       Comparisons against fields that are not set (None) only match
+       for = none and != none. get_sql() gives an equivalent SQL
+       expression for CILDataFileCatalogIndex.
+    """
+    OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'in', 'range']
+
+    # field name => (CILDataFile getter, catalog index sql column,
+    #                value type)
+    FIELDS = {'id': ('get_id', 'CAST(image_id AS INTEGER)', 'int'),
+              'suffix': (None, None, 'suffix'),
+              'name': ('get_file_name', 'file_name', 'str'),
+              'mime': ('get_mime_type', 'mime_type', 'str'),
+              'size': ('get_file_size', 'file_size', 'size'),
+              'success': ('get_download_success', 'download_success',
+                          'bool'),
+              'video': ('get_is_video', 'is_video', 'bool'),
+              'hasraw': ('get_has_raw', 'has_raw', 'bool')}
+
+    FIELD_ALIASES = {'file_name': 'name', 'mime_type': 'mime',
+                     'file_size': 'size', 'download_success': 'success',
+                     'is_video': 'video', 'has_raw': 'hasraw'}
+
+    def __init__(self, field, op, value):
+        """Constructor
+        :param field: one of FIELDS or FIELD_ALIASES
+        :param op: one of OPERATORS
+        :param value: value to compare with, list of values for in,
+                      tuple (low, high) inclusive for range
+        :raises ValueError: if `field` or `op` is invalid
+        """
+        field = CILDataFileSelectPredicate.FIELD_ALIASES.get(field, field)
+        if field not in CILDataFileSelectPredicate.FIELDS:
+            raise ValueError('Unknown field: ' + str(field))
+        if op not in CILDataFileSelectPredicate.OPERATORS:
+            raise ValueError('Unknown operator: ' + str(op))
+        self._field = field
+        self._op = op
+        self._value = value
+
+    def get_field(self):
+        return self._field
+
+    def get_op(self):
+        return self._op
+
+    def get_value(self):
+        return self._value
+
+    def _get_cdf_value(self, cdf):
+        """Gets value of field from CILDataFile `cdf`
+        """
+        if self._field == 'suffix':
+            return CILDataFileTable.get_suffix(cdf.get_file_name())
+        val = getattr(cdf, CILDataFileSelectPredicate.FIELDS[
+            self._field][0])()
+        if self._field == 'id' and val is not None:
+            try:
+                return int(val)
+            except ValueError:
+                return None
+        return val
+
+    def _compare(self, val):
+        """Compares `val` with value passed to constructor
+        """
+        if self._op == 'in':
+            return val is not None and val in self._value
+        if self._op == 'range':
+            return (val is not None and
+                    self._value[0] <= val <= self._value[1])
+        if self._value is None:
+            if self._op == '=':
+                return val is None
+            return val is not None
+        if val is None:
+            return False
+        if self._op == '=':
+            return val == self._value
+        if self._op == '!=':
+            return val != self._value
+        if self._op == '<':
+            return val < self._value
+        if self._op == '<=':
+            return val <= self._value
+        if self._op == '>':
+            return val > self._value
+        return val >= self._value
+
+    def matches(self, cdf):
+        return self._compare(self._get_cdf_value(cdf))
+
+    def might_match_id(self, id):
+        """Checks if CILDataFile objects with `id` can match
+        """
+        if self._field != 'id':
+            return True
+        try:
+            return self._compare(int(id))
+        except ValueError:
+            return False
+
+    def _get_table_values(self, table):
+        """Gets values of field for every row of `table`
+        """
+        if self._field == 'id':
+            return table.get_ids()
+        if self._field == 'name':
+            return table.get_file_names()
+        if self._field == 'size':
+            return [None if x == CILDataFileTable.NULL_FILE_SIZE else x
+                    for x in table.get_file_sizes()]
+        if self._field == 'suffix':
+            pool = table._suffix_pool
+            return [pool[x] for x in table._suffix_codes]
+        if self._field == 'mime':
+            pool = table._mime_pool
+            return [pool[x] for x in table._mime_codes]
+        column = {'success': table._success, 'video': table._is_video,
+                  'hasraw': table._has_raw}[self._field]
+        tristate = {CILDataFileTable.TRISTATE_NONE: None,
+                    CILDataFileTable.TRISTATE_FALSE: False,
+                    CILDataFileTable.TRISTATE_TRUE: True}
+        return [tristate[x] for x in column]
+
+    def get_mask(self, table):
+        """Gets mask of rows in CILDataFileTable `table` that
+           pass this predicate
+        """
+        if self._op == '=':
+            if self._field == 'suffix':
+                return table.get_suffix_mask(self._value)
+            if self._field == 'success':
+                return table.get_download_success_mask(self._value)
+            if self._field == 'video':
+                return table.get_is_video_mask(self._value)
+            if self._field == 'hasraw':
+                return table.get_has_raw_mask(self._value)
+        compare = self._compare
+        return bytearray(compare(x) for x in self._get_table_values(table))
+
+    @staticmethod
+    def _escape_like(val):
+        return (val.replace('\\', '\\\\').replace('%', '\\%').
+                replace('_', '\\_'))
+
+    def get_sql(self):
+        """Gets SQL expression for CILDataFileCatalogIndex
+        :returns: tuple (sql, list of parameters, exact) where exact is
+                  False if the expression may match rows that do not
+                  pass matches()
+        """
+        if self._field == 'suffix':
+            # LIKE is a superset of the suffix computed by matches()
+            if self._op == '=' and self._value is not None:
+                return ("lower(file_name) LIKE ? ESCAPE '\\'",
+                        ['%' + self._escape_like(self._value)], False)
+            if self._op == 'in' and None not in self._value:
+                return ('(' + ' OR '.join(["lower(file_name) LIKE ? "
+                                           "ESCAPE '\\'"] *
+                                          len(self._value)) + ')',
+                        ['%' + self._escape_like(v) for v in self._value],
+                        False)
+            return '1', [], False
+
+        column = CILDataFileSelectPredicate.FIELDS[self._field][1]
+        if self._op == 'in':
+            return ('(' + column + ' IS NOT NULL AND ' + column + ' IN (' +
+                    ', '.join(['?'] * len(self._value)) + '))',
+                    list(self._value), True)
+        if self._op == 'range':
+            return ('(' + column + ' IS NOT NULL AND ' + column +
+                    ' BETWEEN ? AND ?)', list(self._value), True)
+        if self._value is None:
+            if self._op == '=':
+                return column + ' IS NULL', [], True
+            return column + ' IS NOT NULL', [], True
+        return ('(' + column + ' IS NOT NULL AND ' + column + ' ' +
+                self._op + ' ?)', [self._value], True)
+
+
+def _get_predicate_sql(predicate):
+    """Gets SQL expression for `predicate` by combining the
+       SQL of CILDataFileSelectPredicate objects within
+    :returns: tuple (sql, list of parameters, exact) where exact is
+              False if the expression may match rows that do not pass
+              `predicate`
+    """
+    if isinstance(predicate, CILDataFileSelectPredicate):
+        return predicate.get_sql()
+    if isinstance(predicate, CILDataFileNotPredicate):
+        sql, params, exact = _get_predicate_sql(predicate._predicate)
+        if not exact:
+            return '1', [], False
+        return 'NOT (' + sql + ')', params, True
+    if isinstance(predicate, (CILDataFileAndPredicate,
+                              CILDataFileOrPredicate)):
+        if isinstance(predicate, CILDataFileAndPredicate):
+            joiner = ' AND '
+        else:
+            joiner = ' OR '
+        sqls = []
+        params = []
+        exact = True
+        for pred in predicate.get_predicates():
+            sql, pred_params, pred_exact = _get_predicate_sql(pred)
+            sqls.append('(' + sql + ')')
+            params.extend(pred_params)
+            exact = exact and pred_exact
+        return joiner.join(sqls), params, exact
+    return '1', [], False
+
+
+def _might_match_id(predicate, id):
+    """Checks if CILDataFile objects with `id` can pass `predicate`
+       without looking at any other field
+    """
+    if isinstance(predicate, CILDataFileSelectPredicate):
+        return predicate.might_match_id(id)
+    if isinstance(predicate, CILDataFileAndPredicate):
+        return all(_might_match_id(p, id) for p in predicate.get_predicates())
+    if isinstance(predicate, CILDataFileOrPredicate):
+        return any(_might_match_id(p, id) for p in predicate.get_predicates())
+    return True
+
+
+# tokens of select expressions, see compile_select()
+_SELECT_TOKEN_RE = re.compile(r"""\s*(?:(?P<string>'[^']*'|"[^"]*")|
+                                     (?P<op>!=|<=|>=|=|<|>|\.\.|\(|\)|,)|
+                                     (?P<word>[^\s=!<>(),'"]+?)
+                                     (?=\.\.|[\s=!<>(),]|$))""",
+                              re.VERBOSE)
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+
+def _tokenize_select(expression):
+    """Splits select `expression` into list of tokens
+    :returns: list of tuples (kind, text) where kind is
+              string, op or word
+    :raises ValueError: if `expression` contains invalid characters
+    """
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _SELECT_TOKEN_RE.match(expression, pos)
+        if match is None:
+            raise ValueError('Invalid select expression at: ' +
+                             expression[pos:].strip())
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+class _SelectParser(object):
+    """Recursive descent parser for select expressions
+    """
+    def __init__(self, expression):
+        self._tokens = _tokenize_select(expression)
+        self._pos = 0
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None, None
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError('Unexpected end of select expression')
+        self._pos += 1
+        return token
+
+    def _peek_keyword(self, keyword):
+        kind, text = self._peek()
+        return kind == 'word' and text.lower() == keyword
+
+    def _expect(self, text):
+        kind, token = self._next()
+        if kind != 'op' or token != text:
+            raise ValueError('Expected ' + text + ' but got ' + token)
+
+    def parse(self):
+        predicate = self._parse_or()
+        kind, text = self._peek()
+        if kind is not None:
+            raise ValueError('Unexpected ' + text + ' in select expression')
+        return predicate
+
+    def _parse_or(self):
+        predicate = self._parse_and()
+        while self._peek_keyword('or'):
+            self._next()
+            predicate = predicate | self._parse_and()
+        return predicate
+
+    def _parse_and(self):
+        predicate = self._parse_not()
+        while self._peek_keyword('and'):
+            self._next()
+            predicate = predicate & self._parse_not()
+        return predicate
+
+    def _parse_not(self):
+        if self._peek_keyword('not'):
+            self._next()
+            return ~self._parse_not()
+        if self._peek() == ('op', '('):
+            self._next()
+            predicate = self._parse_or()
+            self._expect(')')
+            return predicate
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        kind, field = self._next()
+        if kind != 'word':
+            raise ValueError('Expected field name but got ' + field)
+        field = field.lower()
+        field = CILDataFileSelectPredicate.FIELD_ALIASES.get(field, field)
+        if field not in CILDataFileSelectPredicate.FIELDS:
+            raise ValueError('Unknown field: ' + field)
+        value_type = CILDataFileSelectPredicate.FIELDS[field][2]
+
+        if self._peek_keyword('in'):
+            self._next()
+            if self._peek() == ('op', '('):
+                self._next()
+                values = [self._parse_value(value_type)]
+                while self._peek() == ('op', ','):
+                    self._next()
+                    values.append(self._parse_value(value_type))
+                self._expect(')')
+                return CILDataFileSelectPredicate(field, 'in', values)
+            if value_type not in ('int', 'size'):
+                raise ValueError('Range only supported for id and size')
+            low = self._parse_value(value_type)
+            self._expect('..')
+            high = self._parse_value(value_type)
+            return CILDataFileSelectPredicate(field, 'range', (low, high))
+
+        kind, op = self._next()
+        if kind != 'op' or op not in CILDataFileSelectPredicate.OPERATORS:
+            raise ValueError('Expected operator after ' + field +
+                             ' but got ' + op)
+        value = self._parse_value(value_type)
+        if value is None and op not in ('=', '!='):
+            raise ValueError('Only = and != can be used with none')
+        if value_type == 'bool' and op not in ('=', '!='):
+            raise ValueError('Only = and != can be used with ' + field)
+        return CILDataFileSelectPredicate(field, op, value)
+
+    def _parse_value(self, value_type):
+        kind, text = self._next()
+        if kind == 'op':
+            raise ValueError('Expected value but got ' + text)
+        if kind == 'string':
+            text = text[1:-1]
+        elif text.lower() in ('none', 'null'):
+            return None
+
+        if value_type == 'bool':
+            if text.lower() in ('true', 'yes', '1'):
+                return True
+            if text.lower() in ('false', 'no', '0'):
+                return False
+            raise ValueError('Expected true or false but got ' + text)
+        if value_type == 'int':
+            try:
+                return int(text)
+            except ValueError:
+                raise ValueError('Expected integer but got ' + text)
+        if value_type == 'size':
+            return parse_size(text)
+        if value_type == 'suffix':
+            text = text.lower()
+            if not text.startswith('.'):
+                text = '.' + text
+            return text
+        return text
+
+
+def parse_size(size):
+    """Parses `size` with optional K, M, G, or T suffix
+       (powers of 1024) and optional trailing B ie 1.5G or 20KB
+    :returns: size in bytes as int
+    :raises ValueError: if `size` is invalid
+    """
+    val = size.strip().upper()
+    if val.endswith('B'):
+        val = val[:-1]
+    unit = ''
+    if len(val) > 0 and val[-1] in _SIZE_UNITS:
+        unit = val[-1]
+        val = val[:-1]
+    try:
+        return int(float(val) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError('Invalid size: ' + size)
+
+
+def compile_select(expression):
+    """Compiles select `expression` into a CILDataFilePredicate.
+
+       Expressions are comparisons combined with and, or, not and
+       parenthesis ie
+
+       suffix=raw and success=false and size>1G and id in 1000..2000
+
+       Fields are id, suffix, name, mime, size, success, video and
+       hasraw. Operators are =, !=, <, <=, >, >=, in with a range
+       low..high (id and size only) or a list (a, b, c). Values can
+       be quoted with ' or ". none matches fields that are not set.
+       Sizes accept K, M, G, T suffixes.
+    :param expression: select expression
+    :returns: CILDataFilePredicate or None if `expression` is None
+              or empty
+    :raises ValueError: if `expression` is invalid
+    """
+    if expression is None or expression.strip() == '':
+        return None
+    return _SelectParser(expression).parse()
+
+
+def get_batches(iterable, batch_size):
+    """Generator that splits `iterable` into lists of
+       `batch_size` items, the last list may be shorter
+    :param iterable: iterable to split
+    :param batch_size: number of items in each list
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _read_cildatafiles_from_json_files(json_files):
+    """Reads CILDataFile objects from list of `json_files`.
+       This is a module level function so it can be run in
+       a process pool
+    :returns: list of CILDataFile objects
+    """
+    reader = CILDataFileListFromJsonFactory()
+    cdf_list = []
+    for jsonfile in json_files:
+        cdf_list.extend(reader.get_cildatafiles(jsonfile))
+    return cdf_list
+
+
+def _read_cildatafile_dicts_from_json_files(json_files):
+    """Reads CILDataFile objects from list of `json_files` keeping
+       track of the json file each came from. This is a module
+       level function so it can be run in a process pool
+    :returns: list of tuples (json file, list of dicts as returned
+              by CILDataFile.to_dict())
+    """
+    reader = CILDataFileListFromJsonFactory()
+    res = []
+    for jsonfile in json_files:
+        res.append((jsonfile, [cdf.to_dict() for cdf in
+                               reader.get_cildatafiles(jsonfile)]))
+    return res
+
+
+class CILDataFileFromJsonFilesFactory(object):
+    """Generates CILDataFile objects by parsing
+       json files found in directory passed in.
+       If the directory contains a complete CILDataFileCatalogIndex
+       the index is queried instead.
+    """
+    def __init__(self, id=None, use_index=True, discovery_threads=1,
+                 workers=1, chunksize=64, ordered=True, scan_cache=None,
+                 predicate=None):
+        """Constructor
+        :param id: only return CILDataFile objects with matching id.
+        :param use_index: If True and a complete catalog index is found
+                          in directory passed to get_cildatafiles() it is
+                          used instead of parsing json files
+        :param discovery_threads: Number of threads used to look for
+                                  json files within <ID> directories
+        :param workers: Number of processes used to parse json files,
+                        if 1 or less, json files are parsed in this process
+        :param chunksize: Number of json files sent to a worker
+                          process at a time
+        :param ordered: If True CILDataFile objects are returned in the
+                        order the json files were found, otherwise they
+                        are returned as soon as a worker finishes
+        :param scan_cache: CILDataFileScanCache, if set only json files
+                           that changed since they were last cached
+                           are parsed. CILDataFile objects from unchanged
+                           json files are returned first followed by
+                           those from changed json files
+        :param predicate: only return CILDataFile objects that pass this
+                          CILDataFilePredicate ie from compile_select().
+                          <ID> directories that cannot match are skipped
+                          and a catalog index is queried with SQL
+        """
+        self._id = id
+        self._use_index = use_index
+        self._discovery_threads = discovery_threads
+        self._workers = workers
+        self._chunksize = chunksize
+        self._ordered = ordered
+        self._scan_cache = scan_cache
+        self._predicate = predicate
+
+    @staticmethod
+    def _get_id_json_file(id_dir):
+        """Gets <ID>.json file within `id_dir` directory
+        :returns: path to json file or None if not found
+        """
+        jsonfile = os.path.join(id_dir, os.path.basename(id_dir) +
+                                JSON_SUFFIX)
+        if os.path.isfile(jsonfile):
+            return jsonfile
+        return None
+
+    def _get_id_json_files(self, id_dirs):
+        """Generator that yields <ID>.json files found in `id_dirs`
+           list of <ID> directories using a thread pool if
+           more then one discovery thread was requested
+        """
+        if self._discovery_threads <= 1 or len(id_dirs) <= 1:
+            for id_dir in id_dirs:
+                jsonfile = self._get_id_json_file(id_dir)
+                if jsonfile is not None:
+                    yield jsonfile
+            return
+
+        pool = ThreadPool(self._discovery_threads)
+        try:
+            for jsonfile in pool.imap(
+                    CILDataFileFromJsonFilesFactory._get_id_json_file,
+                    id_dirs, chunksize=256):
+                if jsonfile is not None:
+                    yield jsonfile
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_json_files(self, path):
+        """Generator that yields json files found in `path` following
+           layout created by cildatadownloader.py:
+
+           <path>/{images,videos}/<ID>/<ID>.json
+
+           If `path` is a json file it is yielded as is. If `path` is a
+           directory, json files directly within are yielded, numeric
+           <ID> directories are examined for a <ID>.json file and
+           images/ and videos/ directories are examined in the same
+           way. All other directories are skipped as is anything else
+           within <ID> directories ie backups and data files.
+
+           If an id was passed into the constructor only <ID>.json
+           and <ID> directories with matching id are examined.
+        :param path: json file or directory
+        """
+        if path.endswith(JSON_SUFFIX) and os.path.isfile(path):
+            yield path
+            return
+
+        if self._id is not None and os.path.isdir(path):
+            jsonfile = os.path.join(path, self._id + JSON_SUFFIX)
+            if os.path.isfile(jsonfile):
+                yield jsonfile
+            for sub_dir in [path, os.path.join(path, IMAGES_DIR),
+                            os.path.join(path, VIDEOS_DIR)]:
+                jsonfile = self._get_id_json_file(os.path.join(sub_dir,
+                                                               self._id))
+                if jsonfile is not None:
+                    yield jsonfile
+            return
+
+        for jsonfile in self._get_json_files_in_dir(path):
+            yield jsonfile
+
+    def _get_json_files_in_dir(self, path):
+        """Generator that yields json files in directory `path`
+           as described in get_json_files()
+        """
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            return
+
+        id_dirs = []
+        layout_dirs = []
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name.isdigit():
+                    if self._predicate is not None and\
+                            not _might_match_id(self._predicate,
+                                                entry.name):
+                        continue
+                    id_dirs.append(entry.path)
+                elif entry.name == IMAGES_DIR or entry.name == VIDEOS_DIR:
+                    layout_dirs.append(entry.path)
+            elif entry.name.endswith(JSON_SUFFIX) and entry.is_file():
+                yield entry.path
+
+        for jsonfile in self._get_id_json_files(id_dirs):
+            yield jsonfile
+
+        for layout_dir in layout_dirs:
+            for jsonfile in self._get_json_files_in_dir(layout_dir):
+                yield jsonfile
+
+    def get_cildatafiles(self, dir_path):
+        """Gets CILDataFile objects from json files in `dir_path`
+           or from catalog index in `dir_path` if found
+        :param dir_path: directory or json file
+        :returns: list of CILDataFile objects or None if `dir_path`
+                  is None
+        """
+        if dir_path is None:
+            logger.error('None passed in')
+            return None
+
+        return list(self.iter_cildatafiles(dir_path))
+
+    def iter_cildatafiles(self, dir_path):
+        """Generator version of get_cildatafiles() that yields
+           CILDataFile objects as json files are parsed.
+        :param dir_path: directory or json file
+        """
+        if dir_path is None:
+            logger.error('None passed in')
+            return
+
+        if self._use_index is True:
+            index = get_catalog_index(dir_path)
+            if index is not None:
+                try:
+                    if index.is_complete():
+                        logger.debug('Using catalog index in ' + dir_path)
+                        for entry in index.iter_cildatafiles(
+                                id=self._id, predicate=self._predicate):
+                            yield entry
+                        return
+                    logger.warning('Catalog index in ' + dir_path +
+                                   ' is incomplete, ignoring it')
+                finally:
+                    index.close()
+
+        if self._scan_cache is not None:
+            cdfs = self._scan_cache.iter_cildatafiles(
+                self.get_json_files(dir_path), self,
+                prune=self._id is None and self._predicate is None)
+        else:
+            cdfs = itertools.chain.from_iterable(
+                self._read_json_files(self.get_json_files(dir_path)))
+        for entry in cdfs:
+            if self._id is not None and str(entry.get_id()) != self._id:
+                continue
+            if self._predicate is not None and\
+                    not self._predicate.matches(entry):
+                continue
+            yield entry
+
+    def _read_json_files(self, json_files,
+                         read_func=_read_cildatafiles_from_json_files):
+        """Generator that parses `json_files` in batches of chunksize
+           passed to constructor, using a process pool if workers
+           passed to constructor is greater then 1
+        :param read_func: module level function run on each batch
+        :returns: result of `read_func` for each batch, by default
+                  lists of CILDataFile objects
+        """
+        batches = get_batches(json_files, self._chunksize)
+        if self._workers <= 1:
+            for batch in batches:
+                yield read_func(batch)
+            return
+
+        pool = multiprocessing.Pool(self._workers)
+        try:
+            if self._ordered is True:
+                results = pool.imap(read_func, batches)
+            else:
+                results = pool.imap_unordered(read_func, batches)
+            for cdf_list in results:
+                yield cdf_list
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class CILDataFileFromDatabaseFactory(object):
+    """Obtains CILDataFile objects from database
+    """
+    IMG_SUFFIX_LIST = [TIF_SUFFIX, JPG_SUFFIX, RAW_SUFFIX]
+    VID_SUFFIX_LIST = [FLV_SUFFIX, RAW_SUFFIX, JPG_SUFFIX]
+
+    def __init__(self, conn, id=None, skipifrawfalse=False,
+                 skipifprocessedtimeset=False):
+        """Constructor
+        :param conn: database connection already connected
+        :param id: only return CILDataFile objects with matching id.
+        :param skipifrawfalse: Omit the .raw image if has_raw is False
+        """
+        self._conn = conn
+        self._id = id
+        self._skipifrawfalse = skipifrawfalse
+        self._skipifprocessedtimeset = skipifprocessedtimeset
+
+    def get_cildatafiles(self):
+        """Queries database to get CILDataFile objects
+           creating a duplicate entry for each image
+           type (tif, raw, jpg)
+           method also updates status information from status table
+        """
+        return list(self.iter_cildatafiles())
+
+    def iter_cildatafiles(self):
+        """Generator version of get_cildatafiles() that yields
+           CILDataFile objects as rows are read from the database
+        """
+        return self._iter_generated_cildatafiles(
+            self._iter_cildatafiles_from_data_type_table())
+
+    def _generate_cildatafiles_from_database(self, cdflist):
+        """Given a list of CILDataFile objects from the database,
+        which is one CILDataFile per id, generates all the CILDataFile
+        objects which should include multiple CILDataFile objects
+        per id.
+        :param cdflist:
+        :return:
+        """
+        return list(self._iter_generated_cildatafiles(cdflist))
+
+    def _iter_generated_cildatafiles(self, cdfs):
+        """Generator version of _generate_cildatafiles_from_database()
+        :param cdfs: iterable of CILDataFile objects
+        """
+        for cdf in cdfs:
+            if cdf.get_is_video():
+                counter = 0
+                cur_id = cdf.get_id()
+                for suffix in CILDataFileFromDatabaseFactory.VID_SUFFIX_LIST:
+                    if counter is 0:
+                        newcdf = cdf
+                        counter = 1
+                    else:
+                        newcdf = CILDataFile(cur_id)
+                        newcdf.copy(cdf)
+                        newcdf.set_is_video(True)
+
+                    newcdf.set_file_name(str(cur_id) + suffix)
+                    yield newcdf
+            else:
+                counter = 0
+                cur_id = cdf.get_id()
+                for suffix in CILDataFileFromDatabaseFactory.IMG_SUFFIX_LIST:
+                    if self._skipifrawfalse is True and suffix == RAW_SUFFIX:
                         if cdf.get_has_raw() is False:
                             continue
 
@@ -694,8 +3294,7 @@ class CILDataFileFromDatabaseFactory(object):
                         newcdf = CILDataFile(cur_id)
                     newcdf.copy(cdf)
                     newcdf.set_file_name(str(cur_id) + suffix)
-                    newcdflist.append(newcdf)
-        return newcdflist
+                    yield newcdf
 
     def _update_CILDataFileWithStatusFromDatabase(self, cdf):
         """Queries status table with cdf to get any info
@@ -704,7 +3303,11 @@ class CILDataFileFromDatabaseFactory(object):
 
     def _get_cildatafiles_from_data_type_table(self):
         """Queries database to generate CILDataFile objects"""
-        cildatafiles = []
+        return list(self._iter_cildatafiles_from_data_type_table())
+
+    def _iter_cildatafiles_from_data_type_table(self):
+        """Generator version of _get_cildatafiles_from_data_type_table()
+        """
         cursor = self._conn.cursor()
         try:
             if self._id is not None:
@@ -720,37 +3323,53 @@ class CILDataFileFromDatabaseFactory(object):
                            "is_video, has_raw from cil_data_type where is_public=true" +
                            idfilter + processedtimefilter)
 
-            for entry in cursor.fetchall():
+            for entry in cursor:
                 cdf = CILDataFile(entry[0])
                 cdf.set_is_video(bool(entry[1]))
                 cdf.set_has_raw(bool(entry[2]))
 
-                cildatafiles.append(cdf)
+                yield cdf
         finally:
             cursor.close()
             self._conn.commit()
 
-        return cildatafiles
-
 
 class CILDataFileJsonPickleWriter(object):
     """Persists CILDataFile objects to a file using jsonpickle
     """
-    def __init__(self):
+    def __init__(self, header_whitelist=None):
         """Constructor
+        :param header_whitelist: If set, only headers in this list
+                                 are written out, matching is case
+                                 insensitive. If None all headers
+                                 are written
         """
-        pass
+        self._header_whitelist = header_whitelist
+
+    def _get_compacted_cildatafile(self, cdf):
+        """Gets copy of `cdf` with only headers in whitelist
+           passed into constructor or `cdf` if no whitelist was set
+        """
+        if self._header_whitelist is None or cdf.get_headers() is None:
+            return cdf
+        newcdf = CILDataFile(cdf.get_id())
+        newcdf.copy(cdf)
+        newcdf.set_headers(convert_response_headers_to_dict(
+            cdf.get_headers(), whitelist=self._header_whitelist))
+        return newcdf
 
     def writeCILDataFileListToFile(self, outfile,
                                    cildatafile_list,
                                    skipsuffixappend=False):
 
         """Writes CILDataFile objects in list to a file
-           in json format
+           as json without whitespace after separators
         """
         json_cdf_list = []
         for cdf in cildatafile_list:
-            json_cdf_list.append(jsonpickle.encode(cdf))
+            json_cdf_list.append(
+                jsonpickle.encode(self._get_compacted_cildatafile(cdf),
+                                  separators=(',', ':')))
 
         logger.debug('Writing out json file to ' + outfile)
         if skipsuffixappend is False:
@@ -758,9 +3377,10 @@ class CILDataFileJsonPickleWriter(object):
         else:
             full_outfile = outfile
 
-        with open(full_outfile, 'w') as out_file:
-            json.dump(json_cdf_list, out_file)
-            out_file.flush()
+        replace_file_atomically(
+            full_outfile,
+            lambda out_file: json.dump(json_cdf_list, out_file,
+                                       separators=(',', ':')))
 
 
 class CILDataFileListFromJsonPickleFactory(object):
@@ -781,14 +3401,22 @@ class CILDataFileListFromJsonPickleFactory(object):
 
         with open(json_pickle_file, 'r') as in_file:
             data = in_file.read()
-            # this is a hack fix since CaseInsensitiveDict and
-            # OrderedDict objects within the urllib3 package
-            # is not decoding in jsonpickle
-            data = data.replace('requests.packages.urllib3.packages.ordered_dict',
-                                'collections')
-            data = data.replace('requests.structures',
-                                'collections')
-            json_cdf_list = json.loads(data)
+        return self.get_cildatafiles_from_string(data)
+
+    def get_cildatafiles_from_string(self, data):
+        """Gets list of CILDataFile objects from string `data`
+           containing json pickle list of CILDataFile objects
+        :param data: contents of json pickle file
+        :return: list of CILDataFile objects
+        """
+        # this is a hack fix since CaseInsensitiveDict and
+        # OrderedDict objects within the urllib3 package
+        # is not decoding in jsonpickle
+        data = data.replace('requests.packages.urllib3.packages.ordered_dict',
+                            'collections')
+        data = data.replace('requests.structures',
+                            'collections')
+        json_cdf_list = json.loads(data)
 
         cdf_list = []
 
@@ -796,21 +3424,846 @@ class CILDataFileListFromJsonPickleFactory(object):
             tmpcdf = jsonpickle.decode(e)
             cdf = CILDataFile(tmpcdf.get_id())
             cdf.copy(tmpcdf)
+            if isinstance(cdf.get_headers(), dict):
+                cdf.set_headers(
+                    convert_response_headers_to_dict(cdf.get_headers()))
             cdf_list.append(cdf)
         return cdf_list
 
 
+class CILDataFileJsonWriter(object):
+    """Persists CILDataFile objects to a json file as a plain
+       dict with the following structure:
+
+       {"format": "cildatafile", "version": 1,
+        "cildatafiles": [ <CILDataFile.to_dict()>, ... ]}
+
+       Unlike CILDataFileJsonPickleWriter the CILDataFile objects
+       are not encoded as strings within the json document.
+    """
+    def __init__(self, header_whitelist=None, index=None):
+        """Constructor
+        :param header_whitelist: If set, only headers in this list
+                                 are written out, matching is case
+                                 insensitive. If None all headers
+                                 are written
+        :param index: If set, CILDataFileCatalogIndex that is updated
+                      with every file written
+        """
+        self._header_whitelist = header_whitelist
+        self._index = index
+
+    def get_json_dict(self, cildatafile_list):
+        """Gets dict that is written to json file for
+           `cildatafile_list`
+        :param cildatafile_list: list of CILDataFile objects
+        :returns: dict
+        """
+        cdf_dict_list = []
+        for cdf in cildatafile_list:
+            cdf_dict = cdf.to_dict()
+            if self._header_whitelist is not None and\
+                    cdf_dict['headers'] is not None:
+                cdf_dict['headers'] = convert_response_headers_to_dict(
+                    cdf_dict['headers'], whitelist=self._header_whitelist)
+            cdf_dict_list.append(cdf_dict)
+        return {JSON_FORMAT_KEY: JSON_FORMAT_NAME,
+                JSON_VERSION_KEY: JSON_FORMAT_VERSION,
+                JSON_CILDATAFILES_KEY: cdf_dict_list}
+
+    def writeCILDataFileListToFile(self, outfile,
+                                   cildatafile_list,
+                                   skipsuffixappend=False):
+        """Writes CILDataFile objects in list to a file
+           in json format
+        :param outfile: path to output file
+        :param cildatafile_list: list of CILDataFile objects
+        :param skipsuffixappend: If False JSON_SUFFIX is appended
+                                 to `outfile`
+        """
+        logger.debug('Writing out json file to ' + outfile)
+        if skipsuffixappend is False:
+            full_outfile = outfile + JSON_SUFFIX
+        else:
+            full_outfile = outfile
+
+        json_dict = self.get_json_dict(cildatafile_list)
+        replace_file_atomically(
+            full_outfile,
+            lambda out_file: json.dump(json_dict, out_file,
+                                       separators=(',', ':')))
+
+        if self._index is not None:
+            self._index.update_json_file(full_outfile,
+                                         json_dict[JSON_CILDATAFILES_KEY])
+
+
+class CILDataFileListFromJsonFactory(object):
+    """Factory class that creates CILDataFile objects
+       by reading json files written by CILDataFileJsonWriter
+       or legacy json files written by CILDataFileJsonPickleWriter.
+       The format is detected automatically.
+    """
+    def __init__(self):
+        """Constructor
+        """
+        self._legacy_reader = CILDataFileListFromJsonPickleFactory()
+
+    @staticmethod
+    def is_legacy_format(data):
+        """Checks if `data` is in format written by
+           CILDataFileJsonPickleWriter which is a json list
+           whereas CILDataFileJsonWriter writes a json object
+        :param data: contents of json file
+        :returns: True if `data` is legacy json pickle format
+        """
+        return data.lstrip()[:1] == '['
+
+    def get_cildatafiles(self, json_file):
+        """Gets list of CILDataFile objects from json
+           file
+        :param json_file: path to json file
+        :raises ValueError: if json is not in a known format
+        :return: list of CILDataFile objects
+        """
+        with open(json_file, 'r') as in_file:
+            data = in_file.read()
+        return self.get_cildatafiles_from_string(data)
+
+    def get_cildatafiles_from_string(self, data):
+        """Gets list of CILDataFile objects from string
+           `data`
+        :param data: contents of json file
+        :raises ValueError: if json is not in a known format
+        :return: list of CILDataFile objects
+        """
+        if CILDataFileListFromJsonFactory.is_legacy_format(data):
+            return self._legacy_reader.get_cildatafiles_from_string(data)
+
+        json_dict = json.loads(data)
+        if not isinstance(json_dict, dict) or\
+                json_dict.get(JSON_FORMAT_KEY) != JSON_FORMAT_NAME:
+            raise ValueError('Unknown json format')
+
+        version = json_dict.get(JSON_VERSION_KEY)
+        if version != JSON_FORMAT_VERSION:
+            raise ValueError('Unsupported ' + JSON_FORMAT_NAME +
+                             ' json version: ' + str(version))
+
+        cdf_list = []
+        for cdf_dict in json_dict[JSON_CILDATAFILES_KEY]:
+            cdf_list.append(CILDataFile.from_dict(cdf_dict))
+        return cdf_list
+
+
+def get_cildatafile_differences(cdf_a, cdf_b):
+    """Compares every field of two CILDataFile objects
+    :returns: sorted list of names of fields that differ, empty
+              list if they are equal
+    """
+    vals_a = vars(cdf_a)
+    vals_b = vars(cdf_b)
+    return sorted([key for key in set(vals_a.keys()) | set(vals_b.keys())
+                   if vals_a.get(key) != vals_b.get(key)])
+
+
+def migrate_json_file(json_file, keep_legacy=False):
+    """Rewrites legacy json file written by CILDataFileJsonPickleWriter
+       in the format written by CILDataFileJsonWriter. The new
+       contents are read back and every field of every CILDataFile is
+       compared to the legacy contents before `json_file` is atomically
+       replaced. Json files already in the new format are skipped
+       so migration can be rerun after interruption. This is a module
+       level function so it can be run in a process pool.
+    :param json_file: path to json file
+    :param keep_legacy: If True a hard link, or copy if linking fails,
+                        of the legacy json file is kept with
+                        LEGACY_SUFFIX appended to the name
+    :returns: tuple (json file, one of MIGRATE_MIGRATED,
+              MIGRATE_SKIPPED, MIGRATE_FAILED, size of `json_file`
+              in bytes, error message or None)
+    """
+    try:
+        with open(json_file, 'r') as f:
+            data = f.read()
+        if not CILDataFileListFromJsonFactory.is_legacy_format(data):
+            return json_file, MIGRATE_SKIPPED, len(data), None
+
+        reader = CILDataFileListFromJsonFactory()
+        cdf_list = reader.get_cildatafiles_from_string(data)
+        new_data = json.dumps(CILDataFileJsonWriter().get_json_dict(cdf_list),
+                              separators=(',', ':'))
+        new_cdf_list = reader.get_cildatafiles_from_string(new_data)
+        if len(cdf_list) != len(new_cdf_list):
+            return (json_file, MIGRATE_FAILED, len(data),
+                    'Expected ' + str(len(cdf_list)) + ' entries, but got ' +
+                    str(len(new_cdf_list)))
+        for cdf, new_cdf in zip(cdf_list, new_cdf_list):
+            diffs = get_cildatafile_differences(cdf, new_cdf)
+            if len(diffs) > 0:
+                return (json_file, MIGRATE_FAILED, len(data),
+                        'Fields differ for ' + str(cdf.get_file_name()) +
+                        ': ' + ', '.join(diffs))
+
+        if keep_legacy is True:
+            legacy_file = json_file + LEGACY_SUFFIX
+            if not os.path.isfile(legacy_file):
+                try:
+                    os.link(json_file, legacy_file)
+                except OSError:
+                    shutil.copy2(json_file, legacy_file)
+
+        replace_file_atomically(json_file, lambda f: f.write(new_data))
+        return json_file, MIGRATE_MIGRATED, len(data), None
+    except Exception as e:
+        return json_file, MIGRATE_FAILED, 0, str(e)
+
+
+def get_catalog_index(dir_path):
+    """Gets CILDataFileCatalogIndex for download directory `dir_path`
+    :param dir_path: download directory
+    :returns: CILDataFileCatalogIndex or None if `dir_path` does not
+              contain CATALOG_INDEX_FILE
+    """
+    if dir_path is None:
+        return None
+    index_file = os.path.join(dir_path, CATALOG_INDEX_FILE)
+    if not os.path.isfile(index_file):
+        return None
+    return CILDataFileCatalogIndex(index_file)
+
+
+class CILDataFileCatalogIndex(object):
+    """SQLite database that indexes all CILDataFile objects stored
+       in the per ID json files under a download directory. The
+       index is expected to reside at the top of the download directory
+       and json file paths are stored relative to that directory.
+
+       CILDataFileJsonWriter keeps the index in sync when passed
+       an index. The index is only considered complete, see
+       is_complete(), once rebuild() has been run. Json files changed
+       without going through an index aware writer are not noticed,
+       the index must then be rebuilt or bypassed with the --noindex
+       flag of the cildata tools, see README.rst
+    """
+    COMPLETE_KEY = 'complete'
+
+    def __init__(self, index_file):
+        """Constructor
+        :param index_file: path to sqlite database, created if needed
+        """
+        self._index_file = index_file
+        self._base_dir = os.path.dirname(os.path.abspath(index_file))
+        self._conn = None
+
+    def _get_connection(self):
+        """Gets connection to database creating tables if needed
+        """
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self._index_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                           '(key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cildatafile '
+                           '(json_file TEXT NOT NULL, '
+                           'position INTEGER NOT NULL, '
+                           'image_id TEXT, file_name TEXT, '
+                           'is_video INTEGER, download_success INTEGER, '
+                           'file_size INTEGER, mime_type TEXT, '
+                           'has_raw INTEGER, data TEXT NOT NULL, '
+                           'PRIMARY KEY (json_file, position))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cildatafile_image_id '
+                           'ON cildatafile (image_id)')
+        self._conn.commit()
+        return self._conn
+
+    def _get_relative_path(self, json_file):
+        """Gets path of `json_file` relative to directory of index
+        """
+        return os.path.relpath(os.path.abspath(json_file), self._base_dir)
+
+    def _insert(self, conn, json_file, cdf_dict_list):
+        """Inserts `cdf_dict_list` into index for `json_file`
+        """
+        rel_path = self._get_relative_path(json_file)
+        conn.execute('DELETE FROM cildatafile WHERE json_file = ?',
+                     (rel_path,))
+        rows = []
+        for pos, cdf_dict in enumerate(cdf_dict_list):
+            rows.append((rel_path, pos, str(cdf_dict['id']),
+                         cdf_dict['file_name'], cdf_dict['is_video'],
+                         cdf_dict['download_success'],
+                         cdf_dict['file_size'], cdf_dict['mime_type'],
+                         cdf_dict['has_raw'],
+                         json.dumps(cdf_dict, separators=(',', ':'))))
+        conn.executemany('INSERT INTO cildatafile (json_file, position, '
+                         'image_id, file_name, is_video, download_success, '
+                         'file_size, mime_type, has_raw, data) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def update_json_file(self, json_file, cdf_dict_list):
+        """Replaces entries in index for `json_file` with
+           `cdf_dict_list`
+        :param json_file: path to json file
+        :param cdf_dict_list: list of dicts as returned by
+                              CILDataFile.to_dict()
+        """
+        conn = self._get_connection()
+        self._insert(conn, json_file, cdf_dict_list)
+        conn.commit()
+
+    def rebuild(self, dir_path):
+        """Clears index and adds every CILDataFile found in json files
+           under `dir_path` marking the index complete
+        :param dir_path: download directory
+        :returns: number of CILDataFile objects added to index
+        """
+        fac = CILDataFileFromJsonFilesFactory(use_index=False)
+        reader = CILDataFileListFromJsonFactory()
+        conn = self._get_connection()
+        conn.execute('DELETE FROM cildatafile')
+        conn.execute('DELETE FROM meta')
+        count = 0
+        for jsonfile in fac.get_json_files(dir_path):
+            cdf_list = reader.get_cildatafiles(jsonfile)
+            self._insert(conn, jsonfile, [cdf.to_dict() for cdf in cdf_list])
+            count += len(cdf_list)
+        conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)',
+                     (CILDataFileCatalogIndex.COMPLETE_KEY, '1'))
+        conn.commit()
+        return count
+
+    def is_complete(self):
+        """Checks if index has been built via rebuild()
+        :returns: True if complete otherwise False
+        """
+        cursor = self._get_connection().execute(
+            'SELECT value FROM meta WHERE key = ?',
+            (CILDataFileCatalogIndex.COMPLETE_KEY,))
+        row = cursor.fetchone()
+        return row is not None and row[0] == '1'
+
+    def get_json_files(self, id=None):
+        """Gets paths to json files in index
+        :param id: only return json files for this id
+        :returns: list of absolute paths to json files
+        """
+        sql = 'SELECT DISTINCT json_file FROM cildatafile'
+        params = ()
+        if id is not None:
+            sql += ' WHERE image_id = ?'
+            params = (str(id),)
+        sql += ' ORDER BY json_file'
+        return [os.path.join(self._base_dir, row[0]) for row in
+                self._get_connection().execute(sql, params)]
+
+    def get_cildatafiles(self, id=None):
+        """Gets CILDataFile objects in index
+        :param id: only return CILDataFile objects with this id
+        :returns: list of CILDataFile objects ordered by json file
+        """
+        return list(self.iter_cildatafiles(id=id))
+
+    def iter_cildatafiles(self, id=None, page_size=500, predicate=None):
+        """Generator version of get_cildatafiles(). Entries are
+           read a page of `page_size` json files at a time so
+           no read lock is held on the database while entries are
+           being consumed and the index can be updated by the consumer
+        :param id: only return CILDataFile objects with this id
+        :param page_size: number of json files to read at a time
+        :param predicate: only return CILDataFile objects that pass
+                          this CILDataFilePredicate. Predicates from
+                          compile_select() are evaluated in SQL
+        """
+        id_filter = ''
+        params = ()
+        if id is not None:
+            id_filter = ' AND image_id = ?'
+            params = (str(id),)
+        exact = True
+        if predicate is not None:
+            sql, pred_params, exact = _get_predicate_sql(predicate)
+            id_filter += ' AND (' + sql + ')'
+            params += tuple(pred_params)
+
+        conn = self._get_connection()
+        last_json_file = ''
+        while True:
+            json_files = [row[0] for row in conn.execute(
+                'SELECT DISTINCT json_file FROM cildatafile WHERE '
+                'json_file > ?' + id_filter + ' ORDER BY json_file LIMIT ?',
+                (last_json_file,) + params + (page_size,))]
+            if len(json_files) == 0:
+                return
+            rows = conn.execute('SELECT data FROM cildatafile WHERE '
+                                'json_file >= ? AND json_file <= ?' +
+                                id_filter + ' ORDER BY json_file, position',
+                                (json_files[0], json_files[-1]) +
+                                params).fetchall()
+            for row in rows:
+                cdf = CILDataFile.from_dict(json.loads(row[0]))
+                if exact or predicate.matches(cdf):
+                    yield cdf
+            last_json_file = json_files[-1]
+
+    def close(self):
+        """Closes connection to database
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def get_file_stat_key(path):
+    """Gets key that changes whenever file at `path` is modified
+    :param path: path to file
+    :returns: tuple (mtime in nanoseconds, size in bytes, inode) or
+              None if file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns, st.st_size, st.st_ino
+
+
+def get_scan_cache(cache_file):
+    """Gets CILDataFileScanCache for `cache_file`
+    :param cache_file: path to scan cache file, created if needed
+    :returns: CILDataFileScanCache or None if `cache_file` is None
+    """
+    if cache_file is None:
+        return None
+    return CILDataFileScanCache(cache_file)
+
+
+class CILDataFileScanCache(object):
+    """SQLite database that caches CILDataFile objects parsed from
+       json files keyed by json file path and the modification time,
+       size and inode of the json file. Only json files whose key
+       changed since the last scan need to be parsed again.
+       Unlike CILDataFileCatalogIndex the cache does not need to be
+       kept in sync by writers and can reside anywhere.
+    """
+    def __init__(self, cache_file, stat_threads=8):
+        """Constructor
+        :param cache_file: path to sqlite database, created if needed
+        :param stat_threads: number of threads used to stat json files
+        """
+        self._cache_file = cache_file
+        self._stat_threads = stat_threads
+        self._conn = None
+
+    def _get_connection(self):
+        """Gets connection to database creating tables if needed
+        """
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self._cache_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS scan '
+                           '(json_file TEXT PRIMARY KEY, '
+                           'mtime_ns INTEGER NOT NULL, '
+                           'size INTEGER NOT NULL, '
+                           'inode INTEGER NOT NULL, '
+                           'data TEXT NOT NULL)')
+        self._conn.commit()
+        return self._conn
+
+    def get_stat_keys(self, json_files):
+        """Generator that stats `json_files` using a thread pool
+           if more then one stat thread was requested
+        :returns: tuples (absolute path to json file, key from
+                  get_file_stat_key()) in order of `json_files`
+        """
+        json_files = (os.path.abspath(j) for j in json_files)
+        if self._stat_threads <= 1:
+            for jsonfile in json_files:
+                yield jsonfile, get_file_stat_key(jsonfile)
+            return
+
+        pool = ThreadPool(self._stat_threads)
+        try:
+            for res in pool.imap(_get_path_and_stat_key, json_files,
+                                 chunksize=256):
+                yield res
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_cildatafile_dicts(self, json_file, stat_key):
+        """Gets cached entries for `json_file`
+        :param json_file: absolute path to json file
+        :param stat_key: current key of `json_file`
+        :returns: list of dicts as returned by CILDataFile.to_dict()
+                  or None if `json_file` is not cached or has changed
+        """
+        row = self._get_connection().execute(
+            'SELECT mtime_ns, size, inode, data FROM scan '
+            'WHERE json_file = ?', (json_file,)).fetchone()
+        if row is None or tuple(row[0:3]) != tuple(stat_key):
+            return None
+        return json.loads(row[3])
+
+    def update(self, json_file, stat_key, cdf_dict_list):
+        """Caches `cdf_dict_list` for `json_file`, caller must
+           call commit()
+        :param json_file: absolute path to json file
+        :param stat_key: key of `json_file` when it was parsed
+        :param cdf_dict_list: list of dicts as returned by
+                              CILDataFile.to_dict()
+        """
+        self._get_connection().execute(
+            'INSERT OR REPLACE INTO scan (json_file, mtime_ns, size, '
+            'inode, data) VALUES (?, ?, ?, ?, ?)',
+            (json_file, stat_key[0], stat_key[1], stat_key[2],
+             json.dumps(cdf_dict_list, separators=(',', ':'))))
+
+    def prune(self, json_files):
+        """Removes cached entries for json files not in `json_files`,
+           caller must call commit()
+        :param json_files: set of absolute paths to json files to keep
+        """
+        conn = self._get_connection()
+        stale = [(row[0],) for row in
+                 conn.execute('SELECT json_file FROM scan')
+                 if row[0] not in json_files]
+        conn.executemany('DELETE FROM scan WHERE json_file = ?', stale)
+
+    def commit(self):
+        """Commits changes to database
+        """
+        if self._conn is not None:
+            self._conn.commit()
+
+    def iter_cildatafiles(self, json_files, factory, prune=False):
+        """Generator that yields CILDataFile objects from `json_files`.
+           Entries for unchanged json files are read from the cache and
+           yielded first. Changed json files are then parsed via
+           `factory` and their entries cached and yielded.
+        :param json_files: iterable of json files
+        :param factory: CILDataFileFromJsonFilesFactory used to parse
+                        changed json files
+        :param prune: if True remove cached entries for json files
+                      not in `json_files`
+        """
+        seen = set()
+        changed = collections.OrderedDict()
+        for jsonfile, stat_key in self.get_stat_keys(json_files):
+            if stat_key is None:
+                continue
+            seen.add(jsonfile)
+            cdf_dict_list = self.get_cildatafile_dicts(jsonfile, stat_key)
+            if cdf_dict_list is None:
+                changed[jsonfile] = stat_key
+                continue
+            for cdf_dict in cdf_dict_list:
+                yield CILDataFile.from_dict(cdf_dict)
+
+        logger.debug(str(len(seen) - len(changed)) + ' of ' +
+                     str(len(seen)) + ' json files unchanged')
+        for res in factory._read_json_files(
+                list(changed.keys()),
+                read_func=_read_cildatafile_dicts_from_json_files):
+            for jsonfile, cdf_dict_list in res:
+                self.update(jsonfile, changed[jsonfile], cdf_dict_list)
+            self.commit()
+            for jsonfile, cdf_dict_list in res:
+                for cdf_dict in cdf_dict_list:
+                    yield CILDataFile.from_dict(cdf_dict)
+
+        if prune is True:
+            self.prune(seen)
+            self.commit()
+
+    def close(self):
+        """Closes connection to database
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def open_checksum_cache(cache_file, use_xattr=False):
+    """Gets CILDataFileChecksumCache for `cache_file`
+    :param cache_file: path to checksum cache file, created if needed
+    :param use_xattr: if True also store checksums in user extended
+                      attributes of files
+    :returns: CILDataFileChecksumCache or None if `cache_file` is None
+              and `use_xattr` is False
+    """
+    if cache_file is None and use_xattr is False:
+        return None
+    return CILDataFileChecksumCache(cache_file=cache_file,
+                                    use_xattr=use_xattr)
+
+
+class CILDataFileChecksumCache(object):
+    """Caches checksums of files keyed by device, inode, size and
+       modification time of the file, in a SQLite database and/or in
+       user extended attributes of the file. Renaming or hardlinking a
+       file keeps its checksum valid while any write invalidates it,
+       so checksums of unchanged files cost a stat instead of a read.
+       Safe to use from multiple threads and from processes forked
+       after it was created.
+    """
+    def __init__(self, cache_file=None, use_xattr=False):
+        """Constructor
+        :param cache_file: path to sqlite database, created if needed,
+                           or None to not use a database
+        :param use_xattr: if True store checksums in user extended
+                          attributes named CHECKSUM_XATTR_PREFIX +
+                          algorithm, only supported on Linux
+        """
+        self._cache_file = cache_file
+        self._use_xattr = use_xattr and hasattr(os, 'setxattr')
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        """Gets connection to database creating tables if needed. A new
+           connection is made in forked processes
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        self._conn = sqlite3.connect(self._cache_file, timeout=60,
+                                     check_same_thread=False)
+        self._pid = os.getpid()
+        self._conn.execute('CREATE TABLE IF NOT EXISTS checksum '
+                           '(dev INTEGER NOT NULL, '
+                           'inode INTEGER NOT NULL, '
+                           'algorithm TEXT NOT NULL, '
+                           'size INTEGER NOT NULL, '
+                           'mtime_ns INTEGER NOT NULL, '
+                           'checksum TEXT NOT NULL, '
+                           'PRIMARY KEY (dev, inode, algorithm))')
+        self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _get_mtime_ns(st):
+        """Gets modification time in nanoseconds from stat result `st`
+        """
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return mtime_ns
+
+    def get_checksum(self, fname, st=None, algorithm=MD5_ALGORITHM):
+        """Gets cached checksum of `fname`
+        :param fname: path to file
+        :param st: result of os.stat() on `fname`, if None
+                   os.stat() is called
+        :param algorithm: name of checksum algorithm
+        :returns: checksum or None if not cached or file has changed
+        """
+        try:
+            if st is None:
+                st = os.stat(fname)
+        except OSError:
+            return None
+        mtime_ns = self._get_mtime_ns(st)
+        if self._use_xattr is True:
+            try:
+                val = os.getxattr(fname, CHECKSUM_XATTR_PREFIX + algorithm)
+                size, xattr_mtime_ns, checksum = \
+                    val.decode('ascii').split(':')
+                if int(size) == st.st_size and \
+                        int(xattr_mtime_ns) == mtime_ns:
+                    return checksum
+            except (OSError, ValueError, UnicodeDecodeError):
+                pass
+        if self._cache_file is None:
+            return None
+        with self._lock:
+            row = self._get_connection().execute(
+                'SELECT size, mtime_ns, checksum FROM checksum '
+                'WHERE dev = ? AND inode = ? AND algorithm = ?',
+                (st.st_dev, st.st_ino, algorithm)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != mtime_ns:
+            return None
+        return row[2]
+
+    def set_checksum(self, fname, checksum, st=None,
+                     algorithm=MD5_ALGORITHM):
+        """Caches `checksum` of `fname`
+        :param fname: path to file
+        :param checksum: checksum of `fname`
+        :param st: result of os.stat() on `fname` taken before
+                   `checksum` was computed, if None os.stat() is called
+        :param algorithm: name of checksum algorithm
+        """
+        try:
+            if st is None:
+                st = os.stat(fname)
+        except OSError:
+            return
+        mtime_ns = self._get_mtime_ns(st)
+        if self._use_xattr is True:
+            val = str(st.st_size) + ':' + str(mtime_ns) + ':' + checksum
+            try:
+                os.setxattr(fname, CHECKSUM_XATTR_PREFIX + algorithm,
+                            val.encode('ascii'))
+            except OSError as e:
+                logger.debug('Unable to set checksum attribute on ' +
+                             fname + ' : ' + str(e))
+        if self._cache_file is None:
+            return
+        with self._lock:
+            conn = self._get_connection()
+            conn.execute('INSERT OR REPLACE INTO checksum (dev, inode, '
+                         'algorithm, size, mtime_ns, checksum) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (st.st_dev, st.st_ino, algorithm, st.st_size,
+                          mtime_ns, checksum))
+            conn.commit()
+
+    def close(self):
+        """Closes connection to database
+        """
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+def _get_path_and_stat_key(path):
+    """Gets `path` and result of get_file_stat_key() for `path`
+       for use in a thread pool
+    :returns: tuple (path, key)
+    """
+    return path, get_file_stat_key(path)
+
+
+class CILDataFileConvertState(object):
+    """Records progress of CILDataFileConverter on one id in
+       <ID>.convertstate file next to <ID>.json so an interrupted
+       conversion can be resumed. The file is replaced atomically
+       after each step of converting an entry. Once <ID>.json is
+       updated the id is marked done along with the stat key of
+       <ID>.json, letting later runs skip the id until <ID>.json
+       changes.
+    """
+    def __init__(self, cdf_dir, id):
+        """Constructor
+        :param cdf_dir: directory containing <ID>.json
+        :param id: id
+        """
+        self._state_file = os.path.join(cdf_dir,
+                                        str(id) + CONVERT_STATE_SUFFIX)
+        self._state = None
+
+    def get_state_file(self):
+        """Gets path to state file
+        """
+        return self._state_file
+
+    def _load(self):
+        """Loads state file once
+        :returns: dict
+        """
+        if self._state is not None:
+            return self._state
+        self._state = {}
+        if not os.path.isfile(self._state_file):
+            return self._state
+        try:
+            with open(self._state_file, 'r') as f:
+                state = json.load(f)
+            if state.get('version') == CONVERT_STATE_VERSION:
+                self._state = state
+            else:
+                logger.warning('Ignoring ' + self._state_file +
+                               ' with unknown version')
+        except (IOError, OSError, ValueError, AttributeError) as e:
+            logger.warning('Ignoring unreadable ' + self._state_file +
+                           ' : ' + str(e))
+        return self._state
+
+    def _save(self):
+        """Atomically writes state file
+        """
+        self._state['version'] = CONVERT_STATE_VERSION
+        replace_file_atomically(
+            self._state_file,
+            lambda out_file: json.dump(self._state, out_file,
+                                       separators=(',', ':')))
+
+    def is_done(self, jsonfile):
+        """Checks if id was converted and `jsonfile` has not changed
+           since
+        :param jsonfile: path to <ID>.json
+        :returns: True if id can be skipped otherwise False
+        """
+        state = self._load()
+        if state.get('done') is not True:
+            return False
+        stat_key = get_file_stat_key(jsonfile)
+        if stat_key is None:
+            return False
+        return state.get('json_stat_key') == list(stat_key)
+
+    def get_step(self, file_name):
+        """Gets last step finished converting entry `file_name`
+        :param file_name: file name of entry as found in <ID>.json
+        :returns: tuple (step ie CONVERT_STEP_ZIPPED, list of
+                  CILDataFile objects made by step) or (None, None)
+                  if no step finished
+        """
+        entry = self._load().get('entries', {}).get(file_name)
+        if entry is None:
+            return None, None
+        return entry['step'], [CILDataFile.from_dict(cdf_dict) for
+                               cdf_dict in entry['cildatafiles']]
+
+    def set_step(self, file_name, step, cdfs):
+        """Records `step` finished converting entry `file_name`
+        :param file_name: file name of entry as found in <ID>.json
+        :param step: step finished ie CONVERT_STEP_ZIPPED
+        :param cdfs: list of CILDataFile objects made by step
+        """
+        state = self._load()
+        state['done'] = False
+        state.pop('json_stat_key', None)
+        entries = state.setdefault('entries', {})
+        entries[file_name] = {'step': step,
+                              'cildatafiles': [cdf.to_dict() for
+                                               cdf in cdfs]}
+        self._save()
+
+    def set_done(self, jsonfile):
+        """Marks id as converted, dropping state of entries
+        :param jsonfile: path to <ID>.json that was just written
+        """
+        stat_key = get_file_stat_key(jsonfile)
+        self._state = {'done': True,
+                       'json_stat_key': None if stat_key is None
+                       else list(stat_key)}
+        self._save()
+
+
 class CILDataFileConverter(object):
     """Following guidelines set in
     https://github.com/CRBS/cildata_util/wiki
     Instances of this class perform renames and create new CILDataFile
     objects and physical files.
     """
-    def __init__(self):
+    def __init__(self, compresslevel=DEFAULT_COMPRESS_LEVEL,
+                 deflate_threads=1):
         """Constructor
+        :param compresslevel: zlib level 1-9 used to deflate files put
+                              into zip files, 0 stores all files
+        :param deflate_threads: if greater then 1, files of at least
+                                PARALLEL_DEFLATE_MIN_SIZE bytes are
+                                deflated using this many threads
         """
+        self._compresslevel = compresslevel
+        self._deflate_threads = deflate_threads
 
-    def convert(self, cdf, cdf_dir):
+    def convert(self, cdf, cdf_dir, state=None):
         """Converts CILDataFile object and corresponding file
         to appropriate format. This method also creates
         new CILDataFile objects if needed.
@@ -838,6 +4291,11 @@ class CILDataFileConverter(object):
           file. A new CILDataFile object should be created for this
           new file and a new md5 run.
 
+        If `state` is set, each step is recorded and steps already
+        recorded for `cdf` are skipped, resuming an interrupted
+        conversion.
+
+        :param state: CILDataFileConvertState for id of `cdf` or None
         :returns: list of CILDataFile objects
         """
         if cdf is None:
@@ -857,22 +4315,47 @@ class CILDataFileConverter(object):
             raise ValueError('cdf_dir cannot be None')
 
         if cdf.get_is_video() is not True:
-            return self._convert_image(cdf, cdf_dir)
+            return self._convert_image(cdf, cdf_dir, state=state)
+
+        return self._convert_video(cdf, cdf_dir, state=state)
+
+    def _get_step(self, state, file_name):
+        """Gets last step recorded in `state` for `file_name`
+        :returns: tuple (step, list of CILDataFile) or (None, None)
+        """
+        if state is None:
+            return None, None
+        return state.get_step(file_name)
 
-        return self._convert_video(cdf, cdf_dir)
+    def _set_step(self, state, file_name, step, cdfs):
+        """Records `step` in `state` if set
+        """
+        if state is None:
+            return
+        state.set_step(file_name, step, cdfs)
 
-    def _convert_video(self, cdf, cdf_dir):
+    def _convert_video(self, cdf, cdf_dir, state=None):
         """Converts video
         """
         if not cdf.get_file_name().endswith(RAW_SUFFIX):
             return cdf
 
-        # we have a file with .raw ending look at Content-disposition
-        # to get suffix and compare that with mimetype.
-        new_suffix = self._get_raw_video_extension(cdf)
+        raw_file_name = cdf.get_file_name()
+        step, step_cdfs = self._get_step(state, raw_file_name)
+        if step == CONVERT_STEP_ZIPPED:
+            return step_cdfs
 
-        # perform rename and update CILDataFile
-        cdf = self._change_suffix_on_cildatafile(cdf, new_suffix, cdf_dir)
+        if step == CONVERT_STEP_RENAMED:
+            cdf = step_cdfs[0]
+        else:
+            # we have a file with .raw ending look at Content-disposition
+            # to get suffix and compare that with mimetype.
+            new_suffix = self._get_raw_video_extension(cdf, cdf_dir=cdf_dir)
+
+            # perform rename and update CILDataFile
+            cdf = self._change_suffix_on_cildatafile(cdf, new_suffix,
+                                                     cdf_dir)
+            self._set_step(state, raw_file_name, CONVERT_STEP_RENAMED, [cdf])
 
         # create zip with new file in it.
         zipcdf = self._create_zip_file([cdf], cdf_dir)
@@ -880,26 +4363,42 @@ class CILDataFileConverter(object):
         cdf_list = list()
         cdf_list.append(cdf)
         cdf_list.extend(zipcdf)
+        self._set_step(state, raw_file_name, CONVERT_STEP_ZIPPED, cdf_list)
 
         return cdf_list
 
-    def _convert_image(self, cdf, cdf_dir):
+    def _convert_image(self, cdf, cdf_dir, state=None):
         """Converts image
         """
         if not cdf.get_file_name().endswith(RAW_SUFFIX):
             return cdf
         old_file = os.path.join(cdf_dir, cdf.get_file_name())
+        raw_file_name = cdf.get_file_name()
+        step, step_cdfs = self._get_step(state, raw_file_name)
 
-        if not zipfile.is_zipfile(old_file):
-            raise ValueError(old_file + ' is NOT a zip file')
-
-        cdf = self._change_suffix_on_cildatafile(cdf, ZIP_SUFFIX,
-                                                 cdf_dir, makebackup=True)
-
-        extracted_cdfs = self._extract_image_from_zip(cdf, cdf_dir)
-        new_cdf_list = self._create_zip_file(extracted_cdfs,
-                                             cdf_dir)
-        new_cdf_list.extend(extracted_cdfs)
+        if step == CONVERT_STEP_ZIPPED:
+            new_cdf_list = step_cdfs
+        else:
+            zip_file = os.path.join(cdf_dir, str(cdf.get_id()) + ZIP_SUFFIX)
+            try:
+                if step == CONVERT_STEP_EXTRACTED:
+                    extracted_cdfs = step_cdfs
+                else:
+                    extracted_cdfs = self._extract_image_from_raw(cdf,
+                                                                  cdf_dir)
+                    self._set_step(state, raw_file_name,
+                                   CONVERT_STEP_EXTRACTED, extracted_cdfs)
+                new_cdf_list = self._create_zip_file(extracted_cdfs,
+                                                     cdf_dir)
+            except Exception:
+                logger.error('Conversion of ' + old_file + ' failed, '
+                             'removing ' + zip_file)
+                if os.path.isfile(zip_file):
+                    os.unlink(zip_file)
+                raise
+            new_cdf_list.extend(extracted_cdfs)
+            self._set_step(state, raw_file_name, CONVERT_STEP_ZIPPED,
+                           new_cdf_list)
 
         if os.path.isfile(old_file):
             logger.debug('Removing: ' + old_file)
@@ -907,71 +4406,177 @@ class CILDataFileConverter(object):
 
         return new_cdf_list
 
-    def _extract_image_from_zip(self, cdf, cdf_dir):
+    def _extract_image_from_raw(self, cdf, cdf_dir):
+        """Verifies .raw file of CILDataFile `cdf` is a zip file, makes
+           <ID>.zip from it and extracts the files within
+        :raises ValueError: if .raw file is not a zip file
+        :returns: list of CILDataFile objects for extracted files
+        """
+        old_file = os.path.join(cdf_dir, cdf.get_file_name())
+        file_type = sniff_file_type(old_file)
+        if file_type is not None and file_type != FILE_TYPE_ZIP:
+            raise ValueError(old_file + ' is NOT a zip file, contents '
+                                        'look like ' + file_type)
+        try:
+            zf = zipfile.ZipFile(old_file, mode='r', allowZip64=True)
+        except (zipfile.BadZipfile, IOError, OSError):
+            raise ValueError(old_file + ' is NOT a zip file')
+
+        try:
+            cdf = self._change_suffix_on_cildatafile(cdf, ZIP_SUFFIX,
+                                                     cdf_dir,
+                                                     makebackup=True)
+            return self._extract_image_from_zip(cdf, cdf_dir, zf=zf)
+        finally:
+            zf.close()
+
+    def _extract_image_from_zip(self, cdf, cdf_dir, zf=None):
         """Extracts image from zip file specified by CILDataFile `cdf` and
-           renames is <ID>_orig.<suffix of file in zip>
+           renames is <ID>_orig.<suffix of file in zip>. Each file is
+           streamed to a temporary file next to <ID>_orig.<suffix> and
+           renamed once written, computing md5 and size along the way.
+        :param zf: already open zipfile.ZipFile to extract from, if None
+                   zip file is opened and closed by this method
         """
         zip_file = os.path.join(cdf_dir, cdf.get_file_name())
-        zf = zipfile.ZipFile(zip_file, mode='r', allowZip64=True)
-        zipinfo_entries = zf.infolist()
+        if zf is None:
+            with zipfile.ZipFile(zip_file, mode='r', allowZip64=True) as zf:
+                return self._extract_image_from_zip(cdf, cdf_dir, zf=zf)
+
+        zipinfo_entries = [zentry for zentry in zf.infolist()
+                           if not zentry.filename.endswith('/')]
         if len(zipinfo_entries) is 0:
             raise ValueError('Expected at least 1 file in ' + zip_file +
                              ' but found none')
 
-        tmpdir = os.path.join(cdf_dir, 'tmp')
         newcdf_list = []
-        try:
-            os.makedirs(tmpdir, mode=0o755)
-            for zentry in zipinfo_entries:
-
-                extracted_file = zf.extract(zentry, path=tmpdir)
-                suffix = re.sub('^.*\.', '', zentry.filename)
-                suffix = '.' + suffix.lower()
-                new_file_name = str(cdf.get_id()) + ORIG_IDENTIFIER + suffix
-                new_file = os.path.join(cdf_dir, new_file_name)
-                os.rename(extracted_file, new_file)
-                newcdf = CILDataFile(cdf.get_id())
-                newcdf.copy(cdf)
-                newcdf.set_file_name(new_file_name)
-                newcdf.set_localfile(new_file_name)
-                newcdf.set_mime_type(mimetypes.guess_type(new_file_name)[0])
-                newcdf.set_file_size(os.path.getsize(new_file))
-                newcdf.set_checksum(md5(new_file))
-                newcdf_list.append(newcdf)
-            return newcdf_list
-        finally:
-            shutil.rmtree(tmpdir)
+        for zentry in zipinfo_entries:
+            suffix = re.sub('^.*\.', '', zentry.filename)
+            suffix = '.' + suffix.lower()
+            new_file_name = str(cdf.get_id()) + ORIG_IDENTIFIER + suffix
+            new_file = os.path.join(cdf_dir, new_file_name)
+            results = []
+
+            def write_member(out_file):
+                with zf.open(zentry) as in_file:
+                    results.append(copy_stream_with_md5(in_file, out_file))
+
+            logger.debug('Extracting ' + zentry.filename + ' to ' +
+                         new_file)
+            replace_file_atomically(new_file, write_member, mode='wb')
+            checksum, size = results[0]
+            remember_checksum(new_file, checksum)
+            newcdf = CILDataFile(cdf.get_id())
+            newcdf.copy(cdf)
+            newcdf.set_file_name(new_file_name)
+            newcdf.set_localfile(new_file_name)
+            newcdf.set_mime_type(mimetypes.guess_type(new_file_name)[0])
+            newcdf.set_file_size(size)
+            newcdf.set_checksum(checksum)
+            newcdf_list.append(newcdf)
+        return newcdf_list
 
     def _create_zip_file(self, cdf_list, cdf_dir):
         """Takes file specified in get_file_name() and puts it into
         a zip file named <ID>.zip. If file is > 2gb the zip64 extensions
-        will be used.
+        will be used. Files are compressed as determined by
+        get_zip_compress_type() and the md5 and size of the zip file are
+        computed as it is written. If zipfile cannot write to a file that
+        does not seek the zip file is written normally and then read
+        back to compute the md5.
         """
         zip_file_name = str(cdf_list[0].get_id()) + ZIP_SUFFIX
         dest_zip = os.path.join(cdf_dir, zip_file_name)
         logger.debug('Creating zip file: ' + dest_zip)
-
-        zf = zipfile.ZipFile(dest_zip, mode='w', allowZip64=True)
+        results = []
+
+        def write_zip(out_file):
+            hashing_file = None
+            if _ZIPFILE_WRITES_UNSEEKABLE:
+                hashing_file = HashingFileWriter(out_file)
+                out_file = hashing_file
+            zf = zipfile.ZipFile(out_file, mode='w', allowZip64=True)
+            try:
+                for cdf in cdf_list:
+                    vid_file = os.path.join(cdf_dir, cdf.get_file_name())
+                    arcpath = os.path.join(str(cdf.get_id()),
+                                           os.path.basename(vid_file))
+                    self._write_to_zip(zf, vid_file, arcpath)
+            finally:
+                zf.close()
+            if hashing_file is not None:
+                results.append((hashing_file.get_md5(),
+                                hashing_file.get_size()))
+
+        # dest_zip may be a hardlink to the raw file so it is replaced
+        # instead of being truncated and written in place
+        replace_file_atomically(dest_zip, write_zip, mode='wb')
+        if results:
+            checksum, size = results[0]
+            remember_checksum(dest_zip, checksum)
+        else:
+            checksum = md5(dest_zip)
+            size = os.path.getsize(dest_zip)
         newcdf_list = []
-        try:
-            for cdf in cdf_list:
-                vid_file = os.path.join(cdf_dir, cdf.get_file_name())
-                arcpath = os.path.join(str(cdf.get_id()),
-                                       os.path.basename(vid_file))
-                zf.write(vid_file, arcname=arcpath)
-        finally:
-            zf.close()
+        cdf = cdf_list[-1]
         newcdf = CILDataFile(cdf.get_id())
         newcdf.copy(cdf)
         newcdf.set_file_name(zip_file_name)
         newcdf.set_localfile(zip_file_name)
         newcdf.set_mime_type(ZIP_MIMETYPE)
-        newcdf.set_file_size(os.path.getsize(dest_zip))
-        newcdf.set_checksum(md5(dest_zip))
+        newcdf.set_file_size(size)
+        newcdf.set_checksum(checksum)
         newcdf_list.append(newcdf)
 
         return newcdf_list
 
+    def _write_to_zip(self, zf, fname, arcname):
+        """Adds `fname` to open zipfile.ZipFile `zf` as `arcname`
+           compressed as determined by get_zip_compress_type()
+        """
+        if self._compresslevel == 0:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = get_zip_compress_type(fname)
+        logger.debug('Adding ' + fname + ' to zip with compress type ' +
+                     str(compress_type))
+        if compress_type == zipfile.ZIP_STORED:
+            zf.write(fname, arcname=arcname, compress_type=compress_type)
+            return
+        if self._deflate_threads > 1 and \
+                os.path.getsize(fname) >= PARALLEL_DEFLATE_MIN_SIZE and \
+                _can_replace_zip_compressor():
+            self._write_to_zip_in_parallel(zf, fname, arcname)
+            return
+        if _ZIPFILE_HAS_COMPRESSLEVEL:
+            zf.write(fname, arcname=arcname, compress_type=compress_type,
+                     compresslevel=self._compresslevel)
+            return
+        # older zipfile always deflates with zlib default level
+        zf.write(fname, arcname=arcname, compress_type=compress_type)
+
+    def _write_to_zip_in_parallel(self, zf, fname, arcname):
+        """Adds `fname` to open zipfile.ZipFile `zf` as `arcname`
+           deflated by ParallelDeflateCompressor. Only call if
+           _can_replace_zip_compressor() returns True
+        """
+        logger.debug('Deflating ' + fname + ' with ' +
+                     str(self._deflate_threads) + ' threads')
+        zinfo = zipfile.ZipInfo.from_file(fname, arcname=arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        compressor = ParallelDeflateCompressor(
+            self._deflate_threads, level=self._compresslevel,
+            block_size=PARALLEL_DEFLATE_BLOCK_SIZE)
+        try:
+            with open(fname, 'rb') as src:
+                with zf.open(zinfo, mode='w') as dest:
+                    # replaces the zlib compressor zipfile made for this
+                    # member, crc and sizes are still tracked by zipfile
+                    dest._compressor = compressor
+                    shutil.copyfileobj(src, dest, STREAM_BLOCK_SIZE)
+        finally:
+            compressor.close()
+
     def _change_suffix_on_cildatafile(self, cdf, new_suffix, cdf_dir,
                                       makebackup=False):
         """Changes suffix on CILDataFile by renaming and updating
@@ -984,9 +4589,9 @@ class CILDataFileConverter(object):
         old_file = os.path.join(cdf_dir, cdf.get_file_name())
 
         if makebackup is True:
-            logger.debug('Making copy of ' + old_file + ' naming it ' +
-                         new_file)
-            shutil.copy(old_file, new_file)
+            method = link_or_copy_file(old_file, new_file)
+            logger.debug('Made ' + new_file + ' from ' + old_file +
+                         ' using ' + method)
         else:
             logger.debug('Renaming ' + old_file + ' to ' + new_file)
             os.rename(old_file, new_file)
@@ -998,8 +4603,41 @@ class CILDataFileConverter(object):
         newcdf.set_mime_type(mimetypes.guess_type(new_file_name)[0])
         return newcdf
 
-    def _get_raw_video_extension(self, cdf):
-        """hi
+    def _get_raw_video_extension(self, cdf, cdf_dir=None):
+        """Gets suffix for .raw video file. If `cdf_dir` is set the
+           contents of the file are examined with sniff_file_type() and
+           the suffix for the type found is used when it disagrees
+           with the Content-disposition header or the header is missing.
+        :raises ValueError: if file is an HTML page or suffix cannot
+                            be determined
+        """
+        file_type = None
+        if cdf_dir is not None:
+            raw_file = os.path.join(cdf_dir, cdf.get_file_name())
+            file_type = sniff_file_type(raw_file)
+            if file_type == FILE_TYPE_HTML:
+                raise ValueError(raw_file + ' is an HTML page not a video')
+
+        try:
+            newsuffix = self._get_raw_video_extension_from_headers(cdf)
+        except ValueError:
+            if file_type is None:
+                raise
+            logger.info('Using suffix of ' + file_type + ' for ' +
+                        cdf.get_file_name() + ' found by examining file')
+            return FILE_TYPE_SUFFIXES[file_type]
+
+        if file_type is None or \
+                SUFFIX_FILE_TYPES.get(newsuffix) == file_type:
+            return newsuffix
+        logger.warning('For ' + cdf.get_file_name() +
+                       ' content-disposition says file is of type: ' +
+                       newsuffix + ' but file contents are ' + file_type)
+        return FILE_TYPE_SUFFIXES[file_type]
+
+    def _get_raw_video_extension_from_headers(self, cdf):
+        """Gets suffix for .raw video file from Content-disposition
+           header
         """
         if cdf.get_headers() is None:
             raise ValueError('No headers found for ' +
@@ -52,7 +52,8 @@ requirements = [
     "requests",
     "jsonpickle",
     "python-dateutil",
-    "Pillow"
+    "Pillow",
+    "scandir; python_version < '3.5'"
 ]
 
 setup_requirements = [
@@ -106,7 +107,9 @@ setup(
              'cildata_util/cildatareport.py',
              'cildata_util/cildataconverter.py',
              'cildata_util/cildataupdatedb.py',
-             'cildata_util/cildatathumbnailcreator.py'],
+             'cildata_util/cildatamigrate.py',
+             'cildata_util/cildatathumbnailcreator.py',
+             'cildata_util/cildataverify.py'],
     test_suite='tests',
     tests_require=test_requirements,
     setup_requires=setup_requirements,
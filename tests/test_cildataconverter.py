@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `cildata_util` package."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from mock import patch
+
+from cildata_util import cildataconverter
+from cildata_util import dbutil
+
+
+class TestCildataconverter(unittest.TestCase):
+    """Tests for `cildataconverter` package."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_parse_arguments(self):
+        pargs = cildataconverter._parse_arguments('hi', ['adir'])
+        self.assertEqual(pargs.downloaddir, 'adir')
+        self.assertEqual(pargs.loglevel, 'WARNING')
+        self.assertEqual(pargs.keepbackups, None)
+        self.assertEqual(pargs.keepbackupsdays, None)
+        self.assertEqual(pargs.compactbackups, False)
+        self.assertEqual(pargs.ignorestate, False)
+        self.assertEqual(pargs.compresslevel, dbutil.DEFAULT_COMPRESS_LEVEL)
+        self.assertEqual(pargs.noindex, False)
+        self.assertEqual(cildataconverter._get_keep_since(pargs), None)
+
+    def test_main_compactbackups(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            res = cildataconverter.main(['yo', temp_dir, '--compactbackups'])
+            self.assertEqual(res, 1)
+
+            id_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, '1')
+            os.makedirs(id_dir)
+            jsonfile = os.path.join(id_dir, '1' + dbutil.JSON_SUFFIX)
+            with open(jsonfile, 'w') as f:
+                f.write('[]')
+            for i in range(3):
+                dbutil.make_backup_of_json(jsonfile)
+            res = cildataconverter.main(['yo', temp_dir, '--compactbackups',
+                                         '--keepbackups', '1'])
+            self.assertEqual(res, 0)
+            self.assertEqual(dbutil.get_backups_of_json(jsonfile),
+                             [(2, jsonfile + dbutil.BK_TXT + '2')])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _make_raw_image(self, images_dir, cur_id, valid=True):
+        id_dir = os.path.join(images_dir, cur_id)
+        os.makedirs(id_dir)
+        raw_file = os.path.join(id_dir, cur_id + dbutil.RAW_SUFFIX)
+        if valid is True:
+            zf = zipfile.ZipFile(raw_file, mode='w')
+            zf.writestr('image' + cur_id + '.tif', 'data' + cur_id)
+            zf.close()
+        else:
+            with open(raw_file, 'w') as f:
+                f.write('not a zip')
+        cdf = dbutil.CILDataFile(cur_id)
+        cdf.set_file_name(cur_id + dbutil.RAW_SUFFIX)
+        cdf.set_download_success(True)
+        cdf.set_is_video(False)
+        dbutil.CILDataFileJsonWriter().writeCILDataFileListToFile(
+            os.path.join(id_dir, cur_id), [cdf])
+
+    def test_main_convert_with_workers(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            for cur_id in ['1', '2', '3']:
+                self._make_raw_image(images_dir, cur_id)
+            self._make_raw_image(images_dir, '4', valid=False)
+            index = dbutil.CILDataFileCatalogIndex(
+                os.path.join(temp_dir, dbutil.CATALOG_INDEX_FILE))
+            index.rebuild(temp_dir)
+            index.close()
+
+            res = cildataconverter.main(['yo', temp_dir, '--workers', '2'])
+            self.assertEqual(res, 1)
+
+            reader = dbutil.CILDataFileListFromJsonFactory()
+            for cur_id in ['1', '2', '3']:
+                jsonfile = os.path.join(images_dir, cur_id,
+                                        cur_id + dbutil.JSON_SUFFIX)
+                names = [c.get_file_name() for c in
+                         reader.get_cildatafiles(jsonfile)]
+                self.assertEqual(names, [cur_id + dbutil.ZIP_SUFFIX,
+                                         cur_id + '_orig.tif'])
+                self.assertFalse(os.path.isfile(
+                    os.path.join(images_dir, cur_id,
+                                 cur_id + dbutil.RAW_SUFFIX)))
+            jsonfile = os.path.join(images_dir, '4', '4' + dbutil.JSON_SUFFIX)
+            self.assertEqual([c.get_file_name() for c in
+                              reader.get_cildatafiles(jsonfile)],
+                             ['4' + dbutil.RAW_SUFFIX])
+
+            index = dbutil.get_catalog_index(temp_dir)
+            try:
+                names = sorted([c.get_file_name() for c in
+                                index.iter_cildatafiles()])
+            finally:
+                index.close()
+            self.assertEqual(names, ['1.zip', '1_orig.tif', '2.zip',
+                                     '2_orig.tif', '3.zip', '3_orig.tif',
+                                     '4.raw'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_convert_with_workers_and_scancache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            for cur_id in ['1', '2', '3']:
+                self._make_raw_image(images_dir, cur_id)
+            scan_cache = os.path.join(temp_dir, 'sc.sqlite')
+
+            # small batches so ids are read across several batches
+            with patch('cildata_util.cildataconverter.CONVERT_BATCH_SIZE',
+                       2):
+                res = cildataconverter.main(['yo', temp_dir, '--workers',
+                                             '2', '--scancache',
+                                             scan_cache])
+            self.assertEqual(res, 0)
+            self.assertTrue(os.path.isfile(scan_cache))
+            for cur_id in ['1', '2', '3']:
+                self.assertTrue(os.path.isfile(
+                    os.path.join(images_dir, cur_id,
+                                 cur_id + dbutil.ZIP_SUFFIX)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_cildatafiles_of_id_error(self):
+        pargs = cildataconverter._parse_arguments('hi', ['adir'])
+        cdf = dbutil.CILDataFile('5')
+        cdf.set_download_success(True)
+        res = cildataconverter._convert_cildatafiles_of_id(
+            pargs, '/images', '/videos', ('5', [cdf]))
+        self.assertEqual(res, ('5', 0, [],
+                               'For id 5 file name is NOT set'))
+
+    def test_main_skips_converted_ids(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            self._make_raw_image(images_dir, '1')
+            jsonfile = os.path.join(images_dir, '1', '1' + dbutil.JSON_SUFFIX)
+            self.assertEqual(cildataconverter.main(['yo', temp_dir]), 0)
+            self.assertEqual(len(dbutil.get_backups_of_json(jsonfile)), 1)
+            self.assertTrue(os.path.isfile(os.path.join(
+                images_dir, '1', '1' + dbutil.CONVERT_STATE_SUFFIX)))
+
+            # json file is left alone on second run
+            self.assertEqual(cildataconverter.main(['yo', temp_dir]), 0)
+            self.assertEqual(len(dbutil.get_backups_of_json(jsonfile)), 1)
+
+            self.assertEqual(cildataconverter.main(['yo', temp_dir,
+                                                    '--ignorestate']), 0)
+            self.assertEqual(len(dbutil.get_backups_of_json(jsonfile)), 2)
+            reader = dbutil.CILDataFileListFromJsonFactory()
+            self.assertEqual([c.get_file_name() for c in
+                              reader.get_cildatafiles(jsonfile)],
+                             ['1.zip', '1_orig.tif'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_with_checksumcache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            self._make_raw_image(images_dir, '1')
+            cache_file = os.path.join(temp_dir, dbutil.CHECKSUM_CACHE_FILE)
+            self.assertEqual(cildataconverter.main(['yo', temp_dir,
+                                                    '--checksumcache',
+                                                    cache_file]), 0)
+            self.assertEqual(dbutil.get_checksum_cache(), None)
+            cache = dbutil.CILDataFileChecksumCache(cache_file=cache_file)
+            try:
+                for name in ['1.zip', '1_orig.tif']:
+                    path = os.path.join(images_dir, '1', name)
+                    self.assertEqual(cache.get_checksum(path),
+                                     dbutil.md5(path))
+            finally:
+                cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
@@ -4,9 +4,17 @@
 """Tests for `cildata_util` package."""
 
 
+import os
+import shutil
+import tempfile
 import unittest
+from mock import Mock
 
 from cildata_util import cildatadownloader
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonWriter
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
 
 
 class TestCildatadownloader(unittest.TestCase):
@@ -25,7 +33,67 @@ class TestCildatadownloader(unittest.TestCase):
         self.assertEqual(pargs.databaseconf, 'dbconf')
         self.assertEqual(pargs.destdir, 'somedir')
         self.assertEqual(pargs.loglevel, 'WARNING')
+        self.assertEqual(pargs.noindex, False)
+        self.assertEqual(cildatadownloader._get_header_whitelist(pargs),
+                         dbutil.DEFAULT_HEADER_WHITELIST)
+
+    def test_get_header_whitelist(self):
+        pargs = cildatadownloader._parse_arguments('hi', ['dbconf', 'somedir',
+                                                          '--headerwhitelist',
+                                                          'ALL'])
+        self.assertEqual(cildatadownloader._get_header_whitelist(pargs), None)
+        pargs.headerwhitelist = 'Date, ETag,'
+        self.assertEqual(cildatadownloader._get_header_whitelist(pargs),
+                         ['Date', 'ETag'])
+
+    def test_get_expected_files(self):
+        pargs = cildatadownloader._parse_arguments('hi', ['dbconf', 'somedir'])
+        self.assertEqual(cildatadownloader._get_expected_files(pargs), None)
+        pargs.expectedfiles = '{id}.json, {file_name},'
+        self.assertEqual(cildatadownloader._get_expected_files(pargs),
+                         ['{id}.json', '{file_name}'])
 
     def test_main_no_config(self):
         res = cildatadownloader.main(['yo', 'dbconf', 'somedir'])
         self.assertEqual(res, 1)
+
+    def test_retry_download_of_cildatafiles_groups_by_id(self):
+        temp_dir = tempfile.mkdtemp()
+        orig_download = dbutil.download_cil_data_file
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            id_dir = os.path.join(images_dir, '1')
+            os.makedirs(id_dir)
+            cdf_list = []
+            for suffix in [dbutil.RAW_SUFFIX, dbutil.JPG_SUFFIX,
+                           dbutil.TIF_SUFFIX]:
+                cdf = CILDataFile('1')
+                cdf.set_file_name('1' + suffix)
+                cdf.set_download_success(False)
+                cdf_list.append(cdf)
+            writer = CILDataFileJsonWriter()
+            writer.writeCILDataFileListToFile(os.path.join(id_dir, '1'),
+                                              cdf_list)
+
+            def fake_download(base_dir, cdf, **kwargs):
+                newcdf = CILDataFile(cdf.get_id())
+                newcdf.copy(cdf)
+                newcdf.set_download_success(True)
+                return newcdf
+
+            dbutil.download_cil_data_file = Mock(side_effect=fake_download)
+            pargs = cildatadownloader._parse_arguments('hi', ['dbconf',
+                                                              temp_dir])
+            reader = CILDataFileListFromJsonFactory()
+            cildatadownloader._retry_download_of_cildatafiles(
+                pargs, cdf_list[1:], reader, writer, images_dir,
+                os.path.join(temp_dir, dbutil.VIDEOS_DIR), None)
+            self.assertEqual(dbutil.download_cil_data_file.call_count, 2)
+            self.assertEqual(sorted(os.listdir(id_dir)),
+                             ['1.json', '1.json.bk.0', '1.json.bk.index'])
+            res = reader.get_cildatafiles(os.path.join(id_dir, '1.json'))
+            self.assertEqual([c.get_download_success() for c in res],
+                             [False, True, True])
+        finally:
+            dbutil.download_cil_data_file = orig_download
+            shutil.rmtree(temp_dir)
@@ -6,14 +6,22 @@
 import os
 import tempfile
 import shutil
+import sys
 import unittest
 import zipfile
 from mock import Mock
+from mock import patch
 
 from cildata_util import dbutil
 from cildata_util.dbutil import CILDataFile
 from cildata_util.dbutil import CILDataFileConverter
 
+# size of zip holding a 2 byte file, written sequentially zipfile adds a
+# 16 byte data descriptor after the file data
+if dbutil._ZIPFILE_WRITES_UNSEEKABLE:
+    ZIP_SIZE = 138
+else:
+    ZIP_SIZE = 122
 
 class FakeCILDataFile(object):
     """Fake object
@@ -160,10 +168,12 @@ class TestCILDataFileConverter(unittest.TestCase):
             self.assertEqual(newcdf[0].get_file_name(), str(cdf.get_id()) +
                              dbutil.ZIP_SUFFIX)
             self.assertEqual(newcdf[0].get_mime_type(), dbutil.ZIP_MIMETYPE)
-            self.assertEqual(newcdf[0].get_file_size(), 122)
+            self.assertEqual(newcdf[0].get_file_size(), ZIP_SIZE)
             self.assertTrue(newcdf[0].get_checksum(), 'hi')
             zfile = os.path.join(temp_dir, newcdf[0].get_file_name())
             self.assertTrue(os.path.isfile(zfile))
+            self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+            self.assertEqual(os.path.getsize(zfile), ZIP_SIZE)
             zf = zipfile.ZipFile(zfile, mode='r', allowZip64=True)
             self.assertEqual(zf.infolist()[0].filename, '123/123.avi')
         finally:
@@ -184,15 +194,43 @@ class TestCILDataFileConverter(unittest.TestCase):
             self.assertEqual(newcdf[0].get_file_name(), str(cdf.get_id()) +
                              dbutil.ZIP_SUFFIX)
             self.assertEqual(newcdf[0].get_mime_type(), dbutil.ZIP_MIMETYPE)
-            self.assertEqual(newcdf[0].get_file_size(), 122)
+            self.assertEqual(newcdf[0].get_file_size(), ZIP_SIZE)
             self.assertTrue(newcdf[0].get_checksum(), 'hi')
             zfile = os.path.join(temp_dir, newcdf[0].get_file_name())
             self.assertTrue(os.path.isfile(zfile))
+            self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+            self.assertEqual(os.path.getsize(zfile), ZIP_SIZE)
             zf = zipfile.ZipFile(zfile, mode='r', allowZip64=True)
             self.assertEqual(zf.infolist()[0].filename, '123/123.avi')
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_create_zip_file_without_unseekable_zipfile_writes(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            myvid = os.path.join(temp_dir, '123.avi')
+            with open(myvid, 'w') as f:
+                f.write('hi')
+            cdf = CILDataFile(123)
+            cdf.set_file_name('123.avi')
+
+            converter = CILDataFileConverter()
+            with patch('cildata_util.dbutil._ZIPFILE_WRITES_UNSEEKABLE',
+                       False):
+                with patch('cildata_util.dbutil.HashingFileWriter') as mhf:
+                    newcdf = converter._create_zip_file([cdf], temp_dir)
+                    self.assertEqual(mhf.call_count, 0)
+            zfile = os.path.join(temp_dir, newcdf[0].get_file_name())
+            # no data descriptor when headers are updated in place
+            self.assertEqual(newcdf[0].get_file_size(), 122)
+            self.assertEqual(os.path.getsize(zfile), 122)
+            self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+            zf = zipfile.ZipFile(zfile, mode='r', allowZip64=True)
+            self.assertEqual(zf.read('123/123.avi'), b'hi')
+            zf.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_extract_image_from_zip_with_nofiles_inside(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -259,6 +297,12 @@ class TestCILDataFileConverter(unittest.TestCase):
             newcdfs = converter._extract_image_from_zip(cdf, temp_dir)
             self.assertEqual(newcdfs[0].get_file_name(), '123_orig.avi')
             self.assertEqual(newcdfs[0].get_mime_type(), 'video/x-msvideo')
+            self.assertEqual(newcdfs[0].get_file_size(), 2)
+            self.assertEqual(newcdfs[0].get_checksum(),
+                             dbutil.md5(os.path.join(temp_dir,
+                                                     '123_orig.avi')))
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             ['123.AVI', '123.zip', '123_orig.avi'])
         finally:
             shutil.rmtree(temp_dir)
 
@@ -362,3 +406,331 @@ class TestCILDataFileConverter(unittest.TestCase):
             self.assertTrue(os.path.isfile(orig_file))
         finally:
             shutil.rmtree(temp_dir)
+
+    def _write_raw_image(self, temp_dir):
+        src = os.path.join(temp_dir, 'image.tif')
+        with open(src, 'w') as f:
+            f.write('image data')
+        raw = os.path.join(temp_dir, '123' + dbutil.RAW_SUFFIX)
+        zf = zipfile.ZipFile(raw, mode='w')
+        zf.write(src, arcname='image.TIF')
+        zf.close()
+        os.unlink(src)
+        with open(raw, 'rb') as f:
+            raw_data = f.read()
+        cdf = CILDataFile(123)
+        cdf.set_file_name('123' + dbutil.RAW_SUFFIX)
+        return raw, raw_data, cdf
+
+    def test_convert_image_links_raw(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw, raw_data, cdf = self._write_raw_image(temp_dir)
+            converter = CILDataFileConverter()
+            zip_file = os.path.join(temp_dir, '123' + dbutil.ZIP_SUFFIX)
+            orig_extract = converter._extract_image_from_zip
+
+            def check_extract(zcdf, cdf_dir, zf=None):
+                # zip starts out sharing data with the raw file
+                self.assertEqual(os.stat(raw).st_ino,
+                                 os.stat(zip_file).st_ino)
+                self.assertTrue(zf is not None)
+                return orig_extract(zcdf, cdf_dir, zf=zf)
+
+            converter._extract_image_from_zip = check_extract
+            res = converter._convert_image(cdf, temp_dir)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['123.zip', '123_orig.tif'])
+            self.assertFalse(os.path.isfile(raw))
+            zf = zipfile.ZipFile(zip_file, mode='r')
+            self.assertEqual(zf.namelist(), ['123/123_orig.tif'])
+            self.assertEqual(zf.read('123/123_orig.tif'), b'image data')
+            zf.close()
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             ['123.zip', '123_orig.tif'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_image_rolls_back_on_failure(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw, raw_data, cdf = self._write_raw_image(temp_dir)
+            converter = CILDataFileConverter()
+            converter._create_zip_file = Mock(side_effect=IOError('full'))
+            try:
+                converter._convert_image(cdf, temp_dir)
+                self.fail('Expected IOError')
+            except IOError as e:
+                self.assertEqual(str(e), 'full')
+            self.assertFalse(os.path.isfile(os.path.join(temp_dir,
+                                                         '123.zip')))
+            with open(raw, 'rb') as f:
+                self.assertEqual(f.read(), raw_data)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_image_not_a_zip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw = os.path.join(temp_dir, '123' + dbutil.RAW_SUFFIX)
+            cdf = CILDataFile(123)
+            cdf.set_file_name('123' + dbutil.RAW_SUFFIX)
+            converter = CILDataFileConverter()
+            for data in [None, 'not a zip']:
+                if data is not None:
+                    with open(raw, 'w') as f:
+                        f.write(data)
+                try:
+                    converter._convert_image(cdf, temp_dir)
+                    self.fail('Expected ValueError')
+                except ValueError as e:
+                    self.assertEqual(str(e), raw + ' is NOT a zip file')
+            self.assertEqual(os.listdir(temp_dir), ['123.raw'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_create_zip_file_compression_policy(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            data = b'0123456789' * 1000
+            cdfs = []
+            for name in ['123_orig.tif', '123_orig.jpg', '123_orig.mrc']:
+                with open(os.path.join(temp_dir, name), 'wb') as f:
+                    if name.endswith('.tif'):
+                        # uncompressed little endian tiff
+                        f.write(b'II*\x00\x08\x00\x00\x00\x01\x00'
+                                b'\x03\x01\x03\x00\x01\x00\x00\x00'
+                                b'\x01\x00\x00\x00\x00\x00\x00\x00')
+                    f.write(data)
+                cdf = CILDataFile(123)
+                cdf.set_file_name(name)
+                cdfs.append(cdf)
+
+            for level, expected in [(6, [zipfile.ZIP_DEFLATED,
+                                         zipfile.ZIP_STORED,
+                                         zipfile.ZIP_DEFLATED]),
+                                    (0, [zipfile.ZIP_STORED] * 3)]:
+                converter = CILDataFileConverter(compresslevel=level)
+                newcdf = converter._create_zip_file(cdfs, temp_dir)
+                zfile = os.path.join(temp_dir, '123.zip')
+                self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+                self.assertEqual(newcdf[0].get_file_size(),
+                                 os.path.getsize(zfile))
+                zf = zipfile.ZipFile(zfile, mode='r')
+                self.assertEqual([z.compress_type for z in zf.infolist()],
+                                 expected)
+                self.assertEqual(zf.testzip(), None)
+                self.assertEqual(zf.read('123/123_orig.mrc'), data)
+                zf.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _create_zip_file_with_deflate_threads(self, temp_dir,
+                                              replaceable):
+        """Creates 123.zip with 3 deflate threads
+        :param replaceable: value returned by patched
+                            _can_replace_zip_compressor()
+        :returns: tuple (new CILDataFile list, data of 123_orig.mrc,
+                  mock wrapping ParallelDeflateCompressor)
+        """
+        data = b''.join([str(i).encode() for i in range(20000)])
+        with open(os.path.join(temp_dir, '123_orig.mrc'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(temp_dir, '123_orig.dm3'), 'wb') as f:
+            f.write(b'small')
+        cdfs = []
+        for name in ['123_orig.mrc', '123_orig.dm3']:
+            cdf = CILDataFile(123)
+            cdf.set_file_name(name)
+            cdfs.append(cdf)
+        converter = CILDataFileConverter(deflate_threads=3)
+        with patch('cildata_util.dbutil.PARALLEL_DEFLATE_MIN_SIZE', 1000), \
+                patch('cildata_util.dbutil.PARALLEL_DEFLATE_BLOCK_SIZE',
+                      4096), \
+                patch('cildata_util.dbutil._zip_compressor_replaceable',
+                      replaceable), \
+                patch('cildata_util.dbutil.ParallelDeflateCompressor',
+                      wraps=dbutil.ParallelDeflateCompressor) as mock_pdc:
+            newcdf = converter._create_zip_file(cdfs, temp_dir)
+        return newcdf, data, mock_pdc
+
+    def test_can_replace_zip_compressor(self):
+        # zipfile can only open members for writing from Python 3.6
+        expected = sys.version_info >= (3, 6)
+        with patch('cildata_util.dbutil._zip_compressor_replaceable', None):
+            self.assertEqual(dbutil._can_replace_zip_compressor(), expected)
+            self.assertEqual(dbutil._zip_compressor_replaceable, expected)
+
+    def test_create_zip_file_with_deflate_threads_fallback(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            newcdf, data, mock_pdc = \
+                self._create_zip_file_with_deflate_threads(temp_dir, False)
+            self.assertEqual(mock_pdc.call_count, 0)
+            zfile = os.path.join(temp_dir, '123.zip')
+            self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+            with zipfile.ZipFile(zfile, mode='r') as zf:
+                self.assertEqual(zf.testzip(), None)
+                self.assertEqual(zf.read('123/123_orig.mrc'), data)
+                info = zf.getinfo('123/123_orig.mrc')
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipIf(sys.version_info < (3, 6),
+                     'zipfile cannot open members for writing')
+    def test_create_zip_file_with_deflate_threads(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            newcdf, data, mock_pdc = \
+                self._create_zip_file_with_deflate_threads(temp_dir, True)
+            self.assertEqual(mock_pdc.call_count, 1)
+            zfile = os.path.join(temp_dir, '123.zip')
+            self.assertEqual(newcdf[0].get_checksum(), dbutil.md5(zfile))
+            self.assertEqual(newcdf[0].get_file_size(),
+                             os.path.getsize(zfile))
+            zf = zipfile.ZipFile(zfile, mode='r')
+            self.assertEqual(zf.testzip(), None)
+            self.assertEqual(zf.read('123/123_orig.mrc'), data)
+            self.assertEqual(zf.read('123/123_orig.dm3'), b'small')
+            info = zf.getinfo('123/123_orig.mrc')
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(info.file_size, len(data))
+            self.assertTrue(info.compress_size < len(data))
+            zf.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_image_resumes_from_state(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw, raw_data, cdf = self._write_raw_image(temp_dir)
+            cdf.set_download_success(True)
+            state = dbutil.CILDataFileConvertState(temp_dir, 123)
+            converter = CILDataFileConverter()
+            orig_create_zip = converter._create_zip_file
+            converter._create_zip_file = Mock(side_effect=IOError('full'))
+            try:
+                converter.convert(cdf, temp_dir, state=state)
+                self.fail('Expected IOError')
+            except IOError:
+                pass
+            step, cdfs = state.get_step('123.raw')
+            self.assertEqual(step, dbutil.CONVERT_STEP_EXTRACTED)
+            self.assertEqual([c.get_file_name() for c in cdfs],
+                             ['123_orig.tif'])
+
+            # resumes by creating zip from extracted file
+            converter._create_zip_file = orig_create_zip
+            converter._extract_image_from_raw = Mock(
+                side_effect=AssertionError('should not extract'))
+            res = converter.convert(cdf, temp_dir, state=state)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['123.zip', '123_orig.tif'])
+            self.assertFalse(os.path.isfile(raw))
+            step, cdfs = state.get_step('123.raw')
+            self.assertEqual(step, dbutil.CONVERT_STEP_ZIPPED)
+
+            # raw file is gone, recorded result is returned
+            converter._create_zip_file = Mock(
+                side_effect=AssertionError('should not zip'))
+            res = converter.convert(cdf, temp_dir, state=state)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['123.zip', '123_orig.tif'])
+            self.assertEqual(res[0].get_checksum(),
+                             dbutil.md5(os.path.join(temp_dir, '123.zip')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_video_resumes_from_state(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            myvid = os.path.join(temp_dir, '123.raw')
+            with open(myvid, 'w') as f:
+                f.write('hi')
+            cdf = CILDataFile(123)
+            cdf.set_file_name(str(cdf.get_id()) + dbutil.RAW_SUFFIX)
+            cdf.set_is_video(True)
+            cdf.set_download_success(True)
+            cdf.set_headers({dbutil.CONTENT_DISPOSITION:
+                             'attachment; filename=39580.avi'})
+            state = dbutil.CILDataFileConvertState(temp_dir, 123)
+            converter = CILDataFileConverter()
+            orig_create_zip = converter._create_zip_file
+            converter._create_zip_file = Mock(side_effect=IOError('full'))
+            try:
+                converter.convert(cdf, temp_dir, state=state)
+                self.fail('Expected IOError')
+            except IOError:
+                pass
+            self.assertEqual(state.get_step('123.raw')[0],
+                             dbutil.CONVERT_STEP_RENAMED)
+            self.assertFalse(os.path.isfile(myvid))
+
+            converter._create_zip_file = orig_create_zip
+            res = converter.convert(cdf, temp_dir, state=state)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['123.avi', '123.zip'])
+            self.assertEqual(state.get_step('123.raw')[0],
+                             dbutil.CONVERT_STEP_ZIPPED)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_raw_video_extension_sniffs_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            myvid = os.path.join(temp_dir, '123.raw')
+            cdf = CILDataFile(123)
+            cdf.set_file_name('123.raw')
+            converter = CILDataFileConverter()
+
+            # header agrees with contents
+            with open(myvid, 'wb') as f:
+                f.write(b'\x00\x00\x00\x18ftypmp42')
+            cdf.set_headers({dbutil.CONTENT_DISPOSITION:
+                             'attachment; filename=1.M4V'})
+            self.assertEqual(converter._get_raw_video_extension(
+                cdf, cdf_dir=temp_dir), '.m4v')
+
+            # contents win over header
+            with open(myvid, 'wb') as f:
+                f.write(b'FLV\x01\x05')
+            self.assertEqual(converter._get_raw_video_extension(
+                cdf, cdf_dir=temp_dir), '.flv')
+            self.assertEqual(converter._get_raw_video_extension(cdf),
+                             '.m4v')
+
+            # header missing
+            cdf.set_headers(None)
+            self.assertEqual(converter._get_raw_video_extension(
+                cdf, cdf_dir=temp_dir), '.flv')
+
+            with open(myvid, 'wb') as f:
+                f.write(b'<html><body>Not found</body></html>')
+            try:
+                converter._get_raw_video_extension(cdf, cdf_dir=temp_dir)
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertEqual(str(e), myvid +
+                                 ' is an HTML page not a video')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_convert_image_raw_is_html(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw = os.path.join(temp_dir, '123' + dbutil.RAW_SUFFIX)
+            with open(raw, 'w') as f:
+                f.write('<!DOCTYPE html><html></html>')
+            cdf = CILDataFile(123)
+            cdf.set_file_name('123' + dbutil.RAW_SUFFIX)
+            converter = CILDataFileConverter()
+            try:
+                converter._convert_image(cdf, temp_dir)
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertEqual(str(e), raw + ' is NOT a zip file, '
+                                               'contents look like html')
+            self.assertEqual(os.listdir(temp_dir), ['123.raw'])
+        finally:
+            shutil.rmtree(temp_dir)
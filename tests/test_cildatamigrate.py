@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `cildata_util` package."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cildata_util import cildatamigrate
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonPickleWriter
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
+
+
+class TestCildatamigrate(unittest.TestCase):
+    """Tests for `cildatamigrate` package."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_parse_arguments(self):
+        pargs = cildatamigrate._parse_arguments('hi', ['adir'])
+        self.assertEqual(pargs.downloaddir, 'adir')
+        self.assertEqual(pargs.loglevel, 'WARNING')
+        self.assertEqual(pargs.keeplegacy, False)
+        self.assertEqual(pargs.workers, 1)
+
+    def test_get_throughput(self):
+        self.assertEqual(cildatamigrate._get_throughput(10, 2097152, 2),
+                         '5.0 files/sec, 1.00 MB/sec')
+        self.assertTrue('files/sec' in
+                        cildatamigrate._get_throughput(0, 0, 0))
+
+    def test_main_migrates_tree(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonPickleWriter()
+            json_files = []
+            for cur_id in ['1', '2', '3']:
+                id_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, cur_id)
+                os.makedirs(id_dir)
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(cur_id + dbutil.RAW_SUFFIX)
+                cdf.set_headers({'Content-Type': 'application/zip'})
+                writer.writeCILDataFileListToFile(os.path.join(id_dir,
+                                                               cur_id),
+                                                  [cdf])
+                json_files.append(os.path.join(id_dir,
+                                               cur_id + dbutil.JSON_SUFFIX))
+            with open(json_files[0], 'r') as f:
+                legacy_data = f.read()
+
+            res = cildatamigrate.main(['yo', temp_dir, '--keeplegacy',
+                                       '--workers', '2', '--chunksize', '1'])
+            self.assertEqual(res, 0)
+            reader = CILDataFileListFromJsonFactory()
+            for jsonfile in json_files:
+                with open(jsonfile, 'r') as f:
+                    self.assertFalse(reader.is_legacy_format(f.read()))
+                self.assertEqual(len(reader.get_cildatafiles(jsonfile)), 1)
+            with open(json_files[0] + dbutil.LEGACY_SUFFIX, 'r') as f:
+                self.assertEqual(f.read(), legacy_data)
+
+            # rerun skips migrated files
+            res = cildatamigrate.main(['yo', temp_dir])
+            self.assertEqual(res, 0)
+
+            with open(json_files[1], 'w') as f:
+                f.write('[{"bad": ')
+            res = cildatamigrate.main(['yo', temp_dir])
+            self.assertEqual(res, 1)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -4,9 +4,17 @@
 """Tests for `cildata_util` package."""
 
 
+import os
+import shutil
+import tempfile
 import unittest
+from mock import patch
 
 from cildata_util import cildatareport
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonPickleWriter
+from cildata_util.dbutil import CILDataFileJsonWriter
 
 
 class TestCildatareport(unittest.TestCase):
@@ -24,7 +32,104 @@ class TestCildatareport(unittest.TestCase):
 
         self.assertEqual(pargs.downloaddir, 'adir')
         self.assertEqual(pargs.loglevel, 'WARNING')
+        self.assertEqual(pargs.workers, 1)
+        self.assertEqual(pargs.noindex, False)
 
     def test_main_no_config(self):
         res = cildatareport.main(['yo', 'adir'])
         self.assertEqual(res, 0)
+
+    def test_main_with_json_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cdf = CILDataFile(123)
+            cdf.set_file_name('123.jpg')
+            cdf.set_download_success(True)
+            cdf.set_file_size(10)
+            cdf.set_mime_type('image/jpeg')
+            cdf2 = CILDataFile(123)
+            cdf2.set_file_name('123.tif')
+            cdf2.set_download_success(False)
+            writer = CILDataFileJsonPickleWriter()
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '123'),
+                                              [cdf, cdf2])
+            res = cildatareport.main(['yo', temp_dir, '--printfailed'])
+            self.assertEqual(res, 0)
+
+            res = cildatareport.main(['yo', temp_dir, '--workers', '2'])
+            self.assertEqual(res, 0)
+
+            res = cildatareport.main(['yo', temp_dir, '--noindex'])
+            self.assertEqual(res, 0)
+
+            cache_file = os.path.join(temp_dir, dbutil.SCAN_CACHE_FILE)
+            for i in range(2):
+                res = cildatareport.main(['yo', temp_dir, '--scancache',
+                                          cache_file])
+                self.assertEqual(res, 0)
+                self.assertTrue(os.path.isfile(cache_file))
+
+            catalog_file = os.path.join(temp_dir, 'catalog.bin')
+            res = cildatareport.main(['yo', temp_dir, '--exportcatalog',
+                                      catalog_file])
+            self.assertEqual(res, 0)
+            self.assertTrue(os.path.isfile(catalog_file))
+            res = cildatareport.main(['yo', temp_dir, '--catalog',
+                                      catalog_file, '--printfailed'])
+            self.assertEqual(res, 0)
+
+            res = cildatareport.main(['yo', temp_dir, '--rebuildindex'])
+            self.assertEqual(res, 0)
+            self.assertTrue(os.path.isfile(os.path.join(
+                temp_dir, dbutil.CATALOG_INDEX_FILE)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_with_sniff(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, '1')
+            videos_dir = os.path.join(temp_dir, dbutil.VIDEOS_DIR, '2')
+            cdfs = []
+            for cur_dir, name, data, is_video in [
+                    (images_dir, '1.raw', b'PK\x03\x04', False),
+                    (images_dir, '1.jpg', b'<html>error</html>', False),
+                    (images_dir, '1.tif', b'hello', False),
+                    (images_dir, '1.zip', None, False),
+                    (videos_dir, '2.raw', b'FLV\x01', True),
+                    (videos_dir, '2.flv', b'\x00\x00\x00\x18ftypmp42',
+                     True)]:
+                if not os.path.isdir(cur_dir):
+                    os.makedirs(cur_dir)
+                if data is not None:
+                    with open(os.path.join(cur_dir, name), 'wb') as f:
+                        f.write(data)
+                cdf = CILDataFile(os.path.basename(cur_dir))
+                cdf.set_file_name(name)
+                cdf.set_is_video(is_video)
+                cdf.set_download_success(True)
+                cdfs.append(cdf)
+            writer.writeCILDataFileListToFile(os.path.join(images_dir, '1'),
+                                              cdfs[:4])
+            writer.writeCILDataFileListToFile(os.path.join(videos_dir, '2'),
+                                              cdfs[4:])
+            with patch('sys.stdout') as stdout:
+                res = cildatareport.main(['yo', temp_dir, '--sniff',
+                                          '--printfailed', '--workers',
+                                          '2'])
+            self.assertEqual(res, 0)
+            out = ''.join([c[0][0] for c in stdout.write.call_args_list])
+            self.assertTrue('\tflv ==> 1\n' in out)
+            self.assertTrue('\thtml ==> 1\n' in out)
+            self.assertTrue('\tmissing ==> 1\n' in out)
+            self.assertTrue('\tmp4 ==> 1\n' in out)
+            self.assertTrue('\tNone ==> 1\n' in out)
+            self.assertTrue('\tzip ==> 1\n' in out)
+            self.assertTrue('do not match suffix: 2\n' in out)
+            self.assertTrue('\t' + os.path.join(images_dir, '1.jpg') +
+                            ' ==> html\n' in out)
+            self.assertTrue('\t' + os.path.join(videos_dir, '2.flv') +
+                            ' ==> mp4\n' in out)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -10,6 +10,9 @@ import unittest
 
 from PIL import Image
 from cildata_util import cildatathumbnailcreator
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonWriter
 
 
 class TestCILDataThumbnailCreator(unittest.TestCase):
@@ -31,6 +34,7 @@ class TestCILDataThumbnailCreator(unittest.TestCase):
         self.assertEqual(res.sizes, '88,140,220,512')
         self.assertEqual(res.suffix, '.jpg')
         self.assertEqual(res.overwrite, False)
+        self.assertEqual(res.noindex, False)
 
         res = cildatathumbnailcreator._parse_arguments('hi', ['download',
                                                               'dest',
@@ -212,6 +216,49 @@ class TestCILDataThumbnailCreator(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_get_selected_ids(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(cildatathumbnailcreator._get_selected_ids(
+                temp_dir, None), None)
+            writer = CILDataFileJsonWriter()
+            for cur_id in ['1', '2', '3']:
+                id_dir = os.path.join(temp_dir, cur_id)
+                os.makedirs(id_dir)
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(cur_id + '.jpg')
+                cdf.set_is_video(cur_id == '3')
+                writer.writeCILDataFileListToFile(os.path.join(id_dir,
+                                                               cur_id),
+                                                  [cdf])
+            res = cildatathumbnailcreator._get_selected_ids(temp_dir,
+                                                            'video=false')
+            self.assertEqual(res, set(['1', '2']))
+            res = cildatathumbnailcreator._get_selected_ids(temp_dir,
+                                                            'id>5')
+            self.assertEqual(res, set())
+
+            # json file written without index is only seen with noindex
+            index = dbutil.CILDataFileCatalogIndex(
+                os.path.join(temp_dir, dbutil.CATALOG_INDEX_FILE))
+            index.rebuild(temp_dir)
+            index.close()
+            id_dir = os.path.join(temp_dir, '4')
+            os.makedirs(id_dir)
+            cdf = CILDataFile('4')
+            cdf.set_file_name('4.jpg')
+            cdf.set_is_video(False)
+            writer.writeCILDataFileListToFile(os.path.join(id_dir, '4'),
+                                              [cdf])
+            res = cildatathumbnailcreator._get_selected_ids(temp_dir,
+                                                            'video=false')
+            self.assertEqual(res, set(['1', '2']))
+            res = cildatathumbnailcreator._get_selected_ids(
+                temp_dir, 'video=false', use_index=False)
+            self.assertEqual(res, set(['1', '2', '4']))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_create_thumbnails_for_entries_in_subdirs(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `cildata_util` package."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from mock import patch
+
+from cildata_util import cildataverify
+from cildata_util import dbutil
+from cildata_util.dbutil import CILDataFile
+from cildata_util.dbutil import CILDataFileJsonWriter
+
+
+class TestCildataverify(unittest.TestCase):
+    """Tests for `cildataverify` script."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def _add_entry(self, id_dir, cur_id, file_name, data, is_video=False):
+        """Writes `data` to `file_name` in `id_dir` returning a
+           CILDataFile describing it
+        """
+        with open(os.path.join(id_dir, file_name), 'wb') as f:
+            f.write(data)
+        cdf = CILDataFile(cur_id)
+        cdf.set_file_name(file_name)
+        cdf.set_localfile(file_name)
+        cdf.set_is_video(is_video)
+        cdf.set_download_success(True)
+        cdf.set_file_size(len(data))
+        cdf.set_checksum(dbutil.md5(os.path.join(id_dir, file_name)))
+        return cdf
+
+    def _make_tree(self, temp_dir, corrupt_zip=False):
+        """Creates images/123 directory with valid files of each kind
+        :param corrupt_zip: if True last compressed byte of 123.zip
+                            is flipped before its checksum is recorded
+        :returns: path to images/123 directory
+        """
+        id_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, '123')
+        os.makedirs(id_dir)
+        zip_file = os.path.join(temp_dir, 'tmp.zip')
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('123/123_orig.tif', b'x' * 1000)
+        with zipfile.ZipFile(zip_file) as zf:
+            info = zf.infolist()[0]
+        with open(zip_file, 'rb') as f:
+            zip_data = bytearray(f.read())
+        os.remove(zip_file)
+        if corrupt_zip is True:
+            zip_data[info.header_offset + 30 + len(info.filename) +
+                     len(info.extra) + info.compress_size - 1] ^= 0xff
+        zip_data = bytes(zip_data)
+
+        cdfs = [self._add_entry(id_dir, '123', '123.jpg', b'jpg'),
+                self._add_entry(id_dir, '123', '123.tif', b'tif'),
+                self._add_entry(id_dir, '123', '123.png', b'png'),
+                self._add_entry(id_dir, '123', '123.zip', zip_data)]
+        failed = CILDataFile('123')
+        failed.set_file_name('123.raw')
+        failed.set_download_success(False)
+        cdfs.append(failed)
+        writer = CILDataFileJsonWriter()
+        writer.writeCILDataFileListToFile(os.path.join(id_dir, '123'), cdfs)
+        return id_dir
+
+    def _run_main(self, args):
+        """Runs main() returning exit code and output
+        """
+        with patch('sys.stdout') as stdout:
+            res = cildataverify.main(['yo'] + args)
+        out = ''.join([c[0][0] for c in stdout.write.call_args_list])
+        return res, out
+
+    def test_parse_arguments(self):
+        pargs = cildataverify._parse_arguments('hi', ['adir'])
+        self.assertEqual(pargs.downloaddir, 'adir')
+        self.assertEqual(pargs.loglevel, 'WARNING')
+        self.assertEqual(pargs.workers, 1)
+        self.assertEqual(pargs.useprocesses, False)
+        self.assertEqual(pargs.maxmbpersec, None)
+        self.assertEqual(pargs.sample, None)
+        self.assertEqual(pargs.statefile, None)
+        self.assertEqual(pargs.noindex, False)
+
+    def test_main_all_ok(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._make_tree(temp_dir)
+            res, out = self._run_main([temp_dir, '--workers', '2',
+                                       '--maxmbpersec', '100'])
+            self.assertEqual(res, 0)
+            self.assertTrue('Number files verified: 4\n' in out)
+            self.assertTrue('\tok ==> 4\n' in out)
+
+            res, out = self._run_main([temp_dir, '--workers', '2',
+                                       '--useprocesses',
+                                       '--maxmbpersec', '100'])
+            self.assertEqual(res, 0)
+            self.assertTrue('\tok ==> 4\n' in out)
+
+            res, out = self._run_main([temp_dir, '--sample', '2'])
+            self.assertEqual(res, 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_with_problems(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            id_dir = self._make_tree(temp_dir, corrupt_zip=True)
+            os.remove(os.path.join(id_dir, '123.jpg'))
+            with open(os.path.join(id_dir, '123.tif'), 'wb') as f:
+                f.write(b'tiff')
+            with open(os.path.join(id_dir, '123.png'), 'wb') as f:
+                f.write(b'PNG')
+            zip_file = os.path.join(id_dir, '123.zip')
+            open(os.path.join(id_dir, 'extra.txt'), 'w').close()
+
+            res, out = self._run_main([temp_dir])
+            self.assertEqual(res, 1)
+            self.assertTrue('missing ==> ' +
+                            os.path.join(id_dir, '123.jpg') in out)
+            self.assertTrue('size mismatch ==> ' +
+                            os.path.join(id_dir, '123.tif') +
+                            ' (expected 3 found 4)' in out)
+            self.assertTrue('checksum mismatch ==> ' +
+                            os.path.join(id_dir, '123.png') in out)
+            self.assertTrue('bad zip ==> ' + zip_file +
+                            ' (123/123_orig.tif : ' in out)
+            self.assertTrue('extra ==> ' +
+                            os.path.join(id_dir, 'extra.txt') + '\n' in out)
+            self.assertFalse('123.json' in out)
+
+            # extra files are not looked for when sampling
+            res, out = self._run_main([temp_dir, '--sample', '1',
+                                       '--seed', '1'])
+            self.assertEqual(res, 1)
+            self.assertFalse('extra' in out)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_with_statefile(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            id_dir = self._make_tree(temp_dir)
+            state_file = os.path.join(temp_dir, 'verify.sqlite')
+            data_file = os.path.join(id_dir, '123.jpg')
+
+            # simulate previous interrupted run that found a problem
+            state = cildataverify._VerifyState(state_file)
+            state.add_result(data_file, cildataverify.VERIFY_MISSING, None)
+            state.close()
+            with patch('cildata_util.cildataverify._verify_file',
+                       wraps=cildataverify._verify_file) as mock_verify:
+                res, out = self._run_main([temp_dir, '--statefile',
+                                           state_file])
+                self.assertEqual(mock_verify.call_count, 3)
+            self.assertEqual(res, 1)
+            self.assertTrue('missing ==> ' + data_file in out)
+            self.assertFalse(os.path.isfile(state_file))
+
+            # state file removed so next run verifies everything
+            res, out = self._run_main([temp_dir, '--statefile',
+                                       state_file])
+            self.assertEqual(res, 0)
+            self.assertFalse(os.path.isfile(state_file))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_verify_file_and_test_zip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            notzip = os.path.join(temp_dir, '5.raw')
+            with open(notzip, 'wb') as f:
+                f.write(b'hello')
+            res = cildataverify._verify_file((notzip, 5, None, True))
+            self.assertEqual(res[1], cildataverify.VERIFY_BAD_ZIP)
+
+            res = cildataverify._verify_file((notzip, None, None, False))
+            self.assertEqual(res, (notzip, cildataverify.VERIFY_OK, None))
+
+            with patch('cildata_util.dbutil.hash_file',
+                       side_effect=IOError('bad disk')):
+                res = cildataverify._verify_file((notzip, 5, 'x', False))
+            self.assertEqual(res, (notzip, cildataverify.VERIFY_ERROR,
+                                   'bad disk'))
+
+            self.assertEqual(cildataverify._is_zip_file(notzip, False), True)
+            self.assertEqual(cildataverify._is_zip_file(notzip, True), False)
+            self.assertEqual(cildataverify._is_zip_file('5.zip', True), True)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_io_throttle(self):
+        with self.assertRaises(ValueError):
+            dbutil.IOThrottle(0)
+        throttle = dbutil.IOThrottle(1000)
+        self.assertEqual(throttle.get_bytes_per_sec(), 1000.0)
+        with patch('time.sleep') as mock_sleep:
+            throttle.consume(500)
+        self.assertTrue(mock_sleep.call_args[0][0] > 0.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
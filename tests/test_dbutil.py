@@ -3,11 +3,19 @@
 
 """Tests for `cildata_util` package."""
 
+import hashlib
+import io
 import os
+import random
 import tempfile
 import shutil
+import sqlite3
 import unittest
+import zipfile
+import zlib
+from array import array
 from mock import Mock
+from mock import patch
 
 from cildata_util import dbutil
 from cildata_util.dbutil import Database
@@ -19,6 +27,19 @@ from cildata_util.dbutil import CILDataFileFoundInFilesystemFilter
 from cildata_util.dbutil import CILDataFileNoRawFilter
 from cildata_util.dbutil import CILDataFileFromJsonFilesFactory
 from cildata_util.dbutil import CILDataFileFailedDownloadFilter
+from cildata_util.dbutil import CILDataFileTable
+from cildata_util.dbutil import CILDataFileJsonWriter
+from cildata_util.dbutil import CILDataFileListFromJsonFactory
+from cildata_util.dbutil import CILDataFileCatalogIndex
+from cildata_util.dbutil import CILDataFileScanCache
+from cildata_util.dbutil import CILDataFileCatalog
+from cildata_util.dbutil import CILDataFilePredicate
+from cildata_util.dbutil import CILDataFileAndPredicate
+from cildata_util.dbutil import CILDataFileOrPredicate
+from cildata_util.dbutil import CILDataFileNotPredicate
+from cildata_util.dbutil import CILDataFileSelectPredicate
+from cildata_util.dbutil import CILDataFileConvertState
+from cildata_util.dbutil import CILDataFileChecksumCache
 
 
 class FakeCILDataFile(object):
@@ -47,6 +68,217 @@ class TestDbutil(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_replace_file_atomically(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            somefile = os.path.join(temp_dir, 'somefile.json')
+            dbutil.replace_file_atomically(somefile,
+                                           lambda f: f.write('hi\n'))
+            with open(somefile, 'r') as f:
+                self.assertEqual(f.read(), 'hi\n')
+            self.assertEqual(os.stat(somefile).st_mode & 0o777,
+                             dbutil.DEFAULT_FILE_MODE)
+
+            def fail_write(f):
+                f.write('partial')
+                raise IOError('disk full')
+
+            try:
+                dbutil.replace_file_atomically(somefile, fail_write)
+                self.fail('Expected IOError')
+            except IOError as e:
+                self.assertEqual(str(e), 'disk full')
+            with open(somefile, 'r') as f:
+                self.assertEqual(f.read(), 'hi\n')
+            self.assertEqual(os.listdir(temp_dir), ['somefile.json'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_copy_stream_with_md5(self):
+        out_file = io.BytesIO()
+        res = dbutil.copy_stream_with_md5(io.BytesIO(b'hello world'),
+                                          out_file, block_size=3)
+        self.assertEqual(res, ('5eb63bbbe01eeed093cb22bb8f5acdc3', 11))
+        self.assertEqual(out_file.getvalue(), b'hello world')
+        res = dbutil.copy_stream_with_md5(io.BytesIO(), io.BytesIO())
+        self.assertEqual(res, ('d41d8cd98f00b204e9800998ecf8427e', 0))
+
+    def test_get_tiff_compression_and_zip_compress_type(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tiffs = {
+                # little endian classic tiff, SHORT compression tag = 5
+                'lzw.tif': (b'II*\x00\x08\x00\x00\x00\x01\x00'
+                            b'\x03\x01\x03\x00\x01\x00\x00\x00'
+                            b'\x05\x00\x00\x00\x00\x00\x00\x00'),
+                # big endian classic tiff, LONG compression tag = 1
+                'none.TIFF': (b'MM\x00*\x00\x00\x00\x08\x00\x01'
+                              b'\x01\x03\x00\x04\x00\x00\x00\x01'
+                              b'\x00\x00\x00\x01\x00\x00\x00\x00'),
+                # little endian bigtiff, compression tag = 8
+                'big.tif': (b'II+\x00\x08\x00\x00\x00\x10\x00\x00'
+                            b'\x00\x00\x00\x00\x00\x01\x00\x00'
+                            b'\x00\x00\x00\x00\x00\x03\x01\x03'
+                            b'\x00\x01\x00\x00\x00\x00\x00\x00'
+                            b'\x00\x08\x00\x00\x00\x00\x00\x00'
+                            b'\x00'),
+                'notag.tif': (b'II*\x00\x08\x00\x00\x00\x00\x00'),
+                'bad.tif': b'hello',
+                'truncated.tif': b'II*\x00\xff\x00\x00\x00'}
+            for name, data in tiffs.items():
+                with open(os.path.join(temp_dir, name), 'wb') as f:
+                    f.write(data)
+
+            def get_comp(name):
+                return dbutil.get_tiff_compression(os.path.join(temp_dir,
+                                                                name))
+            self.assertEqual(get_comp('lzw.tif'), 5)
+            self.assertEqual(get_comp('none.TIFF'), 1)
+            self.assertEqual(get_comp('big.tif'), 8)
+            self.assertEqual(get_comp('notag.tif'), None)
+            self.assertEqual(get_comp('bad.tif'), None)
+            self.assertEqual(get_comp('truncated.tif'), None)
+            self.assertEqual(get_comp('doesnotexist.tif'), None)
+
+            def get_type(name):
+                return dbutil.get_zip_compress_type(os.path.join(temp_dir,
+                                                                 name))
+            self.assertEqual(get_type('lzw.tif'), zipfile.ZIP_STORED)
+            self.assertEqual(get_type('big.tif'), zipfile.ZIP_STORED)
+            self.assertEqual(get_type('none.TIFF'), zipfile.ZIP_DEFLATED)
+            self.assertEqual(get_type('bad.tif'), zipfile.ZIP_DEFLATED)
+            self.assertEqual(get_type('1.JPG'), zipfile.ZIP_STORED)
+            self.assertEqual(get_type('1.flv'), zipfile.ZIP_STORED)
+            self.assertEqual(get_type('1.mp4'), zipfile.ZIP_STORED)
+            self.assertEqual(get_type('1.mrc'), zipfile.ZIP_DEFLATED)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parallel_deflate_compressor(self):
+        rand = random.Random(1)
+        words = [b'cell', b'image', b'library', b'tiff', b'zip', b'video']
+        data = b' '.join([rand.choice(words) for i in range(40000)])
+        for size in [0, 1, 1000, len(data)]:
+            compressor = dbutil.ParallelDeflateCompressor(4, level=6,
+                                                          block_size=10000)
+            out = []
+            for i in range(0, size, 777):
+                out.append(compressor.compress(data[i:min(i + 777, size)]))
+            out.append(compressor.flush())
+            compressor.close()
+            self.assertEqual(zlib.decompress(b''.join(out), -15),
+                             data[:size])
+
+        # priming each block with previous block keeps output close
+        # to size of a single deflate stream
+        compressor = dbutil.ParallelDeflateCompressor(2, block_size=10000)
+        out = compressor.compress(data) + compressor.flush()
+        single = zlib.compressobj(6, zlib.DEFLATED, -15)
+        single_out = single.compress(data) + single.flush()
+        if dbutil._ZLIB_HAS_ZDICT:
+            self.assertTrue(len(out) < len(single_out) * 1.05)
+
+        with patch('cildata_util.dbutil._ZLIB_HAS_ZDICT', False):
+            compressor = dbutil.ParallelDeflateCompressor(
+                2, block_size=10000)
+            out = compressor.compress(data) + compressor.flush()
+        self.assertEqual(zlib.decompress(out, -15), data)
+
+    def test_link_or_copy_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(temp_dir, '1.raw')
+            with open(src, 'w') as f:
+                f.write('data')
+            os.chmod(src, 0o600)
+            dest = os.path.join(temp_dir, '1.zip')
+            with open(dest, 'w') as f:
+                f.write('old')
+            self.assertEqual(dbutil.link_or_copy_file(src, dest),
+                             dbutil.LINK_METHOD)
+            self.assertEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+
+            with patch('os.link', side_effect=OSError('EXDEV')):
+                res = dbutil.link_or_copy_file(src, dest)
+                self.assertTrue(res in [dbutil.COPY_FILE_RANGE_METHOD,
+                                        dbutil.COPY_METHOD])
+                self.assertNotEqual(os.stat(src).st_ino,
+                                    os.stat(dest).st_ino)
+                with open(dest, 'r') as f:
+                    self.assertEqual(f.read(), 'data')
+                self.assertEqual(os.stat(dest).st_mode & 0o777, 0o600)
+
+                os.unlink(dest)
+                with patch('os.copy_file_range',
+                           side_effect=OSError('unsupported'),
+                           create=True):
+                    self.assertEqual(dbutil.link_or_copy_file(src, dest),
+                                     dbutil.COPY_METHOD)
+                with open(dest, 'r') as f:
+                    self.assertEqual(f.read(), 'data')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_make_backup_of_json_uses_backup_index(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            somefile = os.path.join(temp_dir, 'somefile.json')
+            with open(somefile, 'w') as f:
+                f.write('hi\n')
+            bk = somefile + dbutil.BK_TXT
+            self.assertEqual(dbutil.make_backup_of_json(somefile), bk + '0')
+            self.assertEqual(dbutil.make_backup_of_json(somefile), bk + '1')
+
+            # removed backups are not reused
+            os.remove(bk + '1')
+            self.assertEqual(dbutil.make_backup_of_json(somefile), bk + '2')
+
+            # without index the highest backup number is used
+            os.remove(bk + dbutil.BK_INDEX_TXT)
+            self.assertEqual(dbutil.make_backup_of_json(somefile), bk + '3')
+            with open(bk + dbutil.BK_INDEX_TXT, 'w') as f:
+                f.write('bad')
+            self.assertEqual(dbutil.make_backup_of_json(somefile), bk + '4')
+            self.assertEqual([n for n, p in
+                              dbutil.get_backups_of_json(somefile)],
+                             [0, 2, 3, 4])
+
+            self.assertEqual(dbutil.make_backup_of_json(somefile, keep=2),
+                             bk + '5')
+            self.assertEqual(dbutil.get_backups_of_json(somefile),
+                             [(4, bk + '4'), (5, bk + '5')])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_compact_backups_of_json(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            somefile = os.path.join(temp_dir, 'somefile.json')
+            with open(somefile, 'w') as f:
+                f.write('hi\n')
+            self.assertEqual(dbutil.get_backups_of_json(somefile), [])
+            for i in range(5):
+                dbutil.make_backup_of_json(somefile)
+            bk = somefile + dbutil.BK_TXT
+            now = os.path.getmtime(bk + '4')
+            for i in range(3):
+                os.utime(bk + str(i), (now - 1000, now - 1000))
+
+            self.assertEqual(dbutil.compact_backups_of_json(somefile), [])
+            self.assertEqual(dbutil.compact_backups_of_json(
+                somefile, keep=1, keep_since=now - 10), [bk + '0', bk + '1',
+                                                         bk + '2'])
+            self.assertEqual(dbutil.compact_backups_of_json(somefile,
+                                                            keep=1),
+                             [bk + '3'])
+            self.assertEqual(dbutil.compact_backups_of_json(somefile,
+                                                            keep=0), [bk + '4'])
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             ['somefile.json',
+                              'somefile.json.bk.' + dbutil.BK_INDEX_TXT])
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_make_backup_of_json(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -147,6 +379,55 @@ class TestDbutil(unittest.TestCase):
         self.assertEqual(res['hi'], 'bye')
         self.assertEqual(res['2'], '3')
 
+    def test_convert_response_headers_to_dict_with_whitelist(self):
+        headers = {'Server': 'Apache', 'Date': 'Tue, 23 Jan 2018',
+                   'content-type': 'image/jpeg', 'Connection': 'close'}
+        res = dbutil.convert_response_headers_to_dict(
+            headers, whitelist=dbutil.DEFAULT_HEADER_WHITELIST)
+        self.assertEqual(res, {'Date': 'Tue, 23 Jan 2018',
+                               'content-type': 'image/jpeg'})
+        res = dbutil.convert_response_headers_to_dict(headers, whitelist=[])
+        self.assertEqual(res, {})
+
+    def test_intern_header_value(self):
+        a = ''.join(['image/', 'jpeg'])
+        b = ''.join(['image/', 'jpeg'])
+        self.assertFalse(a is b)
+        self.assertTrue(dbutil.intern_header_value(a) is
+                        dbutil.intern_header_value(b))
+        self.assertEqual(dbutil.intern_header_value(['x']), ['x'])
+        self.assertEqual(dbutil.intern_header_value(None), None)
+
+    def test_convert_response_headers_to_dict_interns_repeated_values(self):
+        headers = {''.join(['Content-', 'Type']): ''.join(['image/', 'png']),
+                   'Date': ''.join(['Tue, 23 Jan 2018 ', '20:42:49 GMT'])}
+        with patch('cildata_util.dbutil._interned_header_values', {}) as \
+                pool:
+            res = dbutil.convert_response_headers_to_dict(headers)
+            self.assertEqual(res, headers)
+            self.assertTrue('image/png' in pool)
+            self.assertTrue('Content-Type' in pool)
+            self.assertTrue('Date' in pool)
+            self.assertFalse('Tue, 23 Jan 2018 20:42:49 GMT' in pool)
+
+    def test_cildatafilepicklewriter_with_header_whitelist(self):
+        cdf = CILDataFile(123)
+        cdf.set_file_name('123.jpg')
+        cdf.set_headers({'Server': 'Apache', 'Date': 'Tue, 23 Jan 2018'})
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonPickleWriter(header_whitelist=['date'])
+            outfile = os.path.join(temp_dir, 'foo')
+            writer.writeCILDataFileListToFile(outfile, [cdf])
+            reader = CILDataFileListFromJsonPickleFactory()
+            res = reader.get_cildatafiles(outfile + dbutil.JSON_SUFFIX)
+            self.assertEqual(res[0].get_headers(),
+                             {'Date': 'Tue, 23 Jan 2018'})
+            # original object should not be modified
+            self.assertEqual(len(cdf.get_headers()), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_download_cil_data_file_with_error_cases(self):
         temp_dir = tempfile.mkdtemp()
         try:
@@ -158,6 +439,75 @@ class TestDbutil(unittest.TestCase):
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_download_cil_data_file_html_page_is_failure(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            id_dir = os.path.join(temp_dir, '123')
+            os.makedirs(id_dir)
+            for data, success in [(b'<!DOCTYPE html><html>Error</html>',
+                                   False),
+                                  (b'PK\x03\x04data', True)]:
+                with open(os.path.join(id_dir, '123.raw'), 'wb') as f:
+                    f.write(data)
+                cdf = CILDataFile(123)
+                cdf.set_file_name('123.raw')
+                headers = {'Content-Type': 'text/html'}
+                with patch('cildata_util.dbutil.download_file',
+                           return_value=('123.raw', headers, 200)):
+                    res = dbutil.download_cil_data_file(temp_dir, cdf)
+                self.assertEqual(res.get_download_success(), success)
+                self.assertEqual(res.get_file_size(), len(data))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_sniff_file_type(self):
+        tests = [(b'PK\x03\x04\x14\x00', dbutil.FILE_TYPE_ZIP),
+                 (b'PK\x05\x06' + b'\x00' * 18, dbutil.FILE_TYPE_ZIP),
+                 (b'II*\x00\x08\x00\x00\x00', dbutil.FILE_TYPE_TIFF),
+                 (b'MM\x00*\x00\x00\x00\x08', dbutil.FILE_TYPE_TIFF),
+                 (b'II+\x00\x08\x00', dbutil.FILE_TYPE_TIFF),
+                 (b'FLV\x01\x05', dbutil.FILE_TYPE_FLV),
+                 (b'\x00\x00\x00\x18ftypmp42', dbutil.FILE_TYPE_MP4),
+                 (b'\x00\x00\x00\x14ftypqt  ', dbutil.FILE_TYPE_MOV),
+                 (b'\x00\x00\x00\x08wide', dbutil.FILE_TYPE_MOV),
+                 (b'RIFF\x00\x00\x00\x00AVI LIST', dbutil.FILE_TYPE_AVI),
+                 (b'RIFF\x00\x00\x00\x00WAVEfmt ', None),
+                 (b'\x00\x00\x01\xba\x44', dbutil.FILE_TYPE_MPEG),
+                 (b'\xff\xd8\xff\xe0\x00\x10JFIF', dbutil.FILE_TYPE_JPEG),
+                 (b'\x89PNG\r\n\x1a\n\x00', dbutil.FILE_TYPE_PNG),
+                 (b'GIF89a', dbutil.FILE_TYPE_GIF),
+                 (b'\xef\xbb\xbf\n  <!DOCTYPE HTML PUBLIC',
+                  dbutil.FILE_TYPE_HTML),
+                 (b'<HTML><body>500</body>', dbutil.FILE_TYPE_HTML),
+                 (b'<?xml version="1.0"?>\n<html xmlns="x">',
+                  dbutil.FILE_TYPE_HTML),
+                 (b'<?xml version="1.0"?><svg>', None),
+                 (b'hello', None),
+                 (b'', None)]
+        for head, expected in tests:
+            self.assertEqual(dbutil.sniff_file_type_from_bytes(head),
+                             expected, head)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            somefile = os.path.join(temp_dir, 'foo.raw')
+            with open(somefile, 'wb') as f:
+                f.write(b'FLV\x01' + b'\x00' * 10000)
+            self.assertEqual(dbutil.sniff_file_type(somefile),
+                             dbutil.FILE_TYPE_FLV)
+            self.assertEqual(dbutil.sniff_file_type(temp_dir), None)
+            self.assertEqual(dbutil.sniff_file_type(
+                os.path.join(temp_dir, 'doesnotexist')), None)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertEqual(dbutil.get_file_type_from_suffix('1.TIFF'),
+                         dbutil.FILE_TYPE_TIFF)
+        self.assertEqual(dbutil.get_file_type_from_suffix('1.m4v'),
+                         dbutil.FILE_TYPE_MP4)
+        self.assertEqual(dbutil.get_file_type_from_suffix('1.raw'), None)
+        self.assertEqual(dbutil.get_file_type_from_suffix('1'), None)
+
     def test_database_get_alternate_connection(self):
         db = Database(None)
         db.set_alternate_connection('hi')
@@ -510,3 +860,1334 @@ class TestDbutil(unittest.TestCase):
         self.assertEqual(res[2].get_file_name(), '123' +
                          dbutil.JPG_SUFFIX)
         self.assertEqual(res[2].get_is_video(), True)
+
+    def test_cildatafiletable_empty(self):
+        table = CILDataFileTable.from_cildatafiles(None)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.get_cildatafiles(), [])
+        self.assertEqual(table.count_by_suffix(), {})
+        self.assertEqual(table.count_by_mime_type(), {})
+        self.assertEqual(table.get_unique_ids(), set())
+        self.assertEqual(len(table.filter(bytearray())), 0)
+
+    def test_cildatafiletable_get_suffix(self):
+        self.assertEqual(CILDataFileTable.get_suffix(None), None)
+        self.assertEqual(CILDataFileTable.get_suffix('123'), None)
+        self.assertEqual(CILDataFileTable.get_suffix('123.RAW'), '.raw')
+        self.assertEqual(CILDataFileTable.get_suffix('123_orig.tif'), '.tif')
+
+    def test_cildatafiletable_masks_and_filter(self):
+        cdf = CILDataFile('123')
+        cdf.set_file_name('123.raw')
+        cdf.set_download_success(True)
+        cdf.set_file_size(10)
+        cdf.set_mime_type('application/zip')
+        cdf.set_has_raw(False)
+        cdf2 = CILDataFile(123)
+        cdf2.set_file_name('123.jpg')
+        cdf2.set_download_success(False)
+        cdf2.set_mime_type('image/jpeg')
+        cdf3 = CILDataFile(456)
+        cdf3.set_file_name('456.raw')
+        cdf3.set_is_video(True)
+        cdf3.set_file_size(0)
+        table = CILDataFileTable.from_cildatafiles([cdf, cdf2, cdf3])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table.get_ids()), [123, 123, 456])
+        self.assertEqual(table.get_file_names(),
+                         ['123.raw', '123.jpg', '456.raw'])
+        self.assertEqual(list(table.get_file_sizes()),
+                         [10, CILDataFileTable.NULL_FILE_SIZE, 0])
+        self.assertEqual(table.get_unique_ids(), set([123, 456]))
+        self.assertEqual(table.count_by_suffix(), {'.raw': 2, '.jpg': 1})
+        self.assertEqual(table.count_by_mime_type(),
+                         {'application/zip': 1, 'image/jpeg': 1, None: 1})
+
+        self.assertEqual(table.get_suffix_mask('.raw'), bytearray([1, 0, 1]))
+        self.assertEqual(table.get_suffix_mask('.tif'), bytearray(3))
+        self.assertEqual(table.get_download_success_mask(True),
+                         bytearray([1, 0, 0]))
+        self.assertEqual(table.get_download_success_mask(None),
+                         bytearray([0, 0, 1]))
+        self.assertEqual(table.get_is_video_mask(True), bytearray([0, 0, 1]))
+        self.assertEqual(table.get_has_raw_mask(False), bytearray([1, 0, 0]))
+        self.assertEqual(table.get_mime_type_mask('image/jpeg'),
+                         bytearray([0, 1, 0]))
+        self.assertEqual(table.get_mime_type_mask('foo'), bytearray(3))
+        self.assertEqual(table.get_file_size_mask(0), bytearray([0, 0, 1]))
+        self.assertEqual(table.get_file_size_mask(None), bytearray([0, 1, 0]))
+
+        a = bytearray([1, 1, 0])
+        b = bytearray([0, 1, 1])
+        self.assertEqual(CILDataFileTable.mask_and(a, b), bytearray([0, 1, 0]))
+        self.assertEqual(CILDataFileTable.mask_or(a, b), bytearray([1, 1, 1]))
+        self.assertEqual(CILDataFileTable.mask_not(a), bytearray([0, 0, 1]))
+        with patch('cildata_util.dbutil._HAS_INT_FROM_BYTES', False):
+            self.assertEqual(CILDataFileTable.mask_and(a, b),
+                             bytearray([0, 1, 0]))
+            self.assertEqual(CILDataFileTable.mask_or(a, b),
+                             bytearray([1, 1, 1]))
+
+        res = table.filter(b)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res.get_cildatafiles(), [cdf2, cdf3])
+        self.assertEqual(res.get_file_names(), ['123.jpg', '456.raw'])
+        self.assertEqual(res.get_suffix_mask('.raw'), bytearray([0, 1]))
+        self.assertEqual(res.get_unique_ids(mask=bytearray([0, 1])),
+                         set([456]))
+        try:
+            table.filter(bytearray(2))
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Mask length 2 does not match '
+                                     'table length 3')
+
+    def test_cildatafiletable_non_numeric_ids(self):
+        cdf = CILDataFile('abc')
+        cdf.set_file_name('abc.jpg')
+        cdf2 = CILDataFile('123')
+        cdf2.set_file_name('123.jpg')
+        cdf3 = CILDataFile(None)
+        table = CILDataFileTable.from_cildatafiles([cdf, cdf2, cdf3])
+        self.assertEqual(list(table.get_ids()), [123])
+        self.assertEqual(table.get_cildatafiles(), [cdf2])
+        self.assertEqual(CILDataFileTable.is_numeric_id('123'), True)
+        self.assertEqual(CILDataFileTable.is_numeric_id(None), False)
+
+        # failed append leaves table unchanged
+        try:
+            table.append(cdf)
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.get_file_names(), ['123.jpg'])
+
+    def test_get_array_typecode(self):
+        self.assertEqual(array(dbutil._INT64_TYPECODE).itemsize, 8)
+        self.assertEqual(dbutil._get_array_typecode(('b', 'h'), 2), 'h')
+        self.assertEqual(dbutil._get_array_typecode(('x', 'b'), 1), 'b')
+        self.assertEqual(dbutil._get_array_typecode(('b', 'B'), 8), 'B')
+
+    def test_cildatafilenorawfilter_suffix_case(self):
+        cdf = CILDataFile(5)
+        cdf.set_file_name('5.RAW')
+        cdf.set_is_video(False)
+        cdf.set_has_raw(False)
+        cdf2 = CILDataFile(6)
+        cdf2.set_file_name('6.jpg')
+        filt = CILDataFileNoRawFilter()
+        self.assertEqual(filt.matches(cdf), False)
+        self.assertEqual(filt.get_cildatafiles([cdf, cdf2]), [cdf2])
+        table = CILDataFileTable.from_cildatafiles([cdf, cdf2])
+        self.assertEqual(table.get_suffix_mask('.RAW'), bytearray([1, 0]))
+        self.assertEqual(filt.get_mask(table), bytearray([0, 1]))
+        self.assertEqual(filt.get_cildatafiles(table).get_cildatafiles(),
+                         [cdf2])
+
+    def test_cildatafiletable_with_filters(self):
+        cdf = CILDataFile(123)
+        cdf.set_file_name('123.jpg')
+        cdf.set_download_success(True)
+        cdf2 = CILDataFile(456)
+        cdf2.set_is_video(True)
+        cdf2.set_file_name('456.raw')
+        cdf2.set_has_raw(False)
+        cdf3 = CILDataFile(444)
+        cdf3.set_is_video(False)
+        cdf3.set_file_name('444.raw')
+        cdf3.set_has_raw(False)
+        cdf3.set_download_success(False)
+        table = CILDataFileTable.from_cildatafiles([cdf, cdf2, cdf3])
+
+        res = CILDataFileNoRawFilter().get_cildatafiles(table)
+        self.assertTrue(isinstance(res, CILDataFileTable))
+        self.assertEqual(res.get_cildatafiles(), [cdf, cdf2])
+
+        res = CILDataFileFailedDownloadFilter().get_cildatafiles(table)
+        self.assertTrue(isinstance(res, CILDataFileTable))
+        self.assertEqual(res.get_cildatafiles(), [cdf2, cdf3])
+
+    def _get_fully_populated_cildatafile(self):
+        cdf = CILDataFile('123')
+        cdf.set_checksum('abc')
+        cdf.set_download_success(True)
+        cdf.set_download_time(5)
+        cdf.set_file_name('123.jpg')
+        cdf.set_is_video(False)
+        cdf.set_mime_type('image/jpeg')
+        cdf.set_headers({'Date': 'Tue, 23 Jan 2018', 'Server': 'Apache'})
+        cdf.set_file_size(123)
+        cdf.set_localfile('123.jpg')
+        cdf.set_has_raw(True)
+        return cdf
+
+    def test_cildatafile_to_dict_and_from_dict(self):
+        cdf = self._get_fully_populated_cildatafile()
+        res = CILDataFile.from_dict(cdf.to_dict())
+        self.assertEqual(res.to_dict(), cdf.to_dict())
+
+        res = CILDataFile.from_dict({'id': 5})
+        self.assertEqual(res.get_id(), 5)
+        self.assertEqual(res.get_file_name(), None)
+        self.assertEqual(res.get_headers(), None)
+
+    def test_cildatafilejsonwriter_and_reader(self):
+        cdf = self._get_fully_populated_cildatafile()
+        cdf2 = CILDataFile('123')
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            outfile = os.path.join(temp_dir, '123')
+            writer.writeCILDataFileListToFile(outfile, [cdf, cdf2])
+            jsonfile = outfile + dbutil.JSON_SUFFIX
+            with open(jsonfile, 'r') as f:
+                data = f.read()
+            self.assertTrue(data.startswith('{'))
+            self.assertFalse(CILDataFileListFromJsonFactory
+                             .is_legacy_format(data))
+            reader = CILDataFileListFromJsonFactory()
+            res = reader.get_cildatafiles(jsonfile)
+            self.assertEqual(len(res), 2)
+            self.assertEqual(res[0].to_dict(), cdf.to_dict())
+            self.assertEqual(res[1].to_dict(), cdf2.to_dict())
+
+            # try with header whitelist
+            writer = CILDataFileJsonWriter(header_whitelist=['date'])
+            writer.writeCILDataFileListToFile(jsonfile, [cdf],
+                                              skipsuffixappend=True)
+            res = reader.get_cildatafiles(jsonfile)
+            self.assertEqual(res[0].get_headers(),
+                             {'Date': 'Tue, 23 Jan 2018'})
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilelistfromjsonfactory_legacy_file(self):
+        cdf = self._get_fully_populated_cildatafile()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonPickleWriter()
+            outfile = os.path.join(temp_dir, '123')
+            writer.writeCILDataFileListToFile(outfile, [cdf])
+            reader = CILDataFileListFromJsonFactory()
+            res = reader.get_cildatafiles(outfile + dbutil.JSON_SUFFIX)
+            self.assertEqual(len(res), 1)
+            self.assertEqual(res[0].to_dict(), cdf.to_dict())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilelistfromjsonfactory_invalid_data(self):
+        reader = CILDataFileListFromJsonFactory()
+        self.assertEqual(reader.get_cildatafiles_from_string('[]'), [])
+        try:
+            reader.get_cildatafiles_from_string('{"format": "foo"}')
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Unknown json format')
+
+        try:
+            reader.get_cildatafiles_from_string('{"format": "cildatafile",'
+                                                ' "version": 99}')
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Unsupported cildatafile json '
+                                     'version: 99')
+
+    def test_get_catalog_index(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(dbutil.get_catalog_index(None), None)
+            self.assertEqual(dbutil.get_catalog_index(temp_dir), None)
+            open(os.path.join(temp_dir, dbutil.CATALOG_INDEX_FILE),
+                 'a').close()
+            index = dbutil.get_catalog_index(temp_dir)
+            self.assertTrue(isinstance(index, CILDataFileCatalogIndex))
+            self.assertEqual(index.is_complete(), False)
+            index.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilecatalogindex(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            cdf = CILDataFile('123')
+            cdf.set_file_name('123.jpg')
+            cdf.set_download_success(True)
+            cdf2 = CILDataFile('123')
+            cdf2.set_file_name('123.tif')
+            img_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, '123')
+            os.makedirs(img_dir)
+            writer.writeCILDataFileListToFile(os.path.join(img_dir, '123'),
+                                              [cdf, cdf2])
+            index_file = os.path.join(temp_dir, dbutil.CATALOG_INDEX_FILE)
+            index = CILDataFileCatalogIndex(index_file)
+            self.assertEqual(index.is_complete(), False)
+            self.assertEqual(index.get_cildatafiles(), [])
+            self.assertEqual(index.rebuild(temp_dir), 2)
+            self.assertEqual(index.is_complete(), True)
+            res = index.get_cildatafiles()
+            self.assertEqual(len(res), 2)
+            self.assertEqual(res[0].to_dict(), cdf.to_dict())
+            self.assertEqual(res[1].to_dict(), cdf2.to_dict())
+            self.assertEqual(index.get_json_files(),
+                             [os.path.join(img_dir, '123.json')])
+
+            # write a new json file via writer with index
+            writer = CILDataFileJsonWriter(index=index)
+            vid_dir = os.path.join(temp_dir, dbutil.VIDEOS_DIR, '456')
+            os.makedirs(vid_dir)
+            cdf3 = CILDataFile('456')
+            cdf3.set_file_name('456.flv')
+            writer.writeCILDataFileListToFile(os.path.join(vid_dir, '456'),
+                                              [cdf3])
+            self.assertEqual(len(index.get_cildatafiles()), 3)
+            res = index.get_cildatafiles(id='456')
+            self.assertEqual(len(res), 1)
+            self.assertEqual(res[0].get_file_name(), '456.flv')
+            self.assertEqual(index.get_json_files(id=456),
+                             [os.path.join(vid_dir, '456.json')])
+
+            # rewrite json file with one entry
+            writer.writeCILDataFileListToFile(os.path.join(img_dir, '123'),
+                                              [cdf])
+            res = index.get_cildatafiles(id='123')
+            self.assertEqual(len(res), 1)
+            index.close()
+
+            # factory should use index so removing json file
+            # should not change result
+            os.unlink(os.path.join(vid_dir, '456.json'))
+            fac = CILDataFileFromJsonFilesFactory()
+            self.assertEqual(len(fac.get_cildatafiles(temp_dir)), 2)
+            fac = CILDataFileFromJsonFilesFactory(id='456')
+            self.assertEqual(len(fac.get_cildatafiles(temp_dir)), 1)
+            fac = CILDataFileFromJsonFilesFactory(use_index=False)
+            self.assertEqual(len(fac.get_cildatafiles(temp_dir)), 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefromjsonfilesfactory_with_id(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            for cur_id in ['1', '2']:
+                writer.writeCILDataFileListToFile(os.path.join(temp_dir,
+                                                               cur_id),
+                                                  [CILDataFile(cur_id)])
+            fac = CILDataFileFromJsonFilesFactory(id='2')
+            res = fac.get_cildatafiles(temp_dir)
+            self.assertEqual(len(res), 1)
+            self.assertEqual(res[0].get_id(), '2')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefromjsonfilesfactory_get_json_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            expected = []
+            for sub_dir, cur_id in [(dbutil.IMAGES_DIR, '1'),
+                                    (dbutil.IMAGES_DIR, '2'),
+                                    (dbutil.VIDEOS_DIR, '3')]:
+                id_dir = os.path.join(temp_dir, sub_dir, cur_id)
+                os.makedirs(os.path.join(id_dir, 'tmp'))
+                jsonfile = os.path.join(id_dir, cur_id + dbutil.JSON_SUFFIX)
+                expected.append(jsonfile)
+                for f in [jsonfile, jsonfile + dbutil.BK_TXT + '0',
+                          os.path.join(id_dir, 'other.json'),
+                          os.path.join(id_dir, 'tmp', 'x.json')]:
+                    open(f, 'a').close()
+
+            # id directory without json file
+            os.makedirs(os.path.join(temp_dir, dbutil.IMAGES_DIR, '4'))
+
+            # non numeric directory should be skipped
+            foo_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, 'foo')
+            os.makedirs(foo_dir)
+            open(os.path.join(foo_dir, 'foo.json'), 'a').close()
+
+            fac = CILDataFileFromJsonFilesFactory()
+            self.assertEqual(sorted(fac.get_json_files(temp_dir)), expected)
+
+            fac = CILDataFileFromJsonFilesFactory(discovery_threads=4)
+            self.assertEqual(sorted(fac.get_json_files(temp_dir)), expected)
+
+            fac = CILDataFileFromJsonFilesFactory(id='3')
+            self.assertEqual(list(fac.get_json_files(temp_dir)),
+                             [expected[2]])
+            self.assertEqual(list(fac.get_json_files(expected[1])),
+                             [expected[1]])
+
+            fac = CILDataFileFromJsonFilesFactory(id='5')
+            self.assertEqual(list(fac.get_json_files(temp_dir)), [])
+            self.assertEqual(list(fac.get_json_files(
+                os.path.join(temp_dir, 'doesnotexist'))), [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_batches(self):
+        self.assertEqual(list(dbutil.get_batches([], 2)), [])
+        self.assertEqual(list(dbutil.get_batches([1, 2, 3], 2)),
+                         [[1, 2], [3]])
+        self.assertEqual(list(dbutil.get_batches(iter([1, 2]), 2)),
+                         [[1, 2]])
+
+    def test_cildatafilefromjsonfilesfactory_with_workers(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            for cur_id in range(10):
+                id_dir = os.path.join(images_dir, str(cur_id))
+                os.makedirs(id_dir)
+                cdf = CILDataFile(str(cur_id))
+                cdf.set_file_name(str(cur_id) + dbutil.JPG_SUFFIX)
+                cdf2 = CILDataFile(str(cur_id))
+                cdf2.set_file_name(str(cur_id) + dbutil.TIF_SUFFIX)
+                writer.writeCILDataFileListToFile(os.path.join(id_dir,
+                                                               str(cur_id)),
+                                                  [cdf, cdf2])
+            fac = CILDataFileFromJsonFilesFactory()
+            expected = [cdf.get_file_name() for cdf in
+                        fac.get_cildatafiles(temp_dir)]
+            self.assertEqual(len(expected), 20)
+
+            fac = CILDataFileFromJsonFilesFactory(workers=2, chunksize=3)
+            res = [cdf.get_file_name() for cdf in
+                   fac.get_cildatafiles(temp_dir)]
+            self.assertEqual(res, expected)
+
+            fac = CILDataFileFromJsonFilesFactory(workers=2, chunksize=3,
+                                                  ordered=False)
+            res = [cdf.get_file_name() for cdf in
+                   fac.get_cildatafiles(temp_dir)]
+            self.assertEqual(sorted(res), sorted(expected))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_filters_iter_cildatafiles(self):
+        cdf = CILDataFile(123)
+        cdf.set_file_name('123.raw')
+        cdf.set_has_raw(False)
+        cdf.set_is_video(False)
+        cdf2 = CILDataFile(456)
+        cdf2.set_file_name('456.jpg')
+        cdf2.set_download_success(True)
+
+        res = CILDataFileNoRawFilter().iter_cildatafiles(iter([cdf, cdf2]))
+        self.assertFalse(isinstance(res, list))
+        self.assertEqual(list(res), [cdf2])
+
+        res = CILDataFileFailedDownloadFilter().iter_cildatafiles([cdf, cdf2])
+        self.assertEqual(list(res), [cdf])
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(temp_dir, '123'))
+            filt = CILDataFileFoundInFilesystemFilter(temp_dir, temp_dir)
+            res = filt.iter_cildatafiles(iter([cdf, cdf2]))
+            self.assertEqual(list(res), [cdf2])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefromdatabasefactory_iter_cildatafiles(self):
+        cursor = Mock()
+        cursor.__iter__ = Mock(return_value=iter([('123', 0, 1),
+                                                  ('456', 1, 0)]))
+        conn = Mock()
+        conn.cursor = Mock(return_value=cursor)
+        fac = CILDataFileFromDatabaseFactory(conn, id='123',
+                                             skipifprocessedtimeset=True)
+        res = fac.iter_cildatafiles()
+        self.assertFalse(isinstance(res, list))
+        res = list(res)
+        self.assertEqual(len(res), 6)
+        self.assertEqual([c.get_file_name() for c in res],
+                         ['123.tif', '123.jpg', '123.raw',
+                          '456.flv', '456.raw', '456.jpg'])
+        sql = cursor.execute.call_args[0][0]
+        self.assertTrue("image_id='CIL_123'" in sql)
+        self.assertTrue('processed_time is null' in sql)
+        cursor.close.assert_called_once_with()
+        conn.commit.assert_called_once_with()
+
+    def test_cildatafilecatalogindex_iter_cildatafiles_with_updates(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            for cur_id in ['1', '2', '3']:
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(cur_id + dbutil.RAW_SUFFIX)
+                writer.writeCILDataFileListToFile(os.path.join(temp_dir,
+                                                               cur_id),
+                                                  [cdf])
+            index_file = os.path.join(temp_dir, dbutil.CATALOG_INDEX_FILE)
+            index = CILDataFileCatalogIndex(index_file)
+            index.rebuild(temp_dir)
+
+            # update index while iterating, new entries for json files
+            # already returned should not be returned again
+            update_index = CILDataFileCatalogIndex(index_file)
+            writer = CILDataFileJsonWriter(index=update_index)
+            res = []
+            for cdf in index.iter_cildatafiles(page_size=1):
+                res.append(cdf.get_file_name())
+                cur_id = cdf.get_id()
+                zcdf = CILDataFile(cur_id)
+                zcdf.set_file_name(cur_id + dbutil.ZIP_SUFFIX)
+                writer.writeCILDataFileListToFile(
+                    os.path.join(temp_dir, cur_id), [cdf, zcdf])
+            self.assertEqual(res, ['1.raw', '2.raw', '3.raw'])
+            self.assertEqual(len(index.get_cildatafiles()), 6)
+            self.assertEqual(len(index.get_cildatafiles(id='2')), 2)
+            index.close()
+            update_index.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefromjsonfilesfactory_iter_cildatafiles(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            fac = CILDataFileFromJsonFilesFactory()
+            self.assertEqual(list(fac.iter_cildatafiles(None)), [])
+            writer = CILDataFileJsonWriter()
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '1'),
+                                              [CILDataFile('1')])
+            res = fac.iter_cildatafiles(temp_dir)
+            self.assertFalse(isinstance(res, list))
+            self.assertEqual([c.get_id() for c in res], ['1'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_file_stat_key(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            afile = os.path.join(temp_dir, 'foo')
+            self.assertEqual(dbutil.get_file_stat_key(afile), None)
+            with open(afile, 'w') as f:
+                f.write('hi')
+            key = dbutil.get_file_stat_key(afile)
+            st = os.stat(afile)
+            self.assertEqual(key[1], 2)
+            self.assertEqual(key[2], st.st_ino)
+            os.utime(afile, (st.st_atime, st.st_mtime + 10))
+            self.assertNotEqual(dbutil.get_file_stat_key(afile), key)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_scan_cache(self):
+        self.assertEqual(dbutil.get_scan_cache(None), None)
+        self.assertTrue(isinstance(dbutil.get_scan_cache('foo'),
+                                   CILDataFileScanCache))
+
+    def test_cildatafilefromjsonfilesfactory_with_scan_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            for cur_id in ['1', '2', '3']:
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(cur_id + dbutil.RAW_SUFFIX)
+                cdf.set_headers({'Content-Type': 'image/tiff'})
+                writer.writeCILDataFileListToFile(os.path.join(temp_dir,
+                                                               cur_id),
+                                                  [cdf])
+            cache_file = os.path.join(temp_dir, dbutil.SCAN_CACHE_FILE)
+            for stat_threads in [1, 4]:
+                cache = CILDataFileScanCache(cache_file,
+                                             stat_threads=stat_threads)
+                fac = CILDataFileFromJsonFilesFactory(scan_cache=cache)
+                res = fac.get_cildatafiles(temp_dir)
+                self.assertEqual(sorted([c.get_file_name() for c in res]),
+                                 ['1.raw', '2.raw', '3.raw'])
+                self.assertEqual(res[0].get_headers(),
+                                 {'Content-Type': 'image/tiff'})
+                cache.close()
+
+            # unchanged json files must come from the cache
+            cache = CILDataFileScanCache(cache_file)
+            fac = CILDataFileFromJsonFilesFactory(scan_cache=cache)
+            json_two = os.path.join(temp_dir, '2.json')
+            json_three = os.path.join(temp_dir, '3.json')
+            cdf = CILDataFile('2')
+            cdf.set_file_name('2' + dbutil.ZIP_SUFFIX)
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '2'),
+                                              [cdf])
+            st = os.stat(json_two)
+            os.utime(json_two, (st.st_atime, st.st_mtime + 10))
+            os.remove(json_three)
+
+            readfunc = dbutil._read_cildatafile_dicts_from_json_files
+            read_files = []
+
+            def tracking_read(json_files):
+                read_files.extend(json_files)
+                return readfunc(json_files)
+
+            dbutil._read_cildatafile_dicts_from_json_files = tracking_read
+            try:
+                res = list(cache.iter_cildatafiles(
+                    fac.get_json_files(temp_dir), fac, prune=True))
+            finally:
+                dbutil._read_cildatafile_dicts_from_json_files = readfunc
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['1.raw', '2.zip'])
+            self.assertEqual(read_files, [json_two])
+            cache.close()
+
+            conn = sqlite3.connect(cache_file)
+            rows = [os.path.basename(r[0]) for r in
+                    conn.execute('SELECT json_file FROM scan '
+                                 'ORDER BY json_file')]
+            conn.close()
+            self.assertEqual(rows, ['1.json', '2.json'])
+
+            # id passed in should not prune other entries
+            cache = CILDataFileScanCache(cache_file)
+            fac = CILDataFileFromJsonFilesFactory(id='1', scan_cache=cache)
+            res = fac.get_cildatafiles(temp_dir)
+            self.assertEqual([c.get_file_name() for c in res], ['1.raw'])
+            self.assertEqual(cache.get_cildatafile_dicts(
+                json_two, dbutil.get_file_stat_key(json_two))[0]['file_name'],
+                '2.zip')
+            cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_group_cildatafiles_by_id(self):
+        cdfs = [CILDataFile('1'), CILDataFile(1), CILDataFile('2'),
+                CILDataFile('3'), CILDataFile('3')]
+        res = list(dbutil.group_cildatafiles_by_id(iter(cdfs)))
+        self.assertEqual([(i, len(c)) for i, c in res],
+                         [('1', 2), ('2', 1), ('3', 2)])
+        self.assertEqual(res[2][1], cdfs[3:])
+
+    def test_update_cildatafiles_in_json(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cdf_list = []
+            for suffix in [dbutil.RAW_SUFFIX, dbutil.JPG_SUFFIX,
+                           dbutil.TIF_SUFFIX]:
+                cdf = CILDataFile('1')
+                cdf.set_file_name('1' + suffix)
+                cdf_list.append(cdf)
+            writer = CILDataFileJsonWriter()
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '1'),
+                                              cdf_list)
+            jsonfile = os.path.join(temp_dir, '1.json')
+
+            zcdf = CILDataFile('1')
+            zcdf.set_file_name('1.zip')
+            tcdf = CILDataFile('1')
+            tcdf.set_file_name('1.tif')
+            tcdf.set_download_success(True)
+            reader = CILDataFileListFromJsonFactory()
+            res = dbutil.update_cildatafiles_in_json(
+                jsonfile, {'1.raw': [cdf_list[0], zcdf], '1.tif': tcdf,
+                           '1.png': zcdf}, reader, writer)
+            self.assertEqual(res, 2)
+            res = reader.get_cildatafiles(jsonfile)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['1.raw', '1.zip', '1.jpg', '1.tif'])
+            self.assertEqual(res[3].get_download_success(), True)
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             ['1.json', '1.json.bk.0', '1.json.bk.index'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilecatalog_write_and_read(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            catalog_file = os.path.join(temp_dir, 'catalog.bin')
+            self.assertEqual(CILDataFileCatalog.write(catalog_file, []), 0)
+            catalog = CILDataFileCatalog(catalog_file)
+            self.assertEqual(len(catalog), 0)
+            self.assertEqual(len(catalog.get_table()), 0)
+            self.assertEqual(catalog.get_cildatafiles(id=1), [])
+            catalog.close()
+
+            cdfs = []
+            for cur_id, suffix in [(5, '.raw'), (3, '.jpg'), (9, None),
+                                   (3, '.raw')]:
+                cdf = CILDataFile(cur_id)
+                if suffix is not None:
+                    cdf.set_file_name(str(cur_id) + suffix)
+                cdf.set_download_success(suffix == '.jpg')
+                cdf.set_has_raw(suffix == '.raw')
+                cdf.set_file_size(cur_id)
+                cdf.set_mime_type('image/jpeg')
+                cdf.set_headers({'ETag': 'x'})
+                cdfs.append(cdf)
+            cdfs.append(self._get_fully_populated_cildatafile())
+            table = CILDataFileTable.from_cildatafiles(cdfs)
+            self.assertEqual(CILDataFileCatalog.write(catalog_file, table), 5)
+
+            catalog = CILDataFileCatalog(catalog_file)
+            self.assertEqual(len(catalog), 5)
+            ctable = catalog.get_table()
+            self.assertEqual(list(ctable.get_ids()),
+                             sorted(table.get_ids()))
+            self.assertEqual(list(ctable.get_file_names())[0:4],
+                             ['3.jpg', '3.raw', '5.raw', None])
+            self.assertEqual(ctable.count_by_suffix(),
+                             table.count_by_suffix())
+            self.assertEqual(ctable.count_by_mime_type(),
+                             table.count_by_mime_type())
+            self.assertEqual(sum(ctable.get_has_raw_mask(True)),
+                             sum(table.get_has_raw_mask(True)))
+            noraw_filt = CILDataFileNoRawFilter()
+            self.assertEqual(len(noraw_filt.get_cildatafiles(ctable)),
+                             len(noraw_filt.get_cildatafiles(table)))
+            res = ctable.filter(ctable.get_download_success_mask(True))
+            self.assertEqual(list(res.get_file_names()), ['3.jpg', '123.jpg'])
+            self.assertEqual(res.get_cildatafiles()[0].get_headers(),
+                             {'ETag': 'x'})
+
+            # lookups by id
+            self.assertEqual(catalog.get_row_range(3), (0, 2))
+            self.assertEqual(catalog.get_row_range('4'), (2, 2))
+            self.assertEqual([c.get_file_name() for c in
+                              catalog.get_cildatafiles(id='3')],
+                             ['3.jpg', '3.raw'])
+            full = cdfs[-1]
+            res = catalog.get_cildatafiles(id=full.get_id())
+            self.assertEqual(res[0].to_dict(), full.to_dict())
+
+            # table loaded from catalog can still be appended to
+            ctable.append(CILDataFile(1))
+            self.assertEqual(len(ctable), 6)
+            self.assertEqual(len(ctable.get_cildatafiles()), 6)
+            catalog.close()
+            catalog.close()
+
+            # without None file names the file name column stays lazy
+            CILDataFileCatalog.write(catalog_file, cdfs[0:2])
+            catalog = CILDataFileCatalog(catalog_file)
+            ctable = catalog.get_table()
+            file_names = ctable.get_file_names()
+            self.assertFalse(isinstance(file_names, list))
+            self.assertEqual(file_names[-1], '5.raw')
+            res = ctable.filter(ctable.get_has_raw_mask(True))
+            self.assertEqual(len(res.get_file_names()), 1)
+            self.assertEqual(res.get_file_names()[0], '5.raw')
+            self.assertEqual(list(res.get_cildatafiles()[0].get_headers()),
+                             ['ETag'])
+            catalog.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilecatalog_invalid_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            catalog_file = os.path.join(temp_dir, 'catalog.bin')
+            with open(catalog_file, 'wb') as f:
+                f.write(b'hello there, this is not a catalog file')
+            try:
+                CILDataFileCatalog(catalog_file)
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertEqual(str(e), catalog_file + ' is not a catalog')
+
+            CILDataFileCatalog.write(catalog_file, [CILDataFile(1)])
+            with open(catalog_file, 'r+b') as f:
+                f.seek(len(dbutil.CATALOG_MAGIC))
+                f.write(b'\x02')
+            try:
+                CILDataFileCatalog(catalog_file)
+                self.fail('Expected ValueError')
+            except ValueError as e:
+                self.assertEqual(str(e), 'Unsupported catalog version: 2')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_cildatafile_differences(self):
+        cdf = self._get_fully_populated_cildatafile()
+        cdf2 = self._get_fully_populated_cildatafile()
+        self.assertEqual(dbutil.get_cildatafile_differences(cdf, cdf2), [])
+        cdf2.set_file_size(1)
+        cdf2.set_checksum(None)
+        self.assertEqual(dbutil.get_cildatafile_differences(cdf, cdf2),
+                         ['_checksum', '_file_size'])
+
+    def test_migrate_json_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            jsonfile = os.path.join(temp_dir, '123.json')
+            res = dbutil.migrate_json_file(jsonfile)
+            self.assertEqual(res[0:3], (jsonfile, dbutil.MIGRATE_FAILED, 0))
+            self.assertTrue('No such file' in res[3])
+
+            cdf = self._get_fully_populated_cildatafile()
+            writer = CILDataFileJsonPickleWriter()
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '123'),
+                                              [cdf, CILDataFile(123)])
+            size = os.path.getsize(jsonfile)
+            self.assertEqual(dbutil.migrate_json_file(jsonfile),
+                             (jsonfile, dbutil.MIGRATE_MIGRATED, size, None))
+            self.assertFalse(os.path.isfile(jsonfile + dbutil.LEGACY_SUFFIX))
+            reader = CILDataFileListFromJsonFactory()
+            res = reader.get_cildatafiles(jsonfile)
+            self.assertEqual(res[0].to_dict(), cdf.to_dict())
+            self.assertEqual(res[1].to_dict(), CILDataFile(123).to_dict())
+
+            size = os.path.getsize(jsonfile)
+            self.assertEqual(dbutil.migrate_json_file(jsonfile),
+                             (jsonfile, dbutil.MIGRATE_SKIPPED, size, None))
+
+            # legacy file is kept as a hard link that is not modified
+            writer.writeCILDataFileListToFile(os.path.join(temp_dir, '123'),
+                                              [cdf])
+            legacy_ino = os.stat(jsonfile).st_ino
+            res = dbutil.migrate_json_file(jsonfile, keep_legacy=True)
+            self.assertEqual(res[1], dbutil.MIGRATE_MIGRATED)
+            legacy_file = jsonfile + dbutil.LEGACY_SUFFIX
+            self.assertEqual(os.stat(legacy_file).st_ino, legacy_ino)
+            self.assertNotEqual(os.stat(jsonfile).st_ino, legacy_ino)
+            self.assertEqual(len(reader.get_cildatafiles(legacy_file)), 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilepredicate_base(self):
+        pred = CILDataFilePredicate()
+        self.assertEqual(pred.get_cost(), CILDataFilePredicate.CHEAP_COST)
+        try:
+            pred.matches(CILDataFile(1))
+            self.fail('Expected NotImplementedError')
+        except NotImplementedError:
+            pass
+        try:
+            CILDataFileAndPredicate()
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'At least one predicate is required')
+
+    def test_cildatafilepredicate_compose(self):
+        calls = []
+
+        class FakePredicate(CILDataFilePredicate):
+            def __init__(self, name, cost, ids):
+                self.name = name
+                self.COST = cost
+                self._ids = ids
+
+            def matches(self, cdf):
+                calls.append((self.name, cdf.get_id()))
+                return cdf.get_id() in self._ids
+
+        expensive = FakePredicate('expensive', 100, [1, 2])
+        cheap = FakePredicate('cheap', 1, [2, 3])
+        medium = FakePredicate('medium', 10, [1, 2, 3])
+        cdfs = [CILDataFile(i) for i in range(1, 5)]
+
+        pred = expensive & cheap & medium
+        self.assertTrue(isinstance(pred, CILDataFileAndPredicate))
+        self.assertEqual([p.name for p in pred.get_predicates()],
+                         ['cheap', 'medium', 'expensive'])
+        self.assertEqual(pred.get_cost(), 111)
+        res = pred.iter_cildatafiles(iter(cdfs))
+        self.assertEqual([c.get_id() for c in res], [2])
+        # expensive predicate only called for entries passing cheap ones
+        self.assertEqual([c for c in calls if c[0] == 'expensive'],
+                         [('expensive', 2), ('expensive', 3)])
+
+        pred = expensive | cheap
+        self.assertTrue(isinstance(pred, CILDataFileOrPredicate))
+        del calls[:]
+        self.assertEqual([c.get_id() for c in pred.get_cildatafiles(cdfs)],
+                         [1, 2, 3])
+        self.assertEqual([c for c in calls if c[0] == 'expensive'],
+                         [('expensive', 1), ('expensive', 4)])
+
+        pred = ~(expensive | cheap)
+        self.assertTrue(isinstance(pred, CILDataFileNotPredicate))
+        self.assertEqual(pred.get_cost(), 101)
+        self.assertEqual([c.get_id() for c in pred.get_cildatafiles(cdfs)],
+                         [4])
+        self.assertEqual(pred.get_cildatafiles(None), None)
+
+        table = CILDataFileTable.from_cildatafiles(cdfs)
+        self.assertEqual(list(pred.get_cildatafiles(table).get_ids()), [4])
+        pred = CILDataFileOrPredicate(cheap & expensive, medium)
+        self.assertEqual(pred.get_mask(table), bytearray([1, 1, 1, 0]))
+
+    def test_cildatafilepredicate_existing_filters(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(temp_dir, '1'))
+            cdfs = []
+            for cur_id, suffix, success, has_raw in [
+                    (1, '.raw', False, False), (2, '.raw', False, False),
+                    (2, '.jpg', False, None), (3, '.jpg', True, None),
+                    (4, '.raw', False, True)]:
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(str(cur_id) + suffix)
+                cdf.set_download_success(success)
+                cdf.set_has_raw(has_raw)
+                cdf.set_is_video(False)
+                cdfs.append(cdf)
+            fs_filt = CILDataFileFoundInFilesystemFilter(temp_dir, temp_dir)
+            self.assertEqual(fs_filt.get_cost(),
+                             CILDataFilePredicate.FILESYSTEM_COST)
+            pred = (fs_filt & CILDataFileFailedDownloadFilter() &
+                    CILDataFileNoRawFilter())
+            self.assertEqual(pred.get_predicates()[-1], fs_filt)
+            res = pred.get_cildatafiles(cdfs)
+            self.assertEqual([c.get_file_name() for c in res],
+                             ['2.jpg', '4.raw'])
+            table = CILDataFileTable.from_cildatafiles(cdfs)
+            self.assertEqual(list(pred.get_cildatafiles(table).get_ids()),
+                             [2, 4])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefoundinfilesystemfilter_lists_dirs_once(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            images_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR)
+            videos_dir = os.path.join(temp_dir, dbutil.VIDEOS_DIR)
+            os.makedirs(os.path.join(images_dir, '1'))
+            os.makedirs(os.path.join(images_dir, 'abc'))
+            os.makedirs(os.path.join(videos_dir, '2'))
+            with open(os.path.join(images_dir, '3'), 'w') as f:
+                f.write('not a directory')
+            cdfs = []
+            for cur_id, is_video in [(1, False), (1, False), (2, True),
+                                     (2, False), (3, False), ('abc', False),
+                                     ('xyz', False)]:
+                cdf = CILDataFile(cur_id)
+                cdf.set_is_video(is_video)
+                cdf.set_file_name(str(cur_id) + '.jpg')
+                cdfs.append(cdf)
+            filt = CILDataFileFoundInFilesystemFilter(images_dir, videos_dir)
+            orig_isdir = os.path.isdir
+            isdir_calls = []
+
+            def tracking_isdir(path):
+                isdir_calls.append(path)
+                return orig_isdir(path)
+
+            os.path.isdir = tracking_isdir
+            try:
+                res = filt.get_cildatafiles(cdfs)
+            finally:
+                os.path.isdir = orig_isdir
+            self.assertEqual([(c.get_id(), c.get_is_video()) for c in res],
+                             [(2, False), (3, False), ('xyz', False)])
+            # only non numeric ids need a stat
+            self.assertEqual(len(isdir_calls), 2)
+
+            # listing is kept until refresh() is called
+            os.makedirs(os.path.join(images_dir, '2'))
+            self.assertTrue(filt.matches(cdfs[3]))
+            filt.refresh()
+            self.assertFalse(filt.matches(cdfs[3]))
+
+            # each pass of a combined predicate lists directories again
+            pred = CILDataFileFailedDownloadFilter() & filt
+            self.assertEqual(len(pred.get_cildatafiles(cdfs)), 2)
+            os.remove(os.path.join(images_dir, '3'))
+            os.makedirs(os.path.join(images_dir, '3'))
+            self.assertEqual(len(pred.get_cildatafiles(cdfs)), 1)
+
+            # missing base directory means nothing is present
+            filt = CILDataFileFoundInFilesystemFilter(
+                os.path.join(temp_dir, 'doesnotexist'), videos_dir)
+            self.assertTrue(filt.matches(cdfs[0]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefoundinfilesystemfilter_expected_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            id_dir = os.path.join(temp_dir, '1')
+            os.makedirs(id_dir)
+            for name in ['1.json', '1.jpg']:
+                with open(os.path.join(id_dir, name), 'w') as f:
+                    f.write('hi')
+            cdfs = []
+            for name in ['1.jpg', '1.raw']:
+                cdf = CILDataFile(1)
+                cdf.set_file_name(name)
+                cdfs.append(cdf)
+            filt = CILDataFileFoundInFilesystemFilter(
+                temp_dir, temp_dir, expected_files=['{id}.json',
+                                                    '{file_name}'])
+            res = filt.get_cildatafiles(cdfs)
+            self.assertEqual([c.get_file_name() for c in res], ['1.raw'])
+
+            filt = CILDataFileFoundInFilesystemFilter(
+                temp_dir, temp_dir, expected_files=['{id}.zip'])
+            self.assertEqual(len(filt.get_cildatafiles(cdfs)), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _get_select_test_cildatafiles(self):
+        cdfs = []
+        for cur_id, name, success, size, mime, is_video, has_raw in [
+                (1000, '1000.raw', False, 2 * 1024 ** 3, None, False, True),
+                (1000, '1000.jpg', True, 10, 'image/jpeg', False, None),
+                (1500, '1500.RAW', False, None, None, False, False),
+                (2500, '2500.raw', False, 3 * 1024 ** 3, None, False, True),
+                (3000, '3000.flv', None, 20, 'video/x-flv', True, None),
+                (3001, None, None, None, None, None, None)]:
+            cdf = CILDataFile(cur_id)
+            cdf.set_file_name(name)
+            cdf.set_download_success(success)
+            cdf.set_file_size(size)
+            cdf.set_mime_type(mime)
+            cdf.set_is_video(is_video)
+            cdf.set_has_raw(has_raw)
+            cdfs.append(cdf)
+        return cdfs
+
+    def test_parse_size(self):
+        self.assertEqual(dbutil.parse_size('10'), 10)
+        self.assertEqual(dbutil.parse_size('2k'), 2048)
+        self.assertEqual(dbutil.parse_size('1.5M'), 1572864)
+        self.assertEqual(dbutil.parse_size('1GB'), 1024 ** 3)
+        self.assertEqual(dbutil.parse_size('1T'), 1024 ** 4)
+        try:
+            dbutil.parse_size('abc')
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Invalid size: abc')
+
+    def test_compile_select_invalid(self):
+        self.assertEqual(dbutil.compile_select(None), None)
+        self.assertEqual(dbutil.compile_select('  '), None)
+        for expr, msg in [('foo=1', 'Unknown field: foo'),
+                          ('id>', 'Unexpected end of select expression'),
+                          ('id 5', 'Expected operator after id but got 5'),
+                          ('id=x', 'Expected integer but got x'),
+                          ('success=maybe',
+                           'Expected true or false but got maybe'),
+                          ('success>true',
+                           'Only = and != can be used with success'),
+                          ('size>none',
+                           'Only = and != can be used with none'),
+                          ('suffix in 1..2',
+                           'Range only supported for id and size'),
+                          ('(id=1', 'Unexpected end of select expression'),
+                          ('id=1 id=2', 'Unexpected id in select expression'),
+                          ('id=1 and =', 'Expected field name but got ='),
+                          ('id=(', 'Expected value but got ('),
+                          ('id in (1 2)', 'Expected ) but got 2'),
+                          ("name='abc", 'Invalid select expression at: '
+                                        "'abc")]:
+            try:
+                dbutil.compile_select(expr)
+                self.fail('Expected ValueError for ' + expr)
+            except ValueError as e:
+                self.assertEqual(str(e), msg)
+        try:
+            CILDataFileSelectPredicate('foo', '=', 1)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Unknown field: foo')
+        try:
+            CILDataFileSelectPredicate('id', '~', 1)
+            self.fail('Expected ValueError')
+        except ValueError as e:
+            self.assertEqual(str(e), 'Unknown operator: ~')
+
+    def test_compile_select(self):
+        pred = dbutil.compile_select('suffix=raw and success=false and '
+                                     'size>1G and id in 1000..2000')
+        self.assertTrue(isinstance(pred, CILDataFileAndPredicate))
+        preds = pred.get_predicates()
+        self.assertEqual([(p.get_field(), p.get_op(), p.get_value())
+                          for p in preds],
+                         [('suffix', '=', '.raw'), ('success', '=', False),
+                          ('size', '>', 1024 ** 3),
+                          ('id', 'range', (1000, 2000))])
+        pred = dbutil.compile_select('NOT (Video = yes OR mime in '
+                                     '("image/jpeg", \'a b\')) and '
+                                     'file_name != none')
+        self.assertTrue(isinstance(pred, CILDataFileAndPredicate))
+        preds = pred.get_predicates()
+        self.assertEqual(preds[0].get_field(), 'name')
+        self.assertEqual(preds[0].get_op(), '!=')
+        self.assertEqual(preds[0].get_value(), None)
+        self.assertTrue(isinstance(preds[1], CILDataFileNotPredicate))
+
+    def test_select_predicate_matches_mask_and_sql_agree(self):
+        cdfs = self._get_select_test_cildatafiles()
+        table = CILDataFileTable.from_cildatafiles(cdfs)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            for cdf in cdfs:
+                writer.writeCILDataFileListToFile(
+                    os.path.join(temp_dir, str(cdf.get_file_name()) +
+                                 str(cdf.get_id())), [cdf])
+            index = CILDataFileCatalogIndex(os.path.join(
+                temp_dir, dbutil.CATALOG_INDEX_FILE))
+            index.rebuild(temp_dir)
+            for expr, expected in [
+                    ('suffix=raw and success=false and size>1G and '
+                     'id in 1000..2000', ['1000.raw']),
+                    ('suffix=raw', ['1000.raw', '1500.RAW', '2500.raw']),
+                    ('suffix!=raw', ['1000.jpg', '3000.flv']),
+                    ('suffix=none', [None]),
+                    ('suffix in (jpg, .flv)', ['1000.jpg', '3000.flv']),
+                    ('not suffix=raw', ['1000.jpg', '3000.flv', None]),
+                    ('success=false', ['1000.raw', '1500.RAW', '2500.raw']),
+                    ('success!=false', ['1000.jpg']),
+                    ('success=none', ['3000.flv', None]),
+                    ('success!=none', ['1000.raw', '1000.jpg', '1500.RAW',
+                                       '2500.raw']),
+                    ('not success=true', ['1000.raw', '1500.RAW',
+                                          '2500.raw', '3000.flv', None]),
+                    ('size<=20 or size=none', ['1000.jpg', '1500.RAW',
+                                               '3000.flv', None]),
+                    ('size in 10..20', ['1000.jpg', '3000.flv']),
+                    ('size>=3G', ['2500.raw']),
+                    ('size<1K and video=true', ['3000.flv']),
+                    ('id in (1500, 3001)', ['1500.RAW', None]),
+                    ('id>2500', ['3000.flv', None]),
+                    ('id<1500 and hasraw=true', ['1000.raw']),
+                    ('hasraw!=true', ['1500.RAW']),
+                    ('mime="image/jpeg"', ['1000.jpg']),
+                    ("name='2500.raw' or name=3000.flv",
+                     ['2500.raw', '3000.flv']),
+                    ('mime!=none and not (video=true)', ['1000.jpg'])]:
+                pred = dbutil.compile_select(expr)
+                res = [c.get_file_name() for c in
+                       pred.get_cildatafiles(cdfs)]
+                self.assertEqual(res, expected, expr)
+                res = pred.get_cildatafiles(table).get_file_names()
+                self.assertEqual(res, expected, expr)
+                res = [c.get_file_name() for c in
+                       index.iter_cildatafiles(predicate=pred)]
+                self.assertEqual(sorted(res, key=str),
+                                 sorted(expected, key=str), expr)
+            index.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafilefromjsonfilesfactory_with_predicate(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = CILDataFileJsonWriter()
+            for cur_id in ['1', '2', '30']:
+                id_dir = os.path.join(temp_dir, dbutil.IMAGES_DIR, cur_id)
+                os.makedirs(id_dir)
+                cdf = CILDataFile(cur_id)
+                cdf.set_file_name(cur_id + dbutil.RAW_SUFFIX)
+                zcdf = CILDataFile(cur_id)
+                zcdf.set_file_name(cur_id + dbutil.ZIP_SUFFIX)
+                writer.writeCILDataFileListToFile(os.path.join(id_dir,
+                                                               cur_id),
+                                                  [cdf, zcdf])
+            pred = dbutil.compile_select('id in 1..10 and suffix=zip')
+            fac = CILDataFileFromJsonFilesFactory(predicate=pred)
+            self.assertEqual(sorted([os.path.basename(f) for f in
+                                     fac.get_json_files(temp_dir)]),
+                             ['1.json', '2.json'])
+            res = fac.get_cildatafiles(temp_dir)
+            self.assertEqual(sorted([c.get_file_name() for c in res]),
+                             ['1.zip', '2.zip'])
+
+            pred = dbutil.compile_select('not id=1 or id=30')
+            fac = CILDataFileFromJsonFilesFactory(predicate=pred)
+            self.assertEqual(len(list(fac.get_json_files(temp_dir))), 3)
+
+            index = CILDataFileCatalogIndex(os.path.join(
+                temp_dir, dbutil.CATALOG_INDEX_FILE))
+            index.rebuild(temp_dir)
+            index.close()
+            fac = CILDataFileFromJsonFilesFactory(
+                predicate=dbutil.compile_select('suffix=raw and id>=2'))
+            res = fac.get_cildatafiles(temp_dir)
+            self.assertEqual(sorted([c.get_file_name() for c in res]),
+                             ['2.raw', '30.raw'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cildatafileconvertstate(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            jsonfile = os.path.join(temp_dir, '5' + dbutil.JSON_SUFFIX)
+            state = CILDataFileConvertState(temp_dir, 5)
+            self.assertEqual(state.get_state_file(),
+                             os.path.join(temp_dir, '5.convertstate'))
+            self.assertEqual(state.is_done(jsonfile), False)
+            self.assertEqual(state.get_step('5.raw'), (None, None))
+
+            cdf = CILDataFile(5)
+            cdf.set_file_name('5.avi')
+            cdf.set_headers({'Content-Type': 'video/avi'})
+            state.set_step('5.raw', dbutil.CONVERT_STEP_RENAMED, [cdf])
+
+            state = CILDataFileConvertState(temp_dir, '5')
+            step, cdfs = state.get_step('5.raw')
+            self.assertEqual(step, dbutil.CONVERT_STEP_RENAMED)
+            self.assertEqual(cdfs[0].get_file_name(), '5.avi')
+            self.assertEqual(cdfs[0].get_headers(),
+                             {'Content-Type': 'video/avi'})
+
+            # not done until json file is written and marked done
+            with open(jsonfile, 'w') as f:
+                f.write('[]')
+            self.assertEqual(state.is_done(jsonfile), False)
+            state.set_done(jsonfile)
+            self.assertEqual(state.get_step('5.raw'), (None, None))
+            state = CILDataFileConvertState(temp_dir, '5')
+            self.assertEqual(state.is_done(jsonfile), True)
+
+            # json file modified after conversion
+            dbutil.replace_file_atomically(jsonfile, lambda f: f.write('[]'))
+            state = CILDataFileConvertState(temp_dir, '5')
+            self.assertEqual(state.is_done(jsonfile), False)
+            os.unlink(jsonfile)
+            self.assertEqual(state.is_done(jsonfile), False)
+
+            # unreadable or unknown version state files are ignored
+            for data in ['{bad', '[]', '{"version": 99, "done": true}']:
+                with open(state.get_state_file(), 'w') as f:
+                    f.write(data)
+                state = CILDataFileConvertState(temp_dir, '5')
+                self.assertEqual(state.get_step('5.raw'), (None, None))
+                self.assertEqual(state.is_done(jsonfile), False)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _check_md5_uses_checksum_cache(self, temp_dir, cache):
+        somefile = os.path.join(temp_dir, 'somefile')
+        with open(somefile, 'w') as f:
+            f.write('hello')
+        # whole second times round trip through os.utime() exactly
+        os.utime(somefile, (1000000000, 1000000000))
+        orig_md5 = dbutil.md5(somefile)
+        self.assertEqual(dbutil.set_checksum_cache(cache), None)
+        try:
+            self.assertEqual(dbutil.md5(somefile), orig_md5)
+            self.assertEqual(cache.get_checksum(somefile), orig_md5)
+
+            # rename keeps inode, size and mtime so cached value is used
+            renamed = os.path.join(temp_dir, 'renamed')
+            os.rename(somefile, renamed)
+            with open(renamed, 'w') as f:
+                f.write('HELLO')
+            os.utime(renamed, (1000000000, 1000000000))
+            self.assertEqual(dbutil.md5(renamed), orig_md5)
+
+            # any change to mtime invalidates cached value
+            os.utime(renamed, (1000000000, 1000000001))
+            self.assertEqual(dbutil.md5(renamed),
+                             'eb61eead90e3b899c6bcbe27ac581660')
+            self.assertEqual(cache.get_checksum(renamed),
+                             'eb61eead90e3b899c6bcbe27ac581660')
+            self.assertEqual(cache.get_checksum(renamed, algorithm='sha1'),
+                             None)
+            self.assertEqual(cache.get_checksum(somefile), None)
+            cache.set_checksum(somefile, 'foo')
+        finally:
+            self.assertEqual(dbutil.get_checksum_cache(), cache)
+            dbutil.close_checksum_cache()
+            self.assertEqual(dbutil.get_checksum_cache(), None)
+
+    def test_checksum_cache_database(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(dbutil.open_checksum_cache(None), None)
+            cache_file = os.path.join(temp_dir, dbutil.CHECKSUM_CACHE_FILE)
+            cache = dbutil.open_checksum_cache(cache_file)
+            self._check_md5_uses_checksum_cache(temp_dir, cache)
+
+            # persisted across instances
+            cache = CILDataFileChecksumCache(cache_file=cache_file)
+            renamed = os.path.join(temp_dir, 'renamed')
+            self.assertEqual(cache.get_checksum(renamed),
+                             'eb61eead90e3b899c6bcbe27ac581660')
+            cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_hash_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            somefile = os.path.join(temp_dir, 'somefile')
+            data = bytes(bytearray(random.getrandbits(8)
+                                   for x in range(10000)))
+            with open(somefile, 'wb') as f:
+                f.write(data)
+            expected = {dbutil.MD5_ALGORITHM: hashlib.md5(data).hexdigest(),
+                        dbutil.SHA256_ALGORITHM:
+                            hashlib.sha256(data).hexdigest()}
+            algos = (dbutil.MD5_ALGORITHM, dbutil.SHA256_ALGORITHM)
+
+            # serial with buffer not a multiple of file size
+            self.assertEqual(dbutil.hash_file(somefile, algorithms=algos,
+                                              buffer_size=999), expected)
+
+            # threaded digests equal serial digests
+            serial = dbutil.hash_file(somefile, algorithms=algos,
+                                      buffer_size=777)
+            with patch('cildata_util.dbutil.PARALLEL_HASH_MIN_SIZE', 1), \
+                    patch('cildata_util.dbutil._update_hashers_in_parallel',
+                          wraps=dbutil._update_hashers_in_parallel) as \
+                    mock_parallel:
+                threaded = dbutil.hash_file(somefile, algorithms=algos,
+                                            buffer_size=777, threads=3)
+                self.assertEqual(mock_parallel.call_count, 1)
+                self.assertEqual(threaded, serial)
+                self.assertEqual(threaded, expected)
+
+                # single digest is not worth a thread pool
+                self.assertEqual(dbutil.hash_file(somefile, threads=3),
+                                 {dbutil.MD5_ALGORITHM:
+                                  expected[dbutil.MD5_ALGORITHM]})
+                self.assertEqual(mock_parallel.call_count, 1)
+
+            # empty file
+            emptyfile = os.path.join(temp_dir, 'emptyfile')
+            open(emptyfile, 'wb').close()
+            with patch('cildata_util.dbutil.PARALLEL_HASH_MIN_SIZE', 0):
+                self.assertEqual(dbutil.hash_file(emptyfile, algorithms=algos,
+                                                  threads=2),
+                                 {dbutil.MD5_ALGORITHM:
+                                  'd41d8cd98f00b204e9800998ecf8427e',
+                                  dbutil.SHA256_ALGORITHM:
+                                  hashlib.sha256(b'').hexdigest()})
+
+            # cache only used if all algorithms are cached
+            cache = CILDataFileChecksumCache(
+                cache_file=os.path.join(temp_dir, 'cache.sqlite'))
+            dbutil.set_checksum_cache(cache)
+            try:
+                cache.set_checksum(somefile, 'foo')
+                self.assertEqual(dbutil.hash_file(somefile,
+                                                  algorithms=algos),
+                                 expected)
+                self.assertEqual(cache.get_checksum(
+                    somefile, algorithm=dbutil.SHA256_ALGORITHM),
+                    expected[dbutil.SHA256_ALGORITHM])
+                cache.set_checksum(somefile, 'foo')
+                self.assertEqual(dbutil.hash_file(somefile),
+                                 {dbutil.MD5_ALGORITHM: 'foo'})
+                self.assertEqual(dbutil.hash_file(somefile,
+                                                  use_cache=False),
+                                 {dbutil.MD5_ALGORITHM:
+                                  expected[dbutil.MD5_ALGORITHM]})
+            finally:
+                dbutil.close_checksum_cache()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_checksum_cache_xattr(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            try:
+                os.setxattr(temp_dir, dbutil.CHECKSUM_XATTR_PREFIX + 'test',
+                            b'1')
+            except (AttributeError, OSError):
+                self.skipTest('user extended attributes not supported')
+            cache = dbutil.open_checksum_cache(None, use_xattr=True)
+            self._check_md5_uses_checksum_cache(temp_dir, cache)
+            renamed = os.path.join(temp_dir, 'renamed')
+            self.assertEqual(os.getxattr(renamed, 'user.cildata.md5')
+                             .decode('ascii').split(':')[2],
+                             'eb61eead90e3b899c6bcbe27ac581660')
+            self.assertEqual(os.listdir(temp_dir), ['renamed'])
+        finally:
+            shutil.rmtree(temp_dir)